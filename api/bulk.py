@@ -0,0 +1,171 @@
+import csv
+import io
+from datetime import datetime
+from typing import AsyncIterator, Callable, List, Optional, Sequence, Tuple
+import orjson
+from fastapi import HTTPException, status
+from pydantic import ValidationError
+from sqlalchemy import Select
+from starlette.requests import Request
+
+from api.config import settings
+from api.database import AsyncSessionLocal
+from api.formating import json_default
+
+
+# (row number, parsed record or None, error or None), rows are numbered from 1
+Record = Tuple[int, Optional[dict], Optional[str]]
+
+NDJSON_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl", "application/json-lines"}
+CSV_TYPES = {"text/csv", "application/csv"}
+
+
+class ImportReport:
+    '''
+    Outcome of a bulk import, errors are kept up to IMPORT_MAX_ERRORS.
+    '''
+    def __init__(self) -> None:
+        self.inserted = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+
+    def fail(self, row: int, error: str):
+        self.failed += 1
+        if len(self.errors) < settings.IMPORT_MAX_ERRORS:
+            self.errors.append({"row": row, "error": error})
+
+    def as_dict(self) -> dict:
+        return {
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+
+def validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}" for e in error.errors())
+
+
+async def read_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    '''
+    Lines of a streamed body, decoded one at a time; nothing else is kept in memory.
+    '''
+    buffer = b""
+    async for piece in stream:
+        buffer += piece
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8", errors="replace")
+
+        if len(buffer) > settings.IMPORT_MAX_LINE_SIZE:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f'Lines cannot exceed {settings.IMPORT_MAX_LINE_SIZE} bytes')
+
+    if buffer:
+        yield buffer.rstrip(b"\r").decode("utf-8", errors="replace")
+
+
+async def ndjson_records(stream: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    row = 0
+    async for line in read_lines(stream):
+        if not line.strip():
+            continue
+
+        row += 1
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            yield row, None, "Invalid JSON"
+            continue
+
+        if not isinstance(record, dict):
+            yield row, None, "Expected a JSON object"
+            continue
+        yield row, record, None
+
+
+async def csv_records(stream: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    '''
+    The first record is the header. Quoted fields may span lines.
+    '''
+    header = None
+    row = 0
+    # Lines of the current record and whether a quoted field is still open at its end
+    pending: List[str] = []
+    pending_size = 0
+    quoted = False
+
+    async for line in read_lines(stream):
+        pending.append(line)
+        pending_size += len(line) + 1
+        if pending_size > settings.IMPORT_MAX_LINE_SIZE:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f'Records cannot exceed {settings.IMPORT_MAX_LINE_SIZE} bytes')
+
+        # An odd number of quotes opens or closes a quoted field ("" escapes are even)
+        if line.count('"') % 2:
+            quoted = not quoted
+        if quoted:
+            continue
+
+        record = "\n".join(pending)
+        pending, pending_size = [], 0
+        if not record.strip():
+            continue
+
+        values = next(csv.reader([record]))
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+
+        row += 1
+        if len(values) != len(header):
+            yield row, None, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        # Empty cells are missing values
+        yield row, {name: value for name, value in zip(header, values) if value != ""}, None
+
+    if pending:
+        yield row + 1, None, "Unterminated quoted field"
+
+
+def records(request: Request) -> AsyncIterator[Record]:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    if content_type in NDJSON_TYPES:
+        return ndjson_records(request.stream())
+    if content_type in CSV_TYPES:
+        return csv_records(request.stream())
+
+    raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                        detail='Expected application/x-ndjson or text/csv')
+
+
+def to_ndjson(columns: Sequence[str], rows: list) -> bytes:
+    return b"".join(orjson.dumps(dict(zip(columns, row)), default=json_default, option=orjson.OPT_APPEND_NEWLINE)
+                    for row in rows)
+
+
+def to_csv(columns: Sequence[str], rows: list) -> bytes:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerows([value.isoformat() if isinstance(value, datetime) else value for value in row]
+                     for row in rows)
+    return output.getvalue().encode("utf-8")
+
+
+async def export_rows(query: Select, serialize: Callable[[Sequence[str], list], bytes],
+                      header: Optional[bytes] = None) -> AsyncIterator[bytes]:
+    '''
+    Stream a query through a server-side cursor, EXPORT_BATCH_SIZE rows per chunk.
+    Opens its own session: the body is sent after the request's one is gone.
+    '''
+    if header:
+        yield header
+
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(query.execution_options(yield_per=settings.EXPORT_BATCH_SIZE))
+        columns = list(result.keys())
+        async for rows in result.partitions():
+            yield serialize(columns, rows)
@@ -1,7 +1,11 @@
+from typing import Optional
 from pydantic import BaseSettings
 
 
 class Settings(BaseSettings):
+    # Adds Server-Timing headers to responses
+    DEBUG: bool = False
+
     DB_CONNECTION: str
     DB_HOST: str
     DB_PORT: int
@@ -9,6 +13,136 @@ class Settings(BaseSettings):
     DB_USER: str
     DB_PASSWORD: str
 
+    # Access tokens
+    JWT_SECRET: str
+    # Days
+    JWT_EXPIRATION_TIME: int
+    JWT_ALGORITHM: str = "HS256"
+    # Key id of JWT_SECRET in token headers
+    JWT_KEY_ID: str = "default"
+    # Rotation, "new-kid:secret,old-kid:secret", the first key signs and all of them verify
+    JWT_KEYS: Optional[str] = None
+    # Seconds between reloads of the revocation list from the database
+    REVOCATION_REFRESH_INTERVAL: float = 30
+    # Seconds before role permissions are reloaded even without a change notification
+    PERMISSIONS_REFRESH_INTERVAL: float = 300
+    # Days a refresh token stays usable, each refresh starts a new period
+    REFRESH_TOKEN_LIFETIME: int = 30
+    # Hours a password reset code stays valid
+    RESET_CODE_LIFETIME: int = 2
+
+    # Connection pool
+    DB_ASYNC_DRIVER: str = "asyncpg"
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    # Milliseconds, 0 disables the timeout
+    DB_STATEMENT_TIMEOUT: int = 30000
+
+    # Cache, in-process unless a shared redis:// backend is configured
+    CACHE_URL: Optional[str] = None
+    PRINCIPAL_CACHE_SIZE: int = 10000
+    PRINCIPAL_CACHE_TTL: int = 60
+    # Serialized read responses, per user, dropped on writes. Several processes need CACHE_URL
+    # or REALTIME_BACKEND=postgres to hear about each other's writes
+    RESPONSE_CACHE_SIZE: int = 2048
+    RESPONSE_CACHE_TTL: int = 30
+
+    # Password hashing
+    BCRYPT_ROUNDS: int = 12
+    HASH_WORKERS: int = 4
+    HASH_QUEUE_SIZE: int = 64
+    # Seconds to wait for a free hashing slot before answering 503
+    HASH_QUEUE_TIMEOUT: float = 5
+
+    # Pagination
+    PAGINATION_MAX_LIMIT: int = 100
+
+    # Uploads
+    UPLOAD_DIRECTORY: str = "uploads"
+    UPLOAD_CHUNK_SIZE: int = 5 * 1024 * 1024
+    UPLOAD_MAX_CHUNK_SIZE: int = 64 * 1024 * 1024
+    # Apply to every storage backend, S3 adds its own part limits on top
+    UPLOAD_MIN_CHUNK_SIZE: int = 64 * 1024
+    UPLOAD_MAX_CHUNKS: int = 10000
+    UPLOAD_MAX_SIZE: int = 5 * 1024 * 1024 * 1024
+
+    # Bulk archive import and export
+    IMPORT_BATCH_SIZE: int = 1000
+    IMPORT_MAX_ERRORS: int = 1000
+    IMPORT_MAX_LINE_SIZE: int = 1024 * 1024
+    EXPORT_BATCH_SIZE: int = 1000
+
+    # Blob storage, "s3" for any S3-compatible service (Linode Object Storage, MinIO), needs boto3
+    STORAGE_BACKEND: str = "local"
+    S3_BUCKET: Optional[str] = None
+    S3_ENDPOINT_URL: Optional[str] = None
+    S3_REGION: Optional[str] = None
+    S3_ACCESS_KEY: Optional[str] = None
+    S3_SECRET_KEY: Optional[str] = None
+    # Key prefix, lets several deployments share a bucket
+    S3_PREFIX: str = ""
+    # "path" for MinIO and other stand-ins without wildcard DNS
+    S3_ADDRESSING_STYLE: str = "auto"
+    # Connections shared by concurrent part uploads
+    S3_MAX_POOL_CONNECTIONS: int = 32
+    # Part uploads sent at once per process, the others wait with their part buffered
+    S3_MAX_CONCURRENT_PARTS: int = 16
+    # Seconds a download URL stays valid
+    S3_PRESIGN_EXPIRES: int = 300
+
+    # Background jobs, run by `python -m api.worker`
+    JOB_CONCURRENCY: int = 8
+    JOB_PROCESSES: int = 2
+    # Seconds between polls while the queue is empty
+    JOB_POLL_INTERVAL: float = 1
+    # Seconds before a running job whose worker died is claimed again
+    JOB_LOCK_TIMEOUT: int = 600
+    JOB_RETRY_BASE_DELAY: float = 5
+    JOB_RETRY_MAX_DELAY: float = 3600
+
+    # Outbound mail. Queued until SMTP_HOST is set, or only logged (recipient and subject)
+    # with MAIL_LOG_ONLY, for development
+    APP_BASE_URL: str = "http://localhost:3000"
+    MAIL_FROM: str = "Managia <no-reply@localhost>"
+    SMTP_HOST: Optional[str] = None
+    MAIL_LOG_ONLY: bool = False
+    SMTP_PORT: int = 587
+    SMTP_USER: Optional[str] = None
+    SMTP_PASSWORD: Optional[str] = None
+    SMTP_STARTTLS: bool = True
+    SMTP_SSL: bool = False
+    SMTP_TIMEOUT: float = 30
+    MAIL_BATCH_SIZE: int = 50
+    MAIL_MAX_ATTEMPTS: int = 8
+    # Mails queued for one address within the window, further requests are refused
+    MAIL_RECIPIENT_LIMIT: int = 5
+    MAIL_RECIPIENT_WINDOW: int = 3600
+
+    # Maintenance, run by the worker every PURGE_INTERVAL seconds
+    # Rows deleted per transaction
+    PURGE_BATCH_SIZE: int = 1000
+    PURGE_INTERVAL: int = 3600
+    # Seconds before an unfinished upload and its temp file are dropped
+    UPLOAD_SESSION_TTL: int = 24 * 3600
+    # Days soft-deleted rows are kept before being deleted for good
+    SOFT_DELETE_RETENTION: int = 30
+    # Days finished jobs and sent mails are kept
+    JOB_RETENTION: int = 7
+    # Seconds an unreferenced blob is kept, an upload may be about to reuse it
+    BLOB_GRACE_PERIOD: int = 3600
+
+    # Realtime, "postgres" fans events out to every worker through LISTEN/NOTIFY
+    REALTIME_BACKEND: str = "memory"
+    REALTIME_CHANNEL: str = "managia_events"
+    # Events buffered per connection before a slow client starts missing some
+    REALTIME_QUEUE_SIZE: int = 256
+    REALTIME_MAX_SUBSCRIPTIONS: int = 64
+    # Seconds between checks that a connected client's token is not revoked, expiry closes it on time
+    REALTIME_TOKEN_CHECK_INTERVAL: float = 30
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
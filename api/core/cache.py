@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional
+
+from api.config import settings
+
+
+# Values are strings so the in-process and the shared backend are interchangeable
+class LocalCache:
+    def __init__(self, namespace: str, maxsize: int, ttl: float) -> None:
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        value, expires_at = item
+        if expires_at < monotonic():
+            self._items.pop(key, None)
+            return None
+
+        self._items.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        self._items[key] = (value, monotonic() + (ttl or self.ttl))
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    async def delete(self, key: str):
+        self._items.pop(key, None)
+
+    async def clear(self):
+        self._items.clear()
+
+
+class RedisCache:
+    def __init__(self, client, namespace: str, ttl: float) -> None:
+        self.client = client
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.client.get(self._key(key))
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        await self.client.set(self._key(key), value, px=int((ttl or self.ttl) * 1000))
+
+    async def delete(self, key: str):
+        await self.client.delete(self._key(key))
+
+    async def clear(self):
+        async for key in self.client.scan_iter(match=self._key("*")):
+            await self.client.unlink(key)
+
+
+redis_client = None
+
+
+def get_redis_client():
+    global redis_client
+
+    if redis_client is None:
+        try:
+            from redis import asyncio as redis
+        except ImportError:
+            raise RuntimeError("CACHE_URL is set but the redis package is not installed")
+
+        redis_client = redis.from_url(settings.CACHE_URL, decode_responses=True)
+
+    return redis_client
+
+
+def create_cache(namespace: str, maxsize: int, ttl: float):
+    if settings.CACHE_URL:
+        return RedisCache(get_redis_client(), namespace, ttl)
+    return LocalCache(namespace, maxsize, ttl)
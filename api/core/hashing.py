@@ -1,14 +1,81 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Optional, Tuple
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
-pwd_cxt = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from api import metrics
+from api.config import settings
+
+pwd_cxt = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+# bcrypt releases the GIL, so threads give real parallelism here
+hash_executor = ThreadPoolExecutor(max_workers=settings.HASH_WORKERS, thread_name_prefix="hash")
+# Running plus queued hashes, anything beyond waits for a slot or gets a 503
+hash_slots = asyncio.Semaphore(settings.HASH_WORKERS + settings.HASH_QUEUE_SIZE)
+
+hash_pool_size = metrics.Gauge("hash_pool_size", "Threads available for password hashing")
+hash_pool_in_flight = metrics.Gauge("hash_pool_in_flight", "Password hashes running or queued in the pool")
+hash_pool_waiting = metrics.Gauge("hash_pool_waiting", "Requests waiting for a slot in the hash pool")
+hash_pool_rejected = metrics.Counter("hash_pool_rejected_total", "Requests rejected because the hash pool was saturated")
+hash_wait_seconds = metrics.Histogram("hash_wait_seconds", "Time spent waiting for a slot in the hash pool")
+hash_duration_seconds = metrics.Histogram("hash_duration_seconds", "Time spent hashing or verifying one password")
+hash_pool_size.set(settings.HASH_WORKERS)
+
+
+async def run_in_hash_pool(func, *args):
+    started_at = perf_counter()
+    hash_pool_waiting.inc()
+    try:
+        await asyncio.wait_for(hash_slots.acquire(), settings.HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        hash_pool_rejected.inc()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many authentication requests, try again shortly",
+            headers={"Retry-After": "1"},
+        )
+    finally:
+        hash_pool_waiting.dec()
+
+    acquired_at = perf_counter()
+    hash_wait_seconds.observe(acquired_at - started_at)
+    hash_pool_in_flight.inc()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(hash_executor, func, *args)
+    finally:
+        finished_at = perf_counter()
+        hash_duration_seconds.observe(finished_at - acquired_at)
+        metrics.record_timing("hash", finished_at - started_at)
+        hash_pool_in_flight.dec()
+        hash_slots.release()
 
 
 class Hash:
     def __init__(self) -> None:
         pass
-    
+
+    @staticmethod
     def bcrypt(password):
         return pwd_cxt.hash(password)
 
+    @staticmethod
     def verify(plain_password, hashed_password):
         return pwd_cxt.verify(plain_password, hashed_password)
+
+    @staticmethod
+    async def bcrypt_async(password) -> str:
+        return await run_in_hash_pool(pwd_cxt.hash, password)
+
+    @staticmethod
+    async def verify_async(plain_password, hashed_password) -> bool:
+        return await run_in_hash_pool(pwd_cxt.verify, plain_password, hashed_password)
+
+    @staticmethod
+    async def verify_and_update(plain_password, hashed_password) -> Tuple[bool, Optional[str]]:
+        '''
+        Verify a password and, when the stored hash uses outdated settings
+        (e.g. fewer rounds than BCRYPT_ROUNDS), return a fresh hash to store.
+        '''
+        return await run_in_hash_pool(pwd_cxt.verify_and_update, plain_password, hashed_password)
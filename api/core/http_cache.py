@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import secrets
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+import orjson
+from fastapi import Request, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api import metrics
+from api.config import settings
+from api.core.cache import create_cache
+from api.realtime import broker
+
+
+TOPIC = "cache"
+# Version of a scope never invalidated, or whose version has expired
+INITIAL_VERSION = "0"
+# Far longer than any entry lives, an expired version only falls back to INITIAL_VERSION
+# once the entries cached under it are gone
+VERSION_TTL = 24 * 3600
+
+hits = metrics.Counter("response_cache_hits_total", "Responses served from the response cache")
+misses = metrics.Counter("response_cache_misses_total", "Responses built because they were not cached")
+not_modified = metrics.Counter("response_cache_not_modified_total", "Requests answered with 304 Not Modified")
+
+# Serialized body and the validators its ETag is derived from
+Build = Callable[[], Awaitable[Tuple[str, tuple]]]
+
+
+def weak_etag(*validators) -> str:
+    # Weak: derived from ids and updated_at, not from the exact bytes
+    return f'W/"{hashlib.blake2b(orjson.dumps(validators, default=str), digest_size=16).hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+
+    # Weak comparison, as If-None-Match requires
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+class ResponseCache:
+    '''
+    JSON responses of read endpoints, cached per user and answered with 304
+    when the client already has them.
+    Entries are keyed by a version of their scope ("archives", "user:<id>");
+    invalidate() moves the version and old entries age out.
+    With CACHE_URL the versions live next to the entries, every process (API
+    workers, python -m api.worker) shares both. Otherwise they are per process
+    and other processes only hear about invalidations through the broker, which
+    needs REALTIME_BACKEND=postgres.
+    '''
+    def __init__(self) -> None:
+        self.cache = create_cache("responses", settings.RESPONSE_CACHE_SIZE, settings.RESPONSE_CACHE_TTL)
+        self.shared = bool(settings.CACHE_URL)
+        self.versions: Dict[str, str] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    async def version(self, scope: str) -> str:
+        if self.shared:
+            return await self.cache.get(f"version:{scope}") or INITIAL_VERSION
+        return self.versions.get(scope, INITIAL_VERSION)
+
+    async def key(self, request: Request, scope: str, user_id) -> str:
+        version = await self.version(scope)
+        return f"{scope}:{version}:{user_id}:{request.url.path}?{request.url.query}"
+
+    async def respond(self, request: Request, scope: str, user_id, build: Build) -> Response:
+        '''
+        return await response_cache.respond(request, "archives", current_user.id, build)
+        build() runs only on a miss and returns (json, validators), e.g. (body, (id, updated_at)).
+        '''
+        # Taken before building, a write during the build leaves the entry under the old version
+        key = await self.key(request, scope, user_id)
+
+        cached = await self.cache.get(key)
+        if cached is not None:
+            hits.inc()
+            etag, _, content = cached.partition("\n")
+        else:
+            misses.inc()
+            content, validators = await build()
+            etag = weak_etag(*validators)
+            await self.cache.set(key, f"{etag}\n{content}")
+
+        headers = {"etag": etag, "cache-control": "private, no-cache", "vary": "Authorization"}
+        if etag_matches(request, etag):
+            not_modified.inc()
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        return Response(content=content, media_type="application/json", headers=headers)
+
+    async def invalidate(self, *scopes: str, db: Optional[AsyncSession] = None):
+        '''
+        Call after a write. With db the other workers hear about it when that transaction commits.
+        '''
+        versions = {scope: secrets.token_hex(8) for scope in scopes}
+        if self.shared:
+            for scope, version in versions.items():
+                await self.cache.set(f"version:{scope}", version, ttl=VERSION_TTL)
+            return
+
+        self.versions.update(versions)
+        await broker.publish("cache.invalidated", {"versions": versions}, TOPIC, db=db)
+
+    async def listen(self):
+        queue = asyncio.Queue(maxsize=256)
+        broker.subscribe(TOPIC, queue)
+        try:
+            while True:
+                message = orjson.loads(await queue.get())
+                self.versions.update(message["data"]["versions"])
+        finally:
+            broker.unsubscribe(TOPIC, queue)
+
+    async def start(self):
+        # Shared versions need no listener
+        if self.task is None and not self.shared:
+            self.task = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+response_cache = ResponseCache()
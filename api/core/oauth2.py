@@ -2,80 +2,106 @@
 from typing import Optional
 from fastapi import Depends, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from jwt import encode, decode, exceptions
-from datetime import datetime, timedelta
-from os import getenv
+from uuid import UUID
 
+from api.config import settings
+from api.core import tokens
+from api.core.cache import create_cache
 from api.core.schemas import UserOAuth
 from api.models import User
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from api import database
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-
-def expire_date(days: int):
-    date = datetime.now()
-    new_date = date + timedelta(days)
-    return new_date
+# Users of older tokens without embedded claims, keyed by token subject
+principal_cache = create_cache(
+    "principal", settings.PRINCIPAL_CACHE_SIZE, settings.PRINCIPAL_CACHE_TTL)
 
 
 def write_token(data: dict):
-    token = encode(
-        payload={
-            **data, "exp": expire_date(int(getenv("JWT_EXPIRATION_TIME")))},
-        key=getenv("JWT_SECRET"),
-        algorithm="HS256"
-    )
-    return token
+    return tokens.issue(data)
+
+
+def principal_claims(user: User) -> dict:
+    # Enough to authorize most requests from the token alone
+    return {
+        "sub": user.email,
+        "uid": str(user.id),
+        "is_active": user.is_active,
+        "roles": user.roles or [],
+    }
 
 
 def validate_token(token, output=False):
     try:
-        if output:
-            return decode(token, key=getenv("JWT_SECRET"), algorithms=["HS256"])
-        decode(token, key=getenv("JWT_SECRET"), algorithms=["HS256"])
-    except exceptions.DecodeError:
+        payload = tokens.verify(token)
+    except tokens.TokenError as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid Token",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    except exceptions.ExpiredSignatureError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Token Expired",
+            detail=e.detail,
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+    if output:
+        return payload
+
+
+def credentials_exception():
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = database.session()):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = database.async_session()):
     payload = validate_token(token, output=True)
-    email: str = payload.get("sub")
 
-    # Find user from DB
-    user: Optional[User] = db.query(User).filter(User.email == email).first()
+    # Signed claims are trusted as is, no database or cache on this path
+    if "uid" in payload:
+        return UserOAuth.construct(
+            id=UUID(payload["uid"]),
+            email=payload["sub"],
+            is_active=payload.get("is_active", True),
+            roles=payload.get("roles"),
+        )
 
-    # If user not found
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
+    # Tokens issued before claims were embedded only carry the email
+    email: str = payload.get("sub")
+
+    principal = await principal_cache.get(email)
+    if principal:
+        userOAuth = UserOAuth.parse_raw(principal)
+    else:
+        # Find user from DB
+        user: Optional[User] = (await db.execute(select(User).where(User.email == email))).scalars().first()
+
+        # If user not found
+        if not user:
+            raise credentials_exception()
+
+        userOAuth = UserOAuth(
+            id=user.id,
+            email=user.email,
+            is_active=user.is_active,
+            roles=user.roles
         )
 
+        await principal_cache.set(email, userOAuth.json())
 
-    userOAuth = UserOAuth(
-        id=user.id,
-        email=user.email,
-        is_active=user.is_active,
-        roles=user.roles
-    )
+    if tokens.revocations.is_user_revoked(userOAuth.id, payload.get("iat", 0)):
+        raise credentials_exception()
 
     return userOAuth
 
 
+async def invalidate_principal(email: str):
+    await principal_cache.delete(email)
+
+
 async def get_current_active_user(current_user: UserOAuth = Depends(get_current_user)):
     if current_user.is_active is False:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -0,0 +1,128 @@
+import asyncio
+from typing import Dict, FrozenSet, Iterable, Optional
+from fastapi import Depends, HTTPException, status
+from sqlalchemy import and_, func, select
+
+from api.config import settings
+from api.core.oauth2 import get_current_active_user
+from api.core.schemas import UserOAuth
+from api.database import AsyncSessionLocal
+from api.models import Permission, Role
+from api.realtime import broker
+
+# Granted everything without a row in permissions
+SUPER_ROLE = "super_admin"
+WILDCARD = "*"
+TOPIC = "permissions"
+
+
+class PermissionMap:
+    '''
+    Role -> permissions, loaded once and kept as frozensets.
+    invalidate() bumps the version, the next check reloads the whole map in one query.
+    Checks are a few set lookups: the permission, "resource:*" and "*".
+    '''
+    def __init__(self) -> None:
+        self.roles: Dict[str, FrozenSet[str]] = {}
+        # Union for each combination of roles seen, most users share a handful
+        self.combined: Dict[FrozenSet[str], FrozenSet[str]] = {}
+        self.version = 1
+        self.loaded_version = 0
+        self.lock = asyncio.Lock()
+        self.tasks = []
+
+    async def load(self):
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(func.coalesce(Role.slug, Role.name).label("role"),
+                       func.coalesce(Permission.slug, Permission.name).label("permission"))
+                .outerjoin(Permission, and_(Permission.role_id == Role.id, Permission.deleted_at.is_(None)))
+                .where(Role.deleted_at.is_(None))
+            )).all()
+
+        roles: Dict[str, set] = {SUPER_ROLE: {WILDCARD}}
+        for row in rows:
+            permissions = roles.setdefault(row.role, set())
+            if row.permission:
+                permissions.add(row.permission)
+
+        return {role: frozenset(permissions) for role, permissions in roles.items()}
+
+    async def ensure_loaded(self):
+        if self.loaded_version == self.version:
+            return
+
+        async with self.lock:
+            version = self.version
+            if self.loaded_version == version:
+                return
+
+            self.roles, self.combined = await self.load(), {}
+            self.loaded_version = version
+
+    def permissions_of(self, roles: Iterable[str]) -> FrozenSet[str]:
+        key = frozenset(roles)
+        permissions = self.combined.get(key)
+        if permissions is None:
+            permissions = frozenset().union(*(self.roles.get(role, frozenset()) for role in key))
+            self.combined[key] = permissions
+        return permissions
+
+    async def allows(self, roles: Optional[Iterable[str]], permission: str) -> bool:
+        await self.ensure_loaded()
+
+        granted = self.permissions_of(roles or ())
+        resource = permission.partition(":")[0]
+        return permission in granted or f"{resource}:*" in granted or WILDCARD in granted
+
+    def invalidate_local(self):
+        self.version += 1
+
+    async def invalidate(self):
+        '''
+        Call after changing roles or permissions, every worker reloads on its next check.
+        '''
+        self.invalidate_local()
+        await broker.publish("permissions.changed", {"version": self.version}, TOPIC)
+
+    async def listen(self):
+        queue = asyncio.Queue(maxsize=16)
+        broker.subscribe(TOPIC, queue)
+        try:
+            while True:
+                await queue.get()
+                self.invalidate_local()
+        finally:
+            broker.unsubscribe(TOPIC, queue)
+
+    async def expire(self):
+        # Also picks up changes made outside the API, e.g. by hand in SQL
+        while True:
+            await asyncio.sleep(settings.PERMISSIONS_REFRESH_INTERVAL)
+            self.invalidate_local()
+
+    async def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.listen()), asyncio.create_task(self.expire())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+
+permission_map = PermissionMap()
+
+
+def require_permission(permission: str):
+    '''
+    current_user: UserOAuth = require_permission("archives:delete")
+    Roles come from the token, so the check adds no query.
+    '''
+    async def check_permission(current_user: UserOAuth = Depends(get_current_active_user)) -> UserOAuth:
+        if not await permission_map.allows(current_user.roles, permission):
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail=f'Permission {permission} required')
+        return current_user
+
+    return Depends(check_permission)
@@ -0,0 +1,79 @@
+import hashlib
+import secrets
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+from uuid import UUID, uuid4
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.config import settings
+from api.models import RefreshToken
+
+
+refresh_token_lifetime = timedelta(days=settings.REFRESH_TOKEN_LIFETIME)
+
+
+def hash_token(token: str) -> str:
+    # Opaque random tokens, a fast hash is enough to make a leaked table useless
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def create(db: AsyncSession, user_id: UUID, family_id: Optional[UUID] = None) -> str:
+    '''
+    New refresh token in the caller's transaction, a new family unless one is given.
+    '''
+    token = secrets.token_urlsafe(32)
+    now = datetime.now(timezone.utc)
+
+    await db.execute(insert(RefreshToken).values(
+        id=uuid4(),
+        token_hash=hash_token(token),
+        user_id=user_id,
+        family_id=family_id or uuid4(),
+        expires_at=now + refresh_token_lifetime,
+        created_at=now,
+    ))
+    return token
+
+
+async def rotate(db: AsyncSession, token: str) -> Optional[Tuple[UUID, str]]:
+    '''
+    Spend a refresh token and issue its successor in the same family.
+    Returns (user_id, new token), or None when the token cannot be used.
+    A token that was already spent means it leaked: its whole family is revoked,
+    the caller must commit that before answering.
+    '''
+    token_hash = hash_token(token)
+
+    # Marking it used is the check, two concurrent refreshes cannot both win
+    spent = (await db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.token_hash == token_hash,
+               RefreshToken.used_at.is_(None),
+               RefreshToken.revoked_at.is_(None),
+               RefreshToken.expires_at > func.now())
+        .values(used_at=func.now())
+        .returning(RefreshToken.user_id, RefreshToken.family_id)
+    )).first()
+
+    if spent is None:
+        reused_family = (select(RefreshToken.family_id)
+                         .where(RefreshToken.token_hash == token_hash,
+                                RefreshToken.used_at.is_not(None))
+                         .scalar_subquery())
+        await db.execute(update(RefreshToken)
+                         .where(RefreshToken.family_id == reused_family,
+                                RefreshToken.revoked_at.is_(None))
+                         .values(revoked_at=func.now())
+                         .execution_options(synchronize_session=False))
+        return None
+
+    return spent.user_id, await create(db, spent.user_id, spent.family_id)
+
+
+async def revoke_user(db: AsyncSession, user_id: UUID):
+    await db.execute(update(RefreshToken)
+                     .where(RefreshToken.user_id == user_id,
+                            RefreshToken.revoked_at.is_(None))
+                     .values(revoked_at=func.now()))
+
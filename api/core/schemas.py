@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import List, Optional
 from pydantic import BaseModel, EmailStr, Field
 from uuid import UUID
@@ -15,6 +16,10 @@ class LoginSchema(BaseModel):
     password: str = Field(..., min_length=6)
 
 
+class RefreshTokenSchema(BaseModel):
+    refresh_token: str = Field(..., min_length=1)
+
+
 class RegisterUserAdminSchema(BaseModel):
     firstname: str = Field(...)
     lastname: str = Field(...)
@@ -41,9 +46,76 @@ class CreateWorkspace(BaseModel):
     description: Optional[str]
 
 
-class UploadChunkFile(BaseModel):
+class CreateUploadSession(BaseModel):
     archive_id: Optional[UUID] = None
+    name: str = Field(..., max_length=255)
+    size: int = Field(..., ge=0)
+    chunk_size: Optional[int] = Field(None, gt=0)
+    # Lets the server skip the upload when it already stores these bytes
+    sha256: Optional[str] = Field(None, regex=r'^[0-9a-f]{64}$')
+
+
+# Response models
+
+class ArchiveOut(BaseModel):
+    id: UUID
+    title: str
+    description: Optional[str]
+    author_id: Optional[UUID]
+    processing_status: Optional[str]
+    created_at: datetime
+    updated_at: datetime
+
+
+class AuthorOut(BaseModel):
+    id: UUID
+    firstname: str
+    lastname: str
+
+
+class ArchiveDetail(ArchiveOut):
+    author: Optional[AuthorOut]
+
+
+class ArchivePage(BaseModel):
+    items: List[ArchiveOut]
+    next_cursor: Optional[str]
+    total: Optional[int]
+
+
+class ArchiveSearchHit(BaseModel):
+    id: UUID
+    title: str
+    created_at: datetime
+    rank: float
+    title_highlight: str
+    description_highlight: str
+
+
+class ArchiveSearchResults(BaseModel):
+    items: List[ArchiveSearchHit]
+
+
+class WorkspaceOut(BaseModel):
+    id: UUID
     name: str
-    size: str
-    currentChunkIndex: str
-    totalChunks: str
+    slug: Optional[str]
+    description: Optional[str]
+    author_id: Optional[UUID]
+    created_at: datetime
+    updated_at: datetime
+
+
+class WorkspacePage(BaseModel):
+    items: List[WorkspaceOut]
+    next_cursor: Optional[str]
+
+
+class UserProfile(BaseModel):
+    id: UUID
+    firstname: str
+    lastname: str
+    middlename: Optional[str]
+    avatar: Optional[str]
+    created_at: datetime
+    updated_at: datetime
@@ -0,0 +1,354 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from tempfile import SpooledTemporaryFile
+from time import time
+from typing import AsyncIterator, Iterable, Optional
+from urllib.parse import quote
+from fastapi import Request
+from fastapi.responses import RedirectResponse, Response
+from starlette.concurrency import run_in_threadpool
+
+from api import jobs, streaming
+from api.config import settings
+from api.core import uploads
+from api.models import UploadSession
+
+
+# Where blobs and in-progress uploads live. Uploads are addressed by session,
+# blobs by SHA-256; the upload session rows and the blobs table stay the source of truth.
+class LocalStorage:
+    '''
+    Files under UPLOAD_DIRECTORY, for development and single host deployments.
+    '''
+    # Any chunk size works on disk
+    min_part_size = 0
+    max_parts = None
+
+    async def create_upload(self, upload_session: UploadSession) -> Optional[str]:
+        # Reserve the whole file up front, chunks are then written in place
+        await run_in_threadpool(uploads.preallocate, uploads.temp_path(upload_session.id), upload_session.size)
+        return None
+
+    async def write_chunk(self, upload_session: UploadSession, index: int, stream: AsyncIterator[bytes],
+                          content_hash: Optional[uploads.ContentHash]) -> int:
+        offset, length = uploads.chunk_bounds(upload_session, index)
+        return await uploads.write_chunk(uploads.temp_path(upload_session.id), offset, length, stream, content_hash)
+
+    async def advance_hash(self, upload_session: UploadSession, bitmap: bytes):
+        await uploads.advance_hash(upload_session, bitmap)
+
+    async def complete_upload(self, upload_session: UploadSession) -> str:
+        return await run_in_threadpool(uploads.finish_hash, upload_session)
+
+    async def store_blob(self, upload_session: UploadSession, digest: str, replace: bool = False) -> bool:
+        return await run_in_threadpool(uploads.store_blob, upload_session.id, digest, replace)
+
+    async def abort_upload(self, upload_session: UploadSession):
+        await run_in_threadpool(uploads.discard, upload_session.id)
+
+    async def remove_orphan_uploads(self) -> int:
+        return await run_in_threadpool(remove_orphan_temp_files)
+
+    async def hash_blob(self, digest: str, size: int) -> str:
+        return await jobs.run_cpu(uploads.hash_file, uploads.blob_path(digest), size)
+
+    async def delete_blobs(self, digests: Iterable[str]):
+        def unlink():
+            for digest in digests:
+                try:
+                    os.unlink(uploads.blob_path(digest))
+                except FileNotFoundError:
+                    pass
+
+        await run_in_threadpool(unlink)
+
+    async def blob_response(self, request: Request, digest: str, size: int, content_type: str,
+                            created_at: datetime, filename: Optional[str]) -> Response:
+        # Blobs are content addressed, the hash is a strong validator
+        return streaming.file_response(request, uploads.blob_path(digest), size=size, etag=f'"{digest}"',
+                                       last_modified=created_at, filename=filename, media_type=content_type)
+
+
+def remove_orphan_temp_files() -> int:
+    '''
+    tmp_* files older than the upload TTL, left behind by crashes or deleted sessions.
+    '''
+    if not os.path.isdir(uploads.upload_directory):
+        return 0
+
+    cutoff = time() - settings.UPLOAD_SESSION_TTL
+    removed = 0
+    with os.scandir(uploads.upload_directory) as entries:
+        for entry in entries:
+            if entry.name.startswith("tmp_") and entry.is_file() and entry.stat().st_mtime < cutoff:
+                try:
+                    os.unlink(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
+
+
+s3_client = None
+
+
+def get_s3_client():
+    global s3_client
+
+    if s3_client is None:
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND is s3 but the boto3 package is not installed")
+
+        if not settings.S3_BUCKET:
+            raise RuntimeError("STORAGE_BACKEND is s3 but S3_BUCKET is not set")
+
+        # Thread safe, every part upload and presign shares its connection pool
+        s3_client = boto3.client(
+            "s3",
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            region_name=settings.S3_REGION,
+            aws_access_key_id=settings.S3_ACCESS_KEY,
+            aws_secret_access_key=settings.S3_SECRET_KEY,
+            config=Config(
+                signature_version="s3v4",
+                max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+                s3={"addressing_style": settings.S3_ADDRESSING_STYLE},
+                retries={"mode": "standard"},
+            ),
+        )
+
+    return s3_client
+
+
+# Parts buffered in memory up to this size, larger ones spill to a temporary file
+PART_MEMORY_SIZE = 8 * 1024 * 1024
+
+
+def is_missing(error: Exception) -> bool:
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NoSuchUpload")
+
+
+class S3Storage:
+    '''
+    Any S3-compatible service (Linode Object Storage, MinIO, AWS).
+    An upload session is a multipart upload and every chunk one of its parts,
+    so parallel chunk requests upload parts concurrently and no local disk is shared.
+    Downloads are redirects to presigned URLs, the bytes never go through the API.
+    '''
+    # S3 rejects smaller parts except the last one, and more than 10000 of them
+    min_part_size = 5 * 1024 * 1024
+    max_parts = 10000
+
+    @property
+    def client(self):
+        return get_s3_client()
+
+    @property
+    def bucket(self) -> str:
+        return settings.S3_BUCKET
+
+    def upload_key(self, upload_id) -> str:
+        return f"{settings.S3_PREFIX}uploads/{upload_id}"
+
+    def blob_key(self, digest: str) -> str:
+        return f"{settings.S3_PREFIX}blobs/{digest[:2]}/{digest}"
+
+    async def create_upload(self, upload_session: UploadSession) -> Optional[str]:
+        multipart = await run_in_threadpool(self.client.create_multipart_upload,
+                                            Bucket=self.bucket, Key=self.upload_key(upload_session.id))
+        return multipart["UploadId"]
+
+    def __init__(self) -> None:
+        # Created lazily, at most S3_MAX_CONCURRENT_PARTS part uploads leave the process at once
+        self.part_slots: Optional[asyncio.Semaphore] = None
+
+    async def write_chunk(self, upload_session: UploadSession, index: int, stream: AsyncIterator[bytes],
+                          content_hash: Optional[uploads.ContentHash]) -> int:
+        _, length = uploads.chunk_bounds(upload_session, index)
+        # A part needs its length up front, so it is buffered first: in memory up to
+        # PART_MEMORY_SIZE, beyond that in a temporary file
+        part = SpooledTemporaryFile(max_size=PART_MEMORY_SIZE)
+        buffer = bytearray()
+        received = written = 0
+
+        try:
+            async for piece in stream:
+                received += len(piece)
+                if received > length:
+                    raise ValueError("Chunk is larger than expected")
+                if content_hash:
+                    content_hash.sha256.update(piece)
+
+                buffer += piece
+                if len(buffer) >= uploads.WRITE_BUFFER_SIZE:
+                    await run_in_threadpool(part.write, buffer)
+                    buffer.clear()
+
+            if buffer:
+                await run_in_threadpool(part.write, buffer)
+
+            if received == length:
+                part.seek(0)
+                await self.upload_part(upload_session, index, part, length)
+                written = length
+        finally:
+            part.close()
+            uploads.release_hash(content_hash, written, length)
+
+        return written
+
+    async def upload_part(self, upload_session: UploadSession, index: int, part, length: int):
+        if self.part_slots is None:
+            self.part_slots = asyncio.Semaphore(settings.S3_MAX_CONCURRENT_PARTS)
+
+        async with self.part_slots:
+            try:
+                await run_in_threadpool(
+                    self.client.upload_part, Bucket=self.bucket, Key=self.upload_key(upload_session.id),
+                    UploadId=upload_session.multipart_upload_id, PartNumber=index + 1,
+                    Body=part, ContentLength=length)
+            except Exception as e:
+                if is_missing(e):
+                    raise FileNotFoundError(upload_session.id)
+                raise
+
+    async def advance_hash(self, upload_session: UploadSession, bitmap: bytes):
+        # Parts cannot be read back before completion, out of order chunks are hashed then
+        pass
+
+    def complete_multipart(self, upload_session: UploadSession):
+        key = self.upload_key(upload_session.id)
+        parts = []
+        for page in self.client.get_paginator("list_parts").paginate(
+                Bucket=self.bucket, Key=key, UploadId=upload_session.multipart_upload_id):
+            parts += [{"PartNumber": part["PartNumber"], "ETag": part["ETag"]} for part in page.get("Parts", [])]
+
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key,
+                                              UploadId=upload_session.multipart_upload_id,
+                                              MultipartUpload={"Parts": parts})
+
+    def finish_hash(self, upload_session: UploadSession) -> str:
+        content_hash = uploads.take_hash(upload_session)
+
+        # Only what was not hashed on the way in, i.e. chunks that came out of order
+        if content_hash.offset < upload_session.size:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.upload_key(upload_session.id),
+                                          Range=f"bytes={content_hash.offset}-{upload_session.size - 1}")["Body"]
+            for data in body.iter_chunks(uploads.READ_BUFFER_SIZE):
+                content_hash.sha256.update(data)
+
+        return content_hash.sha256.hexdigest()
+
+    async def complete_upload(self, upload_session: UploadSession) -> str:
+        await run_in_threadpool(self.complete_multipart, upload_session)
+        return await run_in_threadpool(self.finish_hash, upload_session)
+
+    def move_to_blob(self, upload_id, digest: str, replace: bool) -> bool:
+        from botocore.exceptions import ClientError
+
+        upload_key = self.upload_key(upload_id)
+        stored = False
+        if not replace:
+            try:
+                self.client.head_object(Bucket=self.bucket, Key=self.blob_key(digest))
+            except ClientError as e:
+                if not is_missing(e):
+                    raise
+                replace = True
+
+        if replace:
+            # Server side, multipart for large objects
+            self.client.copy({"Bucket": self.bucket, "Key": upload_key}, self.bucket, self.blob_key(digest))
+            stored = True
+
+        self.client.delete_object(Bucket=self.bucket, Key=upload_key)
+        return stored
+
+    async def store_blob(self, upload_session: UploadSession, digest: str, replace: bool = False) -> bool:
+        return await run_in_threadpool(self.move_to_blob, upload_session.id, digest, replace)
+
+    def discard(self, upload_id, multipart_upload_id: Optional[str]):
+        from botocore.exceptions import ClientError
+
+        uploads.content_hashes.pop(upload_id, None)
+        key = self.upload_key(upload_id)
+        # Either still a multipart upload or, once completed, an object
+        if multipart_upload_id:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=multipart_upload_id)
+            except ClientError as e:
+                if not is_missing(e):
+                    raise
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    async def abort_upload(self, upload_session: UploadSession):
+        await run_in_threadpool(self.discard, upload_session.id, upload_session.multipart_upload_id)
+
+    def remove_orphans(self) -> int:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+        prefix = self.upload_key("")
+        removed = 0
+
+        for page in self.client.get_paginator("list_multipart_uploads").paginate(Bucket=self.bucket, Prefix=prefix):
+            for upload in page.get("Uploads", []):
+                if upload["Initiated"] < cutoff:
+                    self.client.abort_multipart_upload(Bucket=self.bucket, Key=upload["Key"],
+                                                       UploadId=upload["UploadId"])
+                    removed += 1
+
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            stale = [{"Key": item["Key"]} for item in page.get("Contents", []) if item["LastModified"] < cutoff]
+            if stale:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": stale, "Quiet": True})
+                removed += len(stale)
+
+        return removed
+
+    async def remove_orphan_uploads(self) -> int:
+        return await run_in_threadpool(self.remove_orphans)
+
+    def read_hash(self, digest: str) -> str:
+        content_hash = uploads.ContentHash()
+        body = self.client.get_object(Bucket=self.bucket, Key=self.blob_key(digest))["Body"]
+        for data in body.iter_chunks(uploads.READ_BUFFER_SIZE):
+            content_hash.sha256.update(data)
+        return content_hash.sha256.hexdigest()
+
+    async def hash_blob(self, digest: str, size: int) -> str:
+        # Network bound, hashlib releases the GIL on large buffers
+        return await run_in_threadpool(self.read_hash, digest)
+
+    def delete_keys(self, digests: Iterable[str]):
+        keys = [{"Key": self.blob_key(digest)} for digest in digests]
+        # At most 1000 keys per request
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": keys[start:start + 1000], "Quiet": True})
+
+    async def delete_blobs(self, digests: Iterable[str]):
+        await run_in_threadpool(self.delete_keys, list(digests))
+
+    async def blob_response(self, request: Request, digest: str, size: int, content_type: str,
+                            created_at: datetime, filename: Optional[str]) -> Response:
+        params = {"Bucket": self.bucket, "Key": self.blob_key(digest), "ResponseContentType": content_type}
+        if filename:
+            params["ResponseContentDisposition"] = f"inline; filename*=UTF-8''{quote(filename)}"
+
+        # Signing is local, no request to the storage service
+        url = self.client.generate_presigned_url("get_object", Params=params,
+                                                 ExpiresIn=settings.S3_PRESIGN_EXPIRES)
+        # Ranges and conditional requests are then handled by the storage service
+        return RedirectResponse(url, status_code=307, headers={"cache-control": "private, no-store"})
+
+
+def create_storage():
+    if settings.STORAGE_BACKEND == "s3":
+        return S3Storage()
+    return LocalStorage()
+
+
+storage = create_storage()
@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import logging
+import math
+from time import monotonic
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Optional, Set, Tuple
+from uuid import UUID, uuid4
+from jwt import decode, encode, get_unverified_header
+from jwt.exceptions import ExpiredSignatureError, InvalidTokenError
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.config import settings
+from api.core import refresh_tokens
+from api.database import AsyncSessionLocal
+from api.models import RevokedToken
+
+logger = logging.getLogger(__name__)
+
+
+def load_keys() -> Dict[str, str]:
+    if not settings.JWT_KEYS:
+        return {settings.JWT_KEY_ID: settings.JWT_SECRET}
+
+    keys = {}
+    for entry in settings.JWT_KEYS.split(","):
+        kid, _, secret = entry.strip().partition(":")
+        keys[kid] = secret
+    return keys
+
+
+# Read once, the first key signs new tokens
+keys = load_keys()
+signing_kid = next(iter(keys))
+token_lifetime = timedelta(days=settings.JWT_EXPIRATION_TIME)
+
+
+class TokenError(Exception):
+    def __init__(self, detail: str) -> None:
+        super().__init__(detail)
+        self.detail = detail
+
+
+def issue(claims: dict) -> str:
+    now = datetime.now(timezone.utc)
+    return encode(
+        payload={**claims, "iat": now, "exp": now + token_lifetime, "jti": uuid4().hex},
+        key=keys[signing_kid],
+        algorithm=settings.JWT_ALGORITHM,
+        headers={"kid": signing_kid},
+    )
+
+
+def verify(token: str) -> dict:
+    '''
+    Claims of a valid, unrevoked token, TokenError otherwise.
+    Tokens issued before key ids existed are checked against JWT_SECRET.
+    '''
+    try:
+        kid = get_unverified_header(token).get("kid")
+        key = keys.get(kid) if kid else settings.JWT_SECRET
+        if key is None:
+            raise TokenError("Invalid Token")
+
+        claims = decode(token, key=key, algorithms=[settings.JWT_ALGORITHM])
+    except ExpiredSignatureError:
+        raise TokenError("Token Expired")
+    except InvalidTokenError:
+        raise TokenError("Invalid Token")
+
+    if revocations.is_revoked(claims):
+        raise TokenError("Token Revoked")
+
+    return claims
+
+
+class BloomFilter:
+    '''
+    Fixed size set membership with false positives only,
+    sized for capacity entries at the given error rate.
+    '''
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key: str) -> Iterable[int]:
+        # Double hashing, one digest gives every position
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+# Revocations made by this worker are kept this long when a refresh does not return them
+# yet, their transaction may still be committing. Longer than any request transaction
+PENDING_GRACE = 60
+
+
+class RevocationList:
+    '''
+    Revoked token ids and per-user cutoffs, mirrored from revoked_tokens.
+    Checks are in memory; other workers see a revocation after their next refresh.
+    '''
+    def __init__(self) -> None:
+        self.bloom = BloomFilter(0)
+        self.jtis: Set[str] = set()
+        # User id -> tokens issued before this second are revoked. Whole seconds, like iat:
+        # a token issued right after a revocation has the same iat and must stay valid
+        self.users: Dict[str, int] = {}
+        # Added here since, with the monotonic time they were added at
+        self.local_jtis: Dict[str, float] = {}
+        self.local_users: Dict[str, Tuple[float, int]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def is_revoked(self, claims: dict) -> bool:
+        jti = claims.get("jti")
+        # Almost every token misses the filter and never reaches the set
+        if jti and self.jtis and jti in self.bloom and jti in self.jtis:
+            return True
+
+        return self.is_user_revoked(claims.get("uid"), claims.get("iat", 0))
+
+    def is_user_revoked(self, user_id, issued_at: float) -> bool:
+        cutoff = self.users.get(str(user_id))
+        return cutoff is not None and issued_at < cutoff
+
+    def add_jti(self, jti: str):
+        self.jtis.add(jti)
+        self.bloom.add(jti)
+        self.local_jtis[jti] = monotonic()
+
+    def add_user(self, user_id, cutoff: int):
+        user_id = str(user_id)
+        self.users[user_id] = max(cutoff, self.users.get(user_id, cutoff))
+        self.local_users[user_id] = (monotonic(), self.users[user_id])
+
+    async def refresh(self):
+        started_at = monotonic()
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(RevokedToken.jti, RevokedToken.user_id, RevokedToken.revoked_at)
+                .where(RevokedToken.expires_at > func.now())
+            )).all()
+
+        jtis = {row.jti for row in rows if row.jti}
+        users: Dict[str, int] = {}
+        for row in rows:
+            if row.user_id and not row.jti:
+                user_id = str(row.user_id)
+                users[user_id] = max(int(row.revoked_at.timestamp()), users.get(user_id, 0))
+
+        # Local revocations missing from the snapshot are kept until it has them,
+        # or dropped once old enough that their transaction must have rolled back
+        expired = started_at - PENDING_GRACE
+        self.local_jtis = {jti: added_at for jti, added_at in self.local_jtis.items()
+                           if jti not in jtis and added_at > expired}
+        self.local_users = {user_id: (added_at, cutoff) for user_id, (added_at, cutoff) in self.local_users.items()
+                            if users.get(user_id, 0) < cutoff and added_at > expired}
+
+        jtis.update(self.local_jtis)
+        for user_id, (_, cutoff) in self.local_users.items():
+            users[user_id] = max(cutoff, users.get(user_id, 0))
+
+        bloom = BloomFilter(len(jtis) * 2)
+        for jti in jtis:
+            bloom.add(jti)
+
+        # Swapped in one go, checks never see a half built list
+        self.bloom, self.jtis, self.users = bloom, jtis, users
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Could not refresh the revocation list")
+            await asyncio.sleep(settings.REVOCATION_REFRESH_INTERVAL)
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+revocations = RevocationList()
+
+
+async def revoke_token(db: AsyncSession, claims: dict):
+    '''
+    Revoke a single token, e.g. on logout. Part of the caller's transaction;
+    the local list is updated right away and corrected by the next refresh on rollback.
+    '''
+    await db.execute(insert(RevokedToken).values(
+        id=uuid4(),
+        jti=claims["jti"],
+        user_id=claims.get("uid"),
+        revoked_at=func.now(),
+        expires_at=datetime.fromtimestamp(claims["exp"], timezone.utc),
+        created_at=datetime.now(),
+    ))
+    revocations.add_jti(claims["jti"])
+
+
+async def revoke_user(db: AsyncSession, user_id: UUID):
+    '''
+    Revoke every access and refresh token of a user issued until now.
+    '''
+    now = datetime.now(timezone.utc)
+    await db.execute(insert(RevokedToken).values(
+        id=uuid4(),
+        user_id=user_id,
+        revoked_at=now,
+        expires_at=now + token_lifetime,
+        created_at=now,
+    ))
+    await refresh_tokens.revoke_user(db, user_id)
+    # An access token issued earlier in the same second stays valid, its refresh token does not
+    revocations.add_user(user_id, int(now.timestamp()))
@@ -0,0 +1,230 @@
+import hashlib
+import os
+from os import path, getcwd
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from uuid import UUID
+from starlette.concurrency import run_in_threadpool
+
+from api import metrics
+from api.config import settings
+from api.models import UploadSession
+
+
+upload_directory = path.join(getcwd(), settings.UPLOAD_DIRECTORY)
+
+upload_bytes = metrics.Counter("upload_bytes_total", "Bytes of upload chunks written to disk")
+upload_chunks = metrics.Counter("upload_chunks_total", "Upload chunks written to disk")
+
+# Network reads are small, coalesce them before hitting the disk
+WRITE_BUFFER_SIZE = 1024 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+class ContentHash:
+    '''
+    SHA-256 of an upload's contiguous prefix, fed while chunks arrive.
+    Chunks streamed in order are hashed straight from the request body,
+    out of order ones are read back from disk once the gap before them fills.
+    '''
+    def __init__(self) -> None:
+        self.sha256 = hashlib.sha256()
+        self.offset = 0
+        self.busy = False
+        self.valid = True
+
+
+# Per worker, a missing or broken entry is rebuilt from disk on completion
+content_hashes: Dict[UUID, ContentHash] = {}
+
+
+def count_chunks(size: int, chunk_size: int) -> int:
+    return max(1, -(-size // chunk_size))
+
+
+def empty_bitmap(total_chunks: int) -> bytes:
+    return bytes((total_chunks + 7) // 8)
+
+
+def has_chunk(bitmap: bytes, index: int) -> bool:
+    # Same bit order as Postgres set_bit(): bit 0 is the low bit of byte 0
+    return bool(bitmap[index >> 3] & (1 << (index & 7)))
+
+
+def missing_chunks(bitmap: bytes, total_chunks: int) -> List[int]:
+    return [i for i in range(total_chunks) if not has_chunk(bitmap, i)]
+
+
+def chunk_bounds(session: UploadSession, index: int) -> Tuple[int, int]:
+    offset = index * session.chunk_size
+    return offset, min(session.chunk_size, session.size - offset)
+
+
+def temp_path(upload_id) -> str:
+    return path.join(upload_directory, f"tmp_{upload_id}")
+
+
+def preallocate(file_path: str, size: int):
+    fd = os.open(file_path, os.O_CREAT | os.O_WRONLY, 0o644)
+    try:
+        if size and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def claim_hash(upload_id: UUID, offset: int) -> Optional[ContentHash]:
+    content_hash = content_hashes.get(upload_id)
+    if content_hash is None or not content_hash.valid:
+        content_hash = content_hashes[upload_id] = ContentHash()
+
+    if content_hash.busy or content_hash.offset != offset:
+        return None
+
+    content_hash.busy = True
+    return content_hash
+
+
+async def write_chunk(file_path: str, offset: int, length: int, stream: AsyncIterator[bytes],
+                      content_hash: Optional[ContentHash] = None) -> int:
+    '''
+    Write a streamed chunk at its offset with positional writes, so chunks
+    can land in any order and from parallel requests.
+    A claimed content hash is fed with the same bytes on the way.
+    Returns the number of bytes written.
+    '''
+    fd = os.open(file_path, os.O_WRONLY)
+    written = 0
+    buffer = bytearray()
+
+    try:
+        async for piece in stream:
+            if written + len(buffer) + len(piece) > length:
+                raise ValueError("Chunk is larger than expected")
+
+            if content_hash:
+                content_hash.sha256.update(piece)
+
+            buffer += piece
+            if len(buffer) >= WRITE_BUFFER_SIZE:
+                written += await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+                buffer.clear()
+
+        if buffer:
+            written += await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+    finally:
+        os.close(fd)
+        release_hash(content_hash, written, length)
+
+    return written
+
+
+def release_hash(content_hash: Optional[ContentHash], written: int, length: int):
+    '''
+    Account for a chunk once it is stored, a partial one breaks the running hash.
+    '''
+    upload_bytes.inc(written)
+    if written == length:
+        upload_chunks.inc()
+
+    if content_hash:
+        if written == length:
+            content_hash.offset += written
+        else:
+            content_hash.valid = False
+        content_hash.busy = False
+
+
+def hash_from_disk(content_hash: ContentHash, file_path: str, end: int):
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        while content_hash.offset < end:
+            data = os.pread(fd, min(READ_BUFFER_SIZE, end - content_hash.offset), content_hash.offset)
+            if not data:
+                raise ValueError("Upload file is shorter than expected")
+            content_hash.sha256.update(data)
+            content_hash.offset += len(data)
+    finally:
+        os.close(fd)
+
+
+async def advance_hash(upload_session: UploadSession, bitmap: bytes):
+    '''
+    Hash chunks that are already on disk right after the hashed prefix.
+    '''
+    content_hash = content_hashes.get(upload_session.id)
+    if content_hash is None or content_hash.busy or not content_hash.valid:
+        return
+
+    index = content_hash.offset // upload_session.chunk_size
+    end_index = index
+    while end_index < upload_session.total_chunks and has_chunk(bitmap, end_index):
+        end_index += 1
+
+    if end_index == index:
+        return
+
+    end = min(end_index * upload_session.chunk_size, upload_session.size)
+    content_hash.busy = True
+    try:
+        await run_in_threadpool(hash_from_disk, content_hash, temp_path(upload_session.id), end)
+    except (OSError, ValueError):
+        content_hash.valid = False
+    finally:
+        content_hash.busy = False
+
+
+def hash_file(file_path: str, size: int) -> str:
+    # Module level so a process pool can run it
+    content_hash = ContentHash()
+    hash_from_disk(content_hash, file_path, size)
+    return content_hash.sha256.hexdigest()
+
+
+def take_hash(upload_session: UploadSession) -> ContentHash:
+    '''
+    The running hash of a completing upload, or a fresh one when it cannot be trusted.
+    After a rewritten chunk the stored bytes may differ from the ones hashed on the way in.
+    '''
+    content_hash = content_hashes.pop(upload_session.id, None)
+    if content_hash is None or content_hash.busy or not content_hash.valid or upload_session.rewritten:
+        return ContentHash()
+    return content_hash
+
+
+def finish_hash(upload_session: UploadSession) -> str:
+    '''
+    Digest of the complete upload, only reads what was not hashed yet.
+    '''
+    content_hash = take_hash(upload_session)
+    hash_from_disk(content_hash, temp_path(upload_session.id), upload_session.size)
+    return content_hash.sha256.hexdigest()
+
+
+def blob_path(digest: str) -> str:
+    return path.join(upload_directory, digest[:2], digest)
+
+
+def store_blob(upload_id, digest: str, replace: bool = False) -> bool:
+    '''
+    Move a finished upload to its content address.
+    Returns False when the same bytes were already stored, the upload is then dropped.
+    replace overwrites a stored file that was never verified against its address.
+    '''
+    final_path = blob_path(digest)
+    if not replace and path.exists(final_path):
+        discard(upload_id)
+        return False
+
+    os.makedirs(path.dirname(final_path), exist_ok=True)
+    os.replace(temp_path(upload_id), final_path)
+    return True
+
+
+def discard(upload_id):
+    content_hashes.pop(upload_id, None)
+    try:
+        os.unlink(temp_path(upload_id))
+    except FileNotFoundError:
+        pass
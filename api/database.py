@@ -1,15 +1,42 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from time import perf_counter
+from typing import Optional
 from fastapi import Depends
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker, with_loader_criteria, Session
 
 from api.config import settings
 
 
 SQLALCHEMY_DATABASE_URL = f'{settings.DB_CONNECTION}://{settings.DB_USER}:{settings.DB_PASSWORD}@{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}'
+SQLALCHEMY_ASYNC_DATABASE_URL = f'{settings.DB_CONNECTION.split("+")[0]}+{settings.DB_ASYNC_DRIVER}://{settings.DB_USER}:{settings.DB_PASSWORD}@{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}'
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+pool_options = {
+    "pool_size": settings.DB_POOL_SIZE,
+    "max_overflow": settings.DB_MAX_OVERFLOW,
+    "pool_timeout": settings.DB_POOL_TIMEOUT,
+    "pool_recycle": settings.DB_POOL_RECYCLE,
+    "pool_pre_ping": settings.DB_POOL_PRE_PING,
+}
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"options": f"-c statement_timeout={settings.DB_STATEMENT_TIMEOUT}"},
+    **pool_options
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async_engine = create_async_engine(
+    SQLALCHEMY_ASYNC_DATABASE_URL,
+    connect_args={"server_settings": {"statement_timeout": str(settings.DB_STATEMENT_TIMEOUT)}},
+    **pool_options
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 def session():
@@ -21,4 +48,107 @@ def session():
             db.close()
 
     db: Session = Depends(get_db)
-    return db
\ No newline at end of file
+    return db
+
+
+# Module level so FastAPI shares one session between a route and its dependencies
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def async_session():
+    db: AsyncSession = Depends(get_async_db)
+    return db
+
+
+class QueryStats:
+    '''
+    Queries run while these stats are current. Nested stats (a request inside a
+    test's count_queries() block) also count towards the ones they were opened in.
+    '''
+    def __init__(self, parent: Optional["QueryStats"] = None) -> None:
+        self.count = 0
+        self.duration = 0.0
+        self.parent = parent
+
+    def add(self, duration: float):
+        stats = self
+        while stats is not None:
+            stats.count += 1
+            stats.duration += duration
+            stats = stats.parent
+
+
+# Stats of the request (or test block) currently running, see count_queries()
+current_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("current_query_stats", default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started_at", []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started_at = conn.info["query_started_at"].pop()
+    stats = current_query_stats.get()
+
+    if stats is not None:
+        stats.add(perf_counter() - started_at)
+
+
+for instrumented_engine in (engine, async_engine.sync_engine):
+    event.listen(instrumented_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(instrumented_engine, "after_cursor_execute", after_cursor_execute)
+
+
+@lru_cache(maxsize=None)
+def live_criteria() -> tuple:
+    '''
+    deleted_at IS NULL for every model that has the column, built once the models are mapped.
+    '''
+    return tuple(
+        with_loader_criteria(mapper.class_, lambda cls: cls.deleted_at.is_(None), include_aliases=True)
+        for mapper in Base.registry.mappers
+        if "deleted_at" in mapper.columns
+    )
+
+
+def live(stmt):
+    # For statements compiled outside a session, e.g. the EXPLAIN of count estimates
+    return stmt.options(*live_criteria())
+
+
+@event.listens_for(Session, "do_orm_execute")
+def exclude_deleted(execute_state):
+    '''
+    Soft-deleted rows are invisible to every SELECT, in joins and subqueries too.
+    Opt out with .execution_options(include_deleted=True).
+    '''
+    if (execute_state.is_select
+            and not execute_state.is_column_load
+            and not execute_state.is_relationship_load
+            and not execute_state.execution_options.get("include_deleted", False)):
+        execute_state.statement = live(execute_state.statement)
+
+
+@contextmanager
+def count_queries():
+    stats = QueryStats(current_query_stats.get())
+    token = current_query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        current_query_stats.reset(token)
+
+
+@contextmanager
+def expect_queries(expected: int):
+    '''
+    Fail when the block runs a different number of queries, e.g.
+    with expect_queries(1): await client.get("/api/v1/archives/?limit=100")
+    '''
+    with count_queries() as stats:
+        yield stats
+
+    if stats.count != expected:
+        raise AssertionError(f"Expected {expected} queries, got {stats.count}")
@@ -1,8 +1,8 @@
-from http.client import HTTPException
+from fastapi import HTTPException, status
 
 
-def UserNotFoundException():
-    HTTPException(
-        status_code=404,
+def UserNotFoundException() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
         detail='User not found'
     )
@@ -1,12 +1,78 @@
-from api.models import User
+from typing import Any, Iterable, List, Optional
+from uuid import UUID
+import orjson
+from fastapi import responses
+from api.models import Archive, User, Workspace
 
-def format_user(user: User):
+
+# Column projections, so listings never build ORM objects or touch relationships
+archive_columns = (
+    Archive.id,
+    Archive.title,
+    Archive.description,
+    Archive.author_id,
+    Archive.processing_status,
+    Archive.created_at,
+    Archive.updated_at,
+)
+
+workspace_columns = (
+    Workspace.id,
+    Workspace.name,
+    Workspace.slug,
+    Workspace.description,
+    Workspace.author_id,
+    Workspace.created_at,
+    Workspace.updated_at,
+)
+
+user_profile_columns = (
+    User.id,
+    User.firstname,
+    User.lastname,
+    User.middlename,
+    User.photo_url.label("avatar"),
+    User.created_at,
+    User.updated_at,
+)
+
+
+def format_author(user: Optional[User]) -> Optional[dict]:
+    if user is None:
+        return None
+    return {"id": user.id, "firstname": user.firstname, "lastname": user.lastname}
+
+
+def format_archive(archive: Archive) -> dict:
     return {
-        "id": user.id,
-        "firstname": user.firstname,
-        "lastname": user.lastname,
-        "middlename": user.middlename,
-        "avatar": user.avatar,
-        "created_at": user.created_at,
-        "updated_at": user.updated_at,
-    }
\ No newline at end of file
+        "id": archive.id,
+        "title": archive.title,
+        "description": archive.description,
+        "author_id": archive.author_id,
+        "author": format_author(archive.author),
+        "processing_status": archive.processing_status,
+        "created_at": archive.created_at,
+        "updated_at": archive.updated_at,
+    }
+
+
+def as_dicts(rows: Iterable) -> List[dict]:
+    # orjson only serializes real dicts, not rows
+    return [dict(row._mapping) for row in rows]
+
+
+def json_default(value: Any) -> str:
+    # asyncpg returns its own uuid.UUID subclass, orjson only serializes the exact type
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content: Any) -> str:
+    return orjson.dumps(content, default=json_default).decode("utf-8")
+
+
+class ORJSONResponse(responses.ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=json_default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
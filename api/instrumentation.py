@@ -0,0 +1,82 @@
+from time import perf_counter
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from api import metrics
+from api.config import settings
+from api.database import QueryStats, async_engine, current_query_stats
+
+
+requests_total = metrics.Counter(
+    "http_requests_total", "Finished HTTP requests", ("method", "route", "status"))
+requests_in_progress = metrics.Gauge(
+    "http_requests_in_progress", "HTTP requests being handled")
+request_duration = metrics.Histogram(
+    "http_request_duration_seconds", "Time until the response is fully sent", ("method", "route"))
+request_queries = metrics.Histogram(
+    "http_request_db_queries", "SQL statements run per request", ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+request_db_duration = metrics.Histogram(
+    "http_request_db_duration_seconds", "Time spent in SQL statements per request", ("route",))
+
+# Read from the pool on every scrape
+pool = async_engine.sync_engine.pool
+metrics.Gauge("db_pool_size", "Connections kept in the pool", function=lambda: pool.size())
+metrics.Gauge("db_pool_checked_out", "Pooled connections in use", function=lambda: pool.checkedout())
+metrics.Gauge("db_pool_overflow", "Connections open beyond the pool size", function=lambda: pool.overflow())
+
+
+def server_timing(stats: QueryStats, timings: dict, total: float) -> str:
+    # Milliseconds, as browsers expect
+    parts = [f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries"']
+    parts += [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class InstrumentationMiddleware:
+    '''
+    Per-route latency, query count and query time for every HTTP request.
+    Routes are labelled by their path template, unmatched paths share one label.
+    With DEBUG on, responses carry a Server-Timing header.
+    '''
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started_at = perf_counter()
+        stats = QueryStats(current_query_stats.get())
+        timings = {}
+        stats_token = current_query_stats.set(stats)
+        timings_token = metrics.current_timings.set(timings)
+        status_code = 500
+
+        async def send_instrumented(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if settings.DEBUG:
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Server-Timing", server_timing(stats, timings, perf_counter() - started_at))
+            await send(message)
+
+        requests_in_progress.inc()
+        try:
+            await self.app(scope, receive, send_instrumented)
+        finally:
+            requests_in_progress.dec()
+            current_query_stats.reset(stats_token)
+            metrics.current_timings.reset(timings_token)
+
+            route = scope.get("route")
+            template = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+
+            requests_total.labels(method, template, status_code).inc()
+            request_duration.labels(method, template).observe(perf_counter() - started_at)
+            request_queries.labels(template).observe(stats.count)
+            request_db_duration.labels(template).observe(stats.duration)
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import random
+from concurrent.futures import Executor
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+from uuid import uuid4
+from sqlalchemy import and_, func, insert, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from api.config import settings
+from api.models import Job
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[AsyncSession, dict], Awaitable[None]]
+FailureHandler = Callable[[AsyncSession, dict, str], Awaitable[None]]
+
+handlers: Dict[str, Handler] = {}
+failure_handlers: Dict[str, FailureHandler] = {}
+
+class PermanentError(Exception):
+    '''
+    A failure retrying cannot fix, the job fails at once.
+    '''
+
+
+# Process pool of the worker, CPU heavy steps run there instead of the event loop
+cpu_executor: Optional[Executor] = None
+
+
+def handler(kind: str, on_failure: Optional[FailureHandler] = None):
+    '''
+    Register the coroutine running jobs of a kind.
+    Jobs can run more than once (retries, crashed workers), handlers must be idempotent.
+    on_failure runs once the job has used all its attempts.
+    '''
+    def register(func: Handler) -> Handler:
+        handlers[kind] = func
+        if on_failure is not None:
+            failure_handlers[kind] = on_failure
+        return func
+
+    return register
+
+
+async def run_cpu(func, *args):
+    if cpu_executor is None:
+        return await run_in_threadpool(func, *args)
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, func, *args)
+
+
+async def enqueue(db: AsyncSession, kind: str, payload: dict, max_attempts: Optional[int] = None):
+    '''
+    Add a job to the caller's transaction, it only becomes visible on commit.
+    '''
+    values = {"id": uuid4(), "kind": kind, "payload": payload, "created_at": datetime.now()}
+    if max_attempts is not None:
+        values["max_attempts"] = max_attempts
+
+    await db.execute(insert(Job).values(**values))
+
+
+async def claim(db: AsyncSession, limit: int) -> list:
+    '''
+    Lock up to limit due jobs and mark them running.
+    SKIP LOCKED lets any number of workers poll without waiting on each other.
+    '''
+    now = func.now()
+    due = (select(Job.id)
+           .where(or_(
+               and_(Job.status == 'queued', Job.run_at <= now),
+               # Worker died mid-job
+               and_(Job.status == 'running', Job.locked_at < now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT)),
+           ))
+           .order_by(Job.run_at)
+           .limit(limit)
+           .with_for_update(skip_locked=True))
+
+    jobs = (await db.execute(
+        update(Job)
+        .where(Job.id.in_(due))
+        .values(status='running', locked_at=now, attempts=Job.attempts + 1, updated_at=now)
+        .returning(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+        .execution_options(synchronize_session=False)
+    )).all()
+    await db.commit()
+
+    return jobs
+
+
+def retry_delay(attempts: int) -> float:
+    # Exponential backoff with jitter, so failed jobs do not retry in lockstep
+    delay = min(settings.JOB_RETRY_MAX_DELAY, settings.JOB_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+async def finish(db: AsyncSession, job):
+    await db.execute(update(Job)
+                     .where(Job.id == job.id)
+                     .values(status='done', locked_at=None, updated_at=func.now()))
+
+
+async def fail(db: AsyncSession, job, error: str, permanent: bool = False):
+    if permanent or job.attempts >= job.max_attempts:
+        await db.execute(update(Job)
+                         .where(Job.id == job.id)
+                         .values(status='failed', locked_at=None, last_error=error, updated_at=func.now()))
+
+        on_failure = failure_handlers.get(job.kind)
+        if on_failure is not None:
+            await on_failure(db, job.payload, error)
+        return
+
+    await db.execute(update(Job)
+                     .where(Job.id == job.id)
+                     .values(status='queued', locked_at=None, last_error=error, updated_at=func.now(),
+                             run_at=func.now() + timedelta(seconds=retry_delay(job.attempts))))
+
+
+async def run(db: AsyncSession, job) -> bool:
+    '''
+    Run a claimed job. Its work and its new status are committed together.
+    '''
+    try:
+        job_handler = handlers.get(job.kind)
+        if job_handler is None:
+            raise LookupError(f'No handler for job {job.kind}')
+
+        await job_handler(db, job.payload)
+        await finish(db, job)
+        await db.commit()
+        return True
+
+    except Exception as e:
+        logger.warning("Job %s (%s) failed on attempt %s: %s", job.id, job.kind, job.attempts, e)
+        await db.rollback()
+        await fail(db, job, f'{type(e).__name__}: {e}', permanent=isinstance(e, PermanentError))
+        await db.commit()
+        return False
+
+
+async def run_due(session_factory, limit: int) -> List[bool]:
+    '''
+    Claim and run one batch, each job in its own session. Returns the outcomes.
+    '''
+    async with session_factory() as db:
+        jobs = await claim(db, limit)
+
+    async def run_one(job):
+        async with session_factory() as db:
+            return await run(db, job)
+
+    return await asyncio.gather(*(run_one(job) for job in jobs))
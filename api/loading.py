@@ -0,0 +1,31 @@
+from sqlalchemy.orm import contains_eager, joinedload, raiseload, selectinload
+
+
+# Relationships are declared lazy="raise_on_sql", so every endpoint that
+# needs one says how to load it here instead of paying one query per row.
+strategies = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "raise": raiseload,
+}
+
+
+def eager(model, **relationships) -> list:
+    '''
+    eager(Archive, author="selectin") -> loader options for a select().
+    Relationships that are not named keep raising if touched.
+    '''
+    return [strategies[strategy](getattr(model, name)) for name, strategy in relationships.items()]
+
+
+def join_eager(stmt, relationship, *columns):
+    '''
+    Fill a many-to-one relationship from the statement's own join.
+    Outer join, so rows whose related row was deleted (SET NULL) are kept.
+    Pass columns to load only part of the related row.
+    '''
+    option = contains_eager(relationship)
+    if columns:
+        option = option.load_only(*columns)
+
+    return stmt.outerjoin(relationship).options(option)
@@ -1,6 +1,255 @@
-# send forgot password mail
-from time import sleep
+import html
+import logging
+import smtplib
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.utils import parseaddr
+from string import Template
+from typing import Dict, List, Optional
+from uuid import uuid4
+from sqlalchemy import and_, func, insert, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
+from api import jobs
+from api.config import settings
+from api.models import OutboxMail
 
-async def send_forgot_password_mail(email, message):
-    pass
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+
+class MailTemplate:
+    '''
+    Subject, text and HTML bodies compiled once at import.
+    Context values are escaped for the HTML body only.
+    '''
+    def __init__(self, subject: str, text: str, html_body: str) -> None:
+        self.subject = Template(subject)
+        self.text = Template(text)
+        self.html = Template(html_body)
+
+    def render(self, context: dict) -> EmailMessage:
+        escaped = {key: html.escape(str(value)) for key, value in context.items()}
+
+        message = EmailMessage()
+        message["Subject"] = self.subject.substitute(context)
+        message.set_content(self.text.substitute(context))
+        message.add_alternative(self.html.substitute(escaped), subtype="html")
+        return message
+
+
+templates: Dict[str, MailTemplate] = {
+    "forgot_password": MailTemplate(
+        subject="Reset your password",
+        text=(
+            "Hello, $name\n\n"
+            "Someone has requested a link to reset your password. "
+            "If you requested this, you can change your password through the following link:\n"
+            "$link\n\n"
+            "If you didn't request this, you can ignore this email.\n"
+            "Your password won't change until you access the link above and create a new one.\n"
+        ),
+        html_body="""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>Reset password</title>
+        </head>
+        <body>
+            <div style="width: 100%;font-family: monospace;">
+                <h1>Hello, $name</h1>
+                <p>Someone has requested a link to reset your password. If you requested this, you can change your password through the following link <br>
+                <a href="$link" style="box-sizing: border-box;text-decoration: underline;">Reset password</a>
+                </p>
+                <p>If you didn't request this, you can ignore this email.</p>
+                <p>Your password won't change until you access the link above and create a new one.</p>
+            </div>
+        </body>
+        </html>
+        """,
+    ),
+}
+
+
+async def queue_mail(db: AsyncSession, recipient: str, template: str, context: dict) -> bool:
+    '''
+    Add a mail to the caller's transaction, the worker sends it once committed.
+    Returns False when the recipient already got MAIL_RECIPIENT_LIMIT mails in the window.
+    '''
+    if template not in templates:
+        raise KeyError(f'Unknown mail template {template}')
+
+    recent = (await db.execute(
+        select(func.count())
+        .select_from(OutboxMail)
+        .where(OutboxMail.recipient == recipient,
+               OutboxMail.created_at >= func.now() - timedelta(seconds=settings.MAIL_RECIPIENT_WINDOW))
+    )).scalar_one()
+
+    if recent >= settings.MAIL_RECIPIENT_LIMIT:
+        return False
+
+    await db.execute(insert(OutboxMail).values(
+        id=uuid4(),
+        recipient=recipient,
+        template=template,
+        context=context,
+        max_attempts=settings.MAIL_MAX_ATTEMPTS,
+        created_at=datetime.now(),
+    ))
+    return True
+
+
+def build_message(mail) -> EmailMessage:
+    message = templates[mail.template].render(mail.context)
+    message["From"] = settings.MAIL_FROM
+    message["To"] = mail.recipient
+    # Same id on every attempt, so a mail sent twice after a crash can be recognised
+    domain = parseaddr(settings.MAIL_FROM)[1].partition("@")[2] or "localhost"
+    message["Message-ID"] = f"<{mail.id}@{domain}>"
+    return message
+
+
+class SMTPConnection:
+    '''
+    One SMTP session reused across batches, reopened when the server drops it.
+    Only used from one thread at a time by the worker.
+    '''
+    def __init__(self) -> None:
+        self.client: Optional[smtplib.SMTP] = None
+
+    def open(self) -> smtplib.SMTP:
+        if settings.SMTP_SSL:
+            client = smtplib.SMTP_SSL(settings.SMTP_HOST, settings.SMTP_PORT, timeout=settings.SMTP_TIMEOUT)
+        else:
+            client = smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT, timeout=settings.SMTP_TIMEOUT)
+            if settings.SMTP_STARTTLS:
+                client.starttls()
+
+        if settings.SMTP_USER:
+            client.login(settings.SMTP_USER, settings.SMTP_PASSWORD or "")
+        return client
+
+    def send(self, message: EmailMessage):
+        if self.client is None:
+            self.client = self.open()
+
+        try:
+            self.client.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # Idle session timed out on the server, retry once on a fresh one
+            self.client = self.open()
+            self.client.send_message(message)
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.quit()
+            except smtplib.SMTPException:
+                pass
+            self.client = None
+
+
+smtp = SMTPConnection()
+
+
+def send_batch(messages: List[EmailMessage]) -> List[Optional[str]]:
+    '''
+    Send over the shared connection, one error (or None) per message.
+    '''
+    errors = []
+    for message in messages:
+        if settings.MAIL_LOG_ONLY:
+            # Never the body, it carries reset links
+            logger.info("Mail to %s: %s", message["To"], message["Subject"])
+            errors.append(None)
+            continue
+
+        try:
+            smtp.send(message)
+            errors.append(None)
+        except (smtplib.SMTPException, OSError) as e:
+            if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                smtp.close()
+            errors.append(f'{type(e).__name__}: {e}')
+
+    return errors
+
+
+async def claim(db: AsyncSession, limit: int) -> list:
+    # Same locking as the job queue, several workers share the outbox
+    now = func.now()
+    due = (select(OutboxMail.id)
+           .where(or_(
+               and_(OutboxMail.status == 'queued', OutboxMail.send_after <= now),
+               and_(OutboxMail.status == 'sending',
+                    OutboxMail.locked_at < now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT)),
+           ))
+           .order_by(OutboxMail.send_after)
+           .limit(limit)
+           .with_for_update(skip_locked=True))
+
+    mails = (await db.execute(
+        update(OutboxMail)
+        .where(OutboxMail.id.in_(due))
+        .values(status='sending', locked_at=now, attempts=OutboxMail.attempts + 1, updated_at=now)
+        .returning(OutboxMail.id, OutboxMail.recipient, OutboxMail.template, OutboxMail.context,
+                   OutboxMail.attempts, OutboxMail.max_attempts)
+        .execution_options(synchronize_session=False)
+    )).all()
+    await db.commit()
+
+    return mails
+
+
+async def deliver_due(session_factory, limit: int) -> int:
+    '''
+    Send one batch of due mails. Returns how many were claimed.
+    Delivery is at least once: a worker dying between sending and committing resends.
+    '''
+    # Nowhere to send them, mails wait in the outbox
+    if settings.SMTP_HOST is None and not settings.MAIL_LOG_ONLY:
+        return 0
+
+    async with session_factory() as db:
+        mails = await claim(db, limit)
+        if not mails:
+            return 0
+
+        messages, errors = [], {}
+        for mail in mails:
+            try:
+                messages.append((mail, build_message(mail)))
+            except (KeyError, ValueError) as e:
+                errors[mail.id] = f'{type(e).__name__}: {e}'
+
+        for (mail, _), error in zip(messages, await run_in_threadpool(send_batch, [m for _, m in messages])):
+            if error is not None:
+                errors[mail.id] = error
+
+        sent = [mail.id for mail in mails if mail.id not in errors]
+        if sent:
+            await db.execute(update(OutboxMail)
+                             .where(OutboxMail.id.in_(sent))
+                             .values(status='sent', sent_at=func.now(), locked_at=None, updated_at=func.now())
+                             .execution_options(synchronize_session=False))
+
+        for mail in mails:
+            error = errors.get(mail.id)
+            if error is None:
+                continue
+
+            logger.warning("Mail %s to %s failed on attempt %s: %s", mail.id, mail.recipient, mail.attempts, error)
+            if mail.attempts >= mail.max_attempts:
+                values = {"status": 'failed'}
+            else:
+                values = {"status": 'queued',
+                          "send_after": func.now() + timedelta(seconds=jobs.retry_delay(mail.attempts))}
+
+            await db.execute(update(OutboxMail)
+                             .where(OutboxMail.id == mail.id)
+                             .values(locked_at=None, last_error=error, updated_at=func.now(), **values))
+
+        await db.commit()
+
+    return len(mails)
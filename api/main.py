@@ -1,16 +1,25 @@
+import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
 from dotenv import load_dotenv
 
+from api import metrics
+from api.core import uploads
+from api.core.http_cache import response_cache
+from api.core.permissions import permission_map
+from api.core.tokens import revocations
+from api.formating import ORJSONResponse
+from api.instrumentation import InstrumentationMiddleware
+from api.realtime import broker
 from api.routers import (
     archives,
-    auth
+    auth,
+    realtime,
+    workspaces
 )
 
-app = FastAPI()
-
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+app = FastAPI(default_response_class=ORJSONResponse)
 
 origins = [
     'http://localhost:3000',
@@ -24,12 +33,34 @@ app.add_middleware(
     allow_methods=['*'],
     allow_headers=['*'],
 )
+app.add_middleware(InstrumentationMiddleware)
 
 
 @app.on_event("startup")
 async def startup_event():
     load_dotenv()
+    os.makedirs(uploads.upload_directory, exist_ok=True)
+    await broker.start()
+    await revocations.start()
+    await permission_map.start()
+    await response_cache.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await broker.stop()
+    await revocations.stop()
+    await permission_map.stop()
+    await response_cache.stop()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    # Per process, scrape every worker
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 app.include_router(archives.router, prefix='/api/v1')
-app.include_router(auth.router, prefix='/api/v1')
\ No newline at end of file
+app.include_router(auth.router, prefix='/api/v1')
+app.include_router(realtime.router, prefix='/api/v1')
+app.include_router(workspaces.router, prefix='/api/v1')
\ No newline at end of file
@@ -0,0 +1,202 @@
+import logging
+import zlib
+from collections import Counter as Tally
+from datetime import datetime, timedelta
+from time import monotonic, time
+from typing import Awaitable, Callable, List, Optional
+from sqlalchemy import delete, exists, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api import metrics
+from api.config import settings
+from api.core.storage import storage
+from api.database import AsyncSessionLocal, async_engine
+from api.models import (
+    Archive,
+    Blob,
+    Job,
+    OutboxMail,
+    Permission,
+    RefreshToken,
+    ResetCode,
+    RevokedToken,
+    Role,
+    UploadSession,
+    User,
+    Workspace,
+)
+
+logger = logging.getLogger(__name__)
+
+BatchHook = Callable[[AsyncSession, list], Awaitable[None]]
+
+
+async def purge(model, *criteria, returning=(), on_batch: Optional[BatchHook] = None,
+                batch_size: Optional[int] = None) -> int:
+    '''
+    Delete the rows matching criteria, batch_size at a time in separate transactions.
+    Batches walk the primary key (keyset), rows locked by someone else are skipped.
+    on_batch gets the deleted rows (id plus returning columns) inside the batch transaction.
+    Returns the number of deleted rows.
+    '''
+    batch_size = batch_size or settings.PURGE_BATCH_SIZE
+    deleted = 0
+    last_id = None
+
+    while True:
+        batch = (select(model.id)
+                 .where(*criteria)
+                 .order_by(model.id)
+                 .limit(batch_size)
+                 .with_for_update(skip_locked=True))
+        if last_id is not None:
+            batch = batch.where(model.id > last_id)
+
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                delete(model)
+                .where(model.id.in_(batch))
+                .returning(model.id, *returning)
+                .execution_options(synchronize_session=False)
+            )).all()
+
+            if rows and on_batch is not None:
+                await on_batch(db, rows)
+            await db.commit()
+
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            return deleted
+        last_id = max(row.id for row in rows)
+
+
+def ago(**delta):
+    # Database clock, the same one that fills the timestamps
+    return func.now() - timedelta(**delta)
+
+
+async def release_blobs(db: AsyncSession, rows: list):
+    # Hard deleted archives no longer hold their content
+    for blob_id, count in Tally(row.blob_id for row in rows if row.blob_id).items():
+        await db.execute(update(Blob).where(Blob.id == blob_id).values(ref_count=Blob.ref_count - count))
+
+
+async def remove_temp_files(db: AsyncSession, rows: list):
+    for row in rows:
+        await storage.abort_upload(row)
+
+
+async def remove_blob_files(db: AsyncSession, rows: list):
+    await storage.delete_blobs(row.hash for row in rows)
+
+
+async def purge_reset_codes() -> int:
+    return await purge(ResetCode, ResetCode.expires_in < datetime.now())
+
+
+async def purge_upload_sessions() -> int:
+    return await purge(UploadSession, UploadSession.created_at < ago(seconds=settings.UPLOAD_SESSION_TTL),
+                       returning=(UploadSession.multipart_upload_id,), on_batch=remove_temp_files)
+
+
+async def purge_temp_files() -> int:
+    # Left behind by crashes, or uploads whose session row is already gone
+    return await storage.remove_orphan_uploads()
+
+
+async def purge_soft_deleted() -> int:
+    cutoff = ago(days=settings.SOFT_DELETE_RETENTION)
+    deleted = await purge(Archive, Archive.deleted_at < cutoff, returning=(Archive.blob_id,), on_batch=release_blobs)
+
+    for model in (Workspace, Permission, Role, ResetCode, UploadSession, User):
+        deleted += await purge(model, model.deleted_at < cutoff)
+    return deleted
+
+
+async def purge_orphan_blobs() -> int:
+    return await purge(
+        Blob,
+        Blob.ref_count <= 0,
+        # Touched by every upload of the same bytes, recent ones may be about to be attached
+        Blob.updated_at < ago(seconds=settings.BLOB_GRACE_PERIOD),
+        ~exists().where(Archive.blob_id == Blob.id),
+        returning=(Blob.hash,),
+        on_batch=remove_blob_files,
+    )
+
+
+async def purge_tokens() -> int:
+    return (await purge(RefreshToken, RefreshToken.expires_at < func.now())
+            + await purge(RevokedToken, RevokedToken.expires_at < func.now()))
+
+
+async def purge_finished_work() -> int:
+    cutoff = ago(days=settings.JOB_RETENTION)
+    return (await purge(Job, Job.status.in_(('done', 'failed')), Job.updated_at < cutoff)
+            + await purge(OutboxMail, OutboxMail.status.in_(('sent', 'failed')), OutboxMail.updated_at < cutoff))
+
+
+class Task:
+    def __init__(self, name: str, run: Callable[[], Awaitable[int]], interval: float) -> None:
+        self.name = name
+        self.run = run
+        self.interval = interval
+        self.next_run = 0.0
+        # Shared across workers, only one of them runs a task at a time
+        self.lock_key = zlib.crc32(f"maintenance:{name}".encode())
+        self.purged = metrics.Counter(f"maintenance_{name}_purged_total", f"Rows or files removed by {name}")
+        self.failures = metrics.Counter(f"maintenance_{name}_failures_total", f"Failed runs of {name}")
+        self.duration = metrics.Gauge(f"maintenance_{name}_duration_seconds", f"Duration of the last run of {name}")
+        self.last_success = metrics.Gauge(f"maintenance_{name}_last_success_timestamp_seconds",
+                                          f"Unix time of the last successful run of {name}")
+
+
+tasks: List[Task] = [
+    Task("reset_codes", purge_reset_codes, settings.PURGE_INTERVAL),
+    Task("upload_sessions", purge_upload_sessions, settings.PURGE_INTERVAL),
+    Task("temp_files", purge_temp_files, settings.PURGE_INTERVAL),
+    Task("soft_deleted", purge_soft_deleted, settings.PURGE_INTERVAL),
+    Task("orphan_blobs", purge_orphan_blobs, settings.PURGE_INTERVAL),
+    Task("tokens", purge_tokens, settings.PURGE_INTERVAL),
+    Task("finished_work", purge_finished_work, settings.PURGE_INTERVAL),
+]
+
+
+async def run_task(task: Task):
+    async with async_engine.connect() as connection:
+        if not await connection.scalar(select(func.pg_try_advisory_lock(task.lock_key))):
+            return
+        # Session level lock, it outlives the transaction
+        await connection.commit()
+
+        started_at = monotonic()
+        try:
+            purged = await task.run()
+        except Exception:
+            task.failures.inc()
+            logger.exception("Maintenance task %s failed", task.name)
+        else:
+            task.purged.inc(purged)
+            task.last_success.set(time())
+            if purged:
+                logger.info("Maintenance task %s removed %s rows or files", task.name, purged)
+        finally:
+            task.duration.set(monotonic() - started_at)
+            await connection.scalar(select(func.pg_advisory_unlock(task.lock_key)))
+            await connection.commit()
+
+
+async def run_due_tasks():
+    '''
+    Run the tasks whose interval has elapsed, called by the worker loop.
+    '''
+    for task in tasks:
+        if monotonic() < task.next_run:
+            continue
+
+        task.next_run = monotonic() + task.interval
+        try:
+            await run_task(task)
+        except Exception:
+            task.failures.inc()
+            logger.exception("Could not run maintenance task %s", task.name)
@@ -0,0 +1,137 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+
+# Process-wide metrics, keyed by name
+registry: Dict[str, "Metric"] = {}
+
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), register: bool = True) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.value = 0
+        self.children: Dict[Tuple[str, ...], "Metric"] = {}
+        if register:
+            registry[name] = self
+
+    def child(self) -> "Metric":
+        return type(self)(self.name, self.documentation, register=False)
+
+    def labels(self, *values) -> "Metric":
+        '''
+        counter.labels("GET", "/api/v1/archives/").inc(), in labelnames order.
+        '''
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self.child()
+        return child
+
+    def samples(self, labels: str):
+        yield self.name, labels, self.value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+        if not self.labelnames:
+            series = [("", self)]
+        else:
+            series = [(format_labels(self.labelnames, key), child) for key, child in list(self.children.items())]
+
+        for labels, metric in series:
+            for name, sample_labels, value in metric.samples(labels):
+                lines.append(f"{name}{{{sample_labels}}} {value}" if sample_labels else f"{name} {value}")
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), register: bool = True,
+                 function: Optional[Callable[[], float]] = None) -> None:
+        super().__init__(name, documentation, labelnames, register)
+        # Read at scrape time instead of being kept up to date
+        self.function = function
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def samples(self, labels: str):
+        yield self.name, labels, self.function() if self.function else self.value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), register: bool = True,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames, register)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, register=False, buckets=self.buckets)
+
+    def observe(self, value: float):
+        # Counts are per bucket, made cumulative when rendered
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, labels: str):
+        prefix = f"{labels}," if labels else ""
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield f"{self.name}_bucket", f'{prefix}le="{"+Inf" if bound == float("inf") else bound}"', cumulative
+        yield f"{self.name}_sum", labels, self.sum
+        yield f"{self.name}_count", labels, self.count
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    return ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+def render() -> str:
+    '''
+    Every registered metric in the Prometheus text format.
+    '''
+    return "\n".join(metric.render() for metric in list(registry.values())) + "\n"
+
+
+# Time spent per resource by the request currently running, for Server-Timing
+current_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("current_timings", default=None)
+
+
+def record_timing(name: str, seconds: float):
+    timings = current_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
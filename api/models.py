@@ -3,18 +3,24 @@ from datetime import datetime, timedelta
 from email.policy import default
 from sqlalchemy import (
     ARRAY,
+    BigInteger,
     Boolean,
     Column,
+    Computed,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
+    LargeBinary,
     String,
     Text,
+    func,
     text,
     TIMESTAMP,
 )
-from sqlalchemy.orm import relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import deferred, relationship
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR, UUID
+from .config import settings
 from .database import Base
 
 
@@ -23,17 +29,51 @@ class Archive(Base):
     __tablename__ = 'archives'
 
     id = Column(UUID(as_uuid=True), primary_key=True, index=True, nullable=False, default=uuid4)
-    title = Column(String(255), index=True, unique=True, nullable=False)
-    description = Column(Text, index=True)
+    # Unique among live archives, see ix_archives_live_title
+    title = Column(String(255), nullable=False)
+    description = Column(Text)
     author_id = Column(UUID(as_uuid=True), ForeignKey(
         'users.id', ondelete="SET NULL"))
+    # Uploaded content, shared by every archive with the same bytes
+    blob_id = Column(UUID(as_uuid=True), ForeignKey(
+        'blobs.id', ondelete="SET NULL"), index=True)
+    filename = Column(String(255))
+    # Background processing of the content: pending, ready or failed
+    processing_status = Column(String(20))
+
+    # Full-text document, maintained by Postgres
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(description, '')), 'B')",
+        persisted=True)), raiseload=True)
 
     created_at = Column(TIMESTAMP(timezone=True), nullable=False)
     deleted_at = Column(TIMESTAMP(timezone=True))
+    # Bumped by every UPDATE, response ETags are derived from it
     updated_at = Column(TIMESTAMP(timezone=True),
-                        nullable=False, server_default=text('now()'))
-
-    author = relationship("User")
+                        nullable=False, server_default=text('now()'), onupdate=func.now())
+
+    author = relationship("User", lazy="raise_on_sql")
+    blob = relationship("Blob", lazy="raise_on_sql")
+
+    # Reads never see soft-deleted rows (see database.exclude_deleted), so indexes skip them too
+    __table_args__ = (
+        Index('ix_archives_live_title', 'title', unique=True,
+              postgresql_where=text('deleted_at IS NULL')),
+        # Keyset pagination order
+        Index('ix_archives_live_created_at_id', 'created_at', 'id',
+              postgresql_where=text('deleted_at IS NULL')),
+        # Substring (LIKE/ILIKE) search
+        Index('ix_archives_live_title_trgm', 'title',
+              postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'},
+              postgresql_where=text('deleted_at IS NULL')),
+        Index('ix_archives_live_description_trgm', 'description',
+              postgresql_using='gin', postgresql_ops={'description': 'gin_trgm_ops'},
+              postgresql_where=text('deleted_at IS NULL')),
+        # Ranked full-text search
+        Index('ix_archives_live_search_vector', 'search_vector', postgresql_using='gin',
+              postgresql_where=text('deleted_at IS NULL')),
+    )
 
 
 # User Model
@@ -41,7 +81,7 @@ class User(Base):
     __tablename__ = 'users'
 
     id = Column(UUID(as_uuid=True), primary_key=True, index=True, nullable=False, default=uuid4)
-    email = Column(String(255), nullable=False, index=True)
+    email = Column(String(255), nullable=False)
     hashed_password = Column(String(255))
 
     firstname = Column(String(255), nullable=False, index=True)
@@ -50,13 +90,17 @@ class User(Base):
     is_active = Column(Boolean, server_default='TRUE', nullable=False)
 
     photo_url = Column(Text)
-    refresh_token = Column(String(255))
     roles = Column(ARRAY(String(255)))
 
     created_at = Column(TIMESTAMP(timezone=True), nullable=False)
     deleted_at = Column(TIMESTAMP(timezone=True))
     updated_at = Column(TIMESTAMP(timezone=True),
-                        nullable=False, server_default=text('now()'))
+                        nullable=False, server_default=text('now()'), onupdate=func.now())
+
+    __table_args__ = (
+        # Login and token lookups, deleted accounts cannot sign in
+        Index('ix_users_live_email', 'email', postgresql_where=text('deleted_at IS NULL')),
+    )
 
 
 # Role Model
@@ -74,7 +118,7 @@ class Role(Base):
     updated_at = Column(TIMESTAMP(timezone=True),
                         nullable=False, server_default=text('now()'))
 
-    author = relationship("User")
+    author = relationship("User", lazy="raise_on_sql")
 
 # Permission Model
 
@@ -96,8 +140,8 @@ class Permission(Base):
     updated_at = Column(TIMESTAMP(timezone=True),
                         nullable=False, server_default=text('now()'))
 
-    role = relationship("Role")
-    author = relationship("User")
+    role = relationship("Role", lazy="raise_on_sql")
+    author = relationship("User", lazy="raise_on_sql")
 
 
 # Workspace Model
@@ -114,9 +158,20 @@ class Workspace(Base):
     created_at = Column(TIMESTAMP(timezone=True), nullable=False)
     deleted_at = Column(TIMESTAMP(timezone=True))
     updated_at = Column(TIMESTAMP(timezone=True),
-                        nullable=False, server_default=text('now()'))
+                        nullable=False, server_default=text('now()'), onupdate=func.now())
+
+    author = relationship("User", lazy="raise_on_sql")
 
-    author = relationship("User")
+    __table_args__ = (
+        # Keyset pagination over live workspaces only
+        Index('ix_workspaces_live_created_at_id', 'created_at', 'id',
+              postgresql_where=text('deleted_at IS NULL')),
+    )
+
+
+def reset_code_expiry() -> datetime:
+    # Called for every insert, not once at import
+    return datetime.now() + timedelta(hours=settings.RESET_CODE_LIFETIME)
 
 
 # Reset Code Model
@@ -126,7 +181,7 @@ class ResetCode(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, index=True, nullable=False, default=uuid4)
     email = Column(String, index=True)
     reset_code = Column(String, index=True, nullable=False)
-    expires_in = Column(DateTime, default=datetime.now() + timedelta(hours=2))
+    expires_in = Column(DateTime, default=reset_code_expiry)
     user_id = Column(UUID(as_uuid=True), ForeignKey(
         'users.id', ondelete="SET NULL"))
 
@@ -135,4 +190,145 @@ class ResetCode(Base):
     updated_at = Column(TIMESTAMP(timezone=True),
                         nullable=False, server_default=text('now()'))
 
-    user = relationship("User")
+    user = relationship("User", lazy="raise_on_sql")
+
+
+# Upload Session Model
+class UploadSession(Base):
+    __tablename__ = 'upload_sessions'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, index=True, nullable=False, default=uuid4)
+    filename = Column(String(255), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    chunk_size = Column(Integer, nullable=False)
+    total_chunks = Column(Integer, nullable=False)
+    # One bit per chunk, set once the chunk has been stored
+    received = Column(LargeBinary, nullable=False)
+    # Multipart upload holding the chunks with the S3 storage backend
+    multipart_upload_id = Column(String(1024))
+    # SHA-256 announced by the client, checked when the upload completes
+    sha256 = Column(String(64))
+    # A chunk was stored more than once or a write failed halfway, the bytes on disk may
+    # then differ from the ones hashed while streaming, so completion hashes from storage
+    rewritten = Column(Boolean, server_default='FALSE', nullable=False)
+    status = Column(String(20), server_default='pending', nullable=False)
+    archive_id = Column(UUID(as_uuid=True), ForeignKey(
+        'archives.id', ondelete="CASCADE"))
+    author_id = Column(UUID(as_uuid=True), ForeignKey(
+        'users.id', ondelete="SET NULL"))
+
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    deleted_at = Column(TIMESTAMP(timezone=True))
+    updated_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text('now()'))
+
+    archive = relationship("Archive", lazy="raise_on_sql")
+    author = relationship("User", lazy="raise_on_sql")
+
+
+# Blob Model, content addressed object under <hash[:2]>/<hash> in the storage backend
+class Blob(Base):
+    __tablename__ = 'blobs'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, index=True, nullable=False, default=uuid4)
+    hash = Column(String(64), index=True, unique=True, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    content_type = Column(String(255))
+    # Archives pointing at this blob, unreferenced blobs can be purged
+    ref_count = Column(Integer, server_default='0', nullable=False)
+    # Set once a worker has re-read the stored file and checked its hash
+    verified_at = Column(TIMESTAMP(timezone=True))
+    # Set when the stored object did not match its hash, not served until the bytes are uploaded again
+    corrupted_at = Column(TIMESTAMP(timezone=True))
+
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    deleted_at = Column(TIMESTAMP(timezone=True))
+    updated_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text('now()'))
+
+
+# Job Model, background work claimed by workers with SELECT ... FOR UPDATE SKIP LOCKED
+class Job(Base):
+    __tablename__ = 'jobs'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, nullable=False, default=uuid4)
+    kind = Column(String(64), nullable=False)
+    payload = Column(JSONB, server_default=text("'{}'::jsonb"), nullable=False)
+    # queued, running, done or failed
+    status = Column(String(20), server_default='queued', nullable=False)
+    attempts = Column(Integer, server_default='0', nullable=False)
+    max_attempts = Column(Integer, server_default='5', nullable=False)
+    run_at = Column(TIMESTAMP(timezone=True), server_default=text('now()'), nullable=False)
+    locked_at = Column(TIMESTAMP(timezone=True))
+    last_error = Column(Text)
+
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text('now()'))
+
+    __table_args__ = (
+        # Claim order, finished jobs stay out of the index
+        Index('ix_jobs_status_run_at', 'status', 'run_at',
+              postgresql_where=text("status IN ('queued', 'running')")),
+    )
+
+
+# Outbox Model, mails queued with the transaction that triggers them and sent by the worker
+class OutboxMail(Base):
+    __tablename__ = 'outbox'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, nullable=False, default=uuid4)
+    recipient = Column(String(255), nullable=False)
+    template = Column(String(64), nullable=False)
+    context = Column(JSONB, server_default=text("'{}'::jsonb"), nullable=False)
+    # queued, sending, sent or failed
+    status = Column(String(20), server_default='queued', nullable=False)
+    attempts = Column(Integer, server_default='0', nullable=False)
+    max_attempts = Column(Integer, server_default='8', nullable=False)
+    send_after = Column(TIMESTAMP(timezone=True), server_default=text('now()'), nullable=False)
+    locked_at = Column(TIMESTAMP(timezone=True))
+    sent_at = Column(TIMESTAMP(timezone=True))
+    last_error = Column(Text)
+
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text('now()'))
+
+    __table_args__ = (
+        Index('ix_outbox_status_send_after', 'status', 'send_after',
+              postgresql_where=text("status IN ('queued', 'sending')")),
+        # Per-recipient rate limit
+        Index('ix_outbox_recipient_created_at', 'recipient', 'created_at'),
+    )
+
+
+# Revoked Token Model, a single token (jti) or every token of a user issued until revoked_at
+class RevokedToken(Base):
+    __tablename__ = 'revoked_tokens'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, nullable=False, default=uuid4)
+    jti = Column(String(64), index=True)
+    user_id = Column(UUID(as_uuid=True), ForeignKey(
+        'users.id', ondelete="CASCADE"), index=True)
+    revoked_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    # Once the revoked tokens have expired the row is no longer needed
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False, index=True)
+
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+
+# Refresh Token Model, only the SHA-256 of the opaque token is stored
+class RefreshToken(Base):
+    __tablename__ = 'refresh_tokens'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, nullable=False, default=uuid4)
+    token_hash = Column(String(64), unique=True, index=True, nullable=False)
+    user_id = Column(UUID(as_uuid=True), ForeignKey(
+        'users.id', ondelete="CASCADE"), index=True, nullable=False)
+    # Every rotation of one login shares the family, a reused token revokes all of it
+    family_id = Column(UUID(as_uuid=True), index=True, nullable=False)
+    used_at = Column(TIMESTAMP(timezone=True))
+    revoked_at = Column(TIMESTAMP(timezone=True))
+    expires_at = Column(TIMESTAMP(timezone=True), index=True, nullable=False)
+
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
@@ -0,0 +1,60 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+from uuid import UUID
+from fastapi import HTTPException, status
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database import live
+
+
+# Keyset pagination over (created_at, id), newest first.
+# Cursors are opaque to clients: base64url of the last row's sort key.
+def encode_cursor(created_at: datetime, id: UUID) -> str:
+    raw = json.dumps([created_at.isoformat(), str(id)], separators=(",", ":"))
+    return urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    try:
+        raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, id = json.loads(raw)
+        return datetime.fromisoformat(created_at), UUID(id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='Invalid cursor')
+
+
+def paginate(stmt, created_at, id, cursor: Optional[str], limit: int):
+    stmt = stmt.order_by(created_at.desc(), id.desc())
+
+    if cursor:
+        # Row comparison walks the (created_at, id) index from the cursor on
+        stmt = stmt.where(tuple_(created_at, id) < tuple_(*decode_cursor(cursor)))
+
+    # One extra row tells whether there is a next page
+    return stmt.limit(limit + 1)
+
+
+def next_page(rows: List[Any], limit: int) -> Tuple[List[Any], Optional[str]]:
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].created_at, rows[-1].id)
+
+
+async def count(db: AsyncSession, stmt, estimate: bool = False) -> int:
+    if not estimate:
+        return (await db.execute(select(func.count()).select_from(stmt.subquery()))).scalar_one()
+
+    # Planner estimate, no table scan. Compiled by hand, so without the session's soft-delete filter
+    connection = await db.connection()
+    compiled = live(stmt).compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+    plan = (await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar_one()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]["Plan"]["Plan Rows"])
@@ -0,0 +1,88 @@
+from uuid import UUID
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api import jobs
+from api.core.http_cache import response_cache
+from api.core.storage import storage
+from api.database import AsyncSessionLocal
+from api.models import Archive, Blob
+from api.realtime import broker
+
+
+# Post-processing of uploaded content, run by `python -m api.worker`.
+# New steps (thumbnails, text extraction, scanning) are more handlers
+# enqueued next to this one from attach_blob().
+PROCESS_ARCHIVE = "archives.process"
+VERIFY_BLOB = "blobs.verify"
+
+
+async def enqueue_processing(db: AsyncSession, archive_id: UUID, blob_id: UUID):
+    await jobs.enqueue(db, PROCESS_ARCHIVE, {"archive_id": str(archive_id), "blob_id": str(blob_id)})
+
+
+async def enqueue_verification(db: AsyncSession, blob_id: UUID):
+    # For uploads not attached to an archive, unverified blobs are never deduplicated onto
+    await jobs.enqueue(db, VERIFY_BLOB, {"blob_id": str(blob_id)})
+
+
+async def set_status(db: AsyncSession, payload: dict, processing_status: str):
+    # Only while the archive still points at the processed blob
+    await db.execute(update(Archive)
+                     .where(Archive.id == UUID(payload["archive_id"]),
+                            Archive.blob_id == UUID(payload["blob_id"]))
+                     .values(processing_status=processing_status))
+    # Cached archive responses are dropped once the status is committed
+    await response_cache.invalidate("archives", db=db)
+
+
+async def processing_failed(db: AsyncSession, payload: dict, error: str):
+    await set_status(db, payload, 'failed')
+    await broker.publish("archive.processed", {"id": payload["archive_id"], "processing_status": 'failed'},
+                         "archives", f"archive:{payload['archive_id']}", db=db)
+
+
+async def mark_corrupted(blob_id: UUID):
+    # Own transaction, the failing job's one is rolled back
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(Blob).where(Blob.id == blob_id).values(corrupted_at=func.now()))
+        await db.commit()
+
+
+async def verify_blob(db: AsyncSession, blob_id: UUID) -> bool:
+    '''
+    Check the stored object against its content address.
+    Blobs are shared, so a blob verified before is not read again. False when the blob is gone.
+    A mismatch cannot go away by reading again: the blob is marked corrupted and the job fails for good.
+    '''
+    blob = (await db.execute(select(Blob.id, Blob.hash, Blob.size, Blob.verified_at, Blob.corrupted_at)
+                             .where(Blob.id == blob_id))).first()
+    if blob is None:
+        return False
+
+    if blob.corrupted_at is not None:
+        raise jobs.PermanentError(f'Blob {blob.id} does not match its SHA-256')
+
+    if blob.verified_at is None:
+        digest = await storage.hash_blob(blob.hash, blob.size)
+        if digest != blob.hash:
+            await mark_corrupted(blob.id)
+            raise jobs.PermanentError(f'Blob {blob.id} does not match its SHA-256')
+
+        await db.execute(update(Blob).where(Blob.id == blob.id).values(verified_at=func.now()))
+    return True
+
+
+@jobs.handler(VERIFY_BLOB)
+async def verify_uploaded_blob(db: AsyncSession, payload: dict):
+    await verify_blob(db, UUID(payload["blob_id"]))
+
+
+@jobs.handler(PROCESS_ARCHIVE, on_failure=processing_failed)
+async def process_archive(db: AsyncSession, payload: dict):
+    if not await verify_blob(db, UUID(payload["blob_id"])):
+        return
+
+    await set_status(db, payload, 'ready')
+    await broker.publish("archive.processed", {"id": payload["archive_id"], "processing_status": 'ready'},
+                         "archives", f"archive:{payload['archive_id']}", db=db)
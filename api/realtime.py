@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Optional, Set
+import asyncpg
+import orjson
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api import metrics
+from api.config import settings
+from api.database import async_engine
+from api.formating import json_default
+
+logger = logging.getLogger(__name__)
+
+dropped_events = metrics.Counter("realtime_dropped_events_total", "Events dropped for subscribers that read too slowly")
+connected_clients = metrics.Gauge("realtime_connected_clients", "Open realtime connections in this worker")
+
+
+class Broker:
+    '''
+    Topic fan-out to the websocket connections of this worker.
+    With REALTIME_BACKEND=postgres events travel through LISTEN/NOTIFY,
+    so every worker delivers events published by any other one.
+    '''
+    def __init__(self) -> None:
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self.listener: Optional[asyncio.Task] = None
+
+    def subscribe(self, topic: str, queue: asyncio.Queue):
+        self.subscribers[topic].add(queue)
+
+    def unsubscribe(self, topic: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(topic)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[topic]
+
+    async def publish(self, event: str, data: dict, *topics: str, db: Optional[AsyncSession] = None):
+        '''
+        publish("archive.deleted", {"id": archive_id}, "archives", f"archive:{archive_id}")
+        Keep data small, NOTIFY payloads are limited to 8000 bytes.
+        With db, the notification is part of that transaction and only sent on commit.
+        '''
+        message = {"topics": topics, "event": event, "data": data}
+
+        if settings.REALTIME_BACKEND != "postgres":
+            self.deliver(message)
+            return
+
+        notify = select(func.pg_notify(settings.REALTIME_CHANNEL, orjson.dumps(message, default=json_default).decode("utf-8")))
+        if db is not None:
+            await db.execute(notify)
+            return
+
+        # Events are best effort, a failed notify must not fail the request
+        try:
+            async with async_engine.begin() as connection:
+                await connection.execute(notify)
+        except Exception:
+            logger.exception("Could not publish %s", event)
+
+    def deliver(self, message: dict):
+        for topic in message["topics"]:
+            queues = self.subscribers.get(topic)
+            if not queues:
+                continue
+
+            # Serialized once per topic, not once per subscriber
+            text = orjson.dumps({"topic": topic, "event": message["event"], "data": message["data"]},
+                                default=json_default).decode("utf-8")
+            for queue in queues:
+                try:
+                    queue.put_nowait(text)
+                except asyncio.QueueFull:
+                    dropped_events.inc()
+
+    def on_notify(self, connection, pid, channel, payload):
+        self.deliver(orjson.loads(payload))
+
+    async def listen(self):
+        # Dedicated connection, a pooled one would carry the listener back to the pool
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(
+                    host=settings.DB_HOST, port=settings.DB_PORT, database=settings.DB_NAME,
+                    user=settings.DB_USER, password=settings.DB_PASSWORD)
+                await connection.add_listener(settings.REALTIME_CHANNEL, self.on_notify)
+
+                while not connection.is_closed():
+                    await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Realtime listener failed, reconnecting")
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+
+            await asyncio.sleep(1)
+
+    async def start(self):
+        if settings.REALTIME_BACKEND == "postgres" and self.listener is None:
+            self.listener = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
+
+
+broker = Broker()
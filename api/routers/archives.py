@@ -1,153 +1,678 @@
 from datetime import datetime
-from uuid import UUID
-from typing import Optional
-from fastapi import APIRouter, Body, Depends, HTTPException, status, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, ValidationError
-from sqlalchemy.orm import Session
-from api import database
-from api.core.oauth2 import get_current_active_user
-from api.core.schemas import UserOAuth
-from api.models import Archive, User
-import base64
-import hashlib
-import os
-from os import path, getcwd
-
-# Local Path for testing
-sep = path.sep
-current_directory = getcwd() + sep + "uploads" + sep
+from uuid import UUID, uuid4
+from typing import List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Query, status, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from api import bulk, database, formating, loading, pagination, processing
+from api.config import settings
+from api.core import uploads
+from api.core.http_cache import response_cache
+from api.core.permissions import require_permission
+from api.core.schemas import ArchiveDetail, ArchivePage, ArchiveSearchResults, CreateUploadSession, UserOAuth
+from api.core.storage import storage
+from api.formating import ORJSONResponse
+from api.models import Archive, Blob, UploadSession, User
+from api.realtime import broker
+import mimetypes
 
 
 router = APIRouter(
     tags=['Archives'],
     prefix="/archives",
-    # dependencies=[Depends(get_current_active_user)]
 )
 
 
 class CreateArchive(BaseModel):
-    title: str
+    title: str = Field(..., min_length=1, max_length=255)
     description: Optional[str]
 
 
-@router.get("/")
-def all_archives(
+@router.get("/", response_model=ArchivePage)
+async def all_archives(
+    request: Request,
     q: Optional[str] = "",
-    page: int = 1,
-    limit: int = 10,
-    db: Session = database.session()
+    cursor: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=settings.PAGINATION_MAX_LIMIT),
+    total: Optional[str] = Query(None, regex="^(exact|estimate)$"),
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:read")
 ):
+    async def build():
+        archives_query = select(*formating.archive_columns)
+        if q:
+            archives_query = archives_query.where(Archive.title.contains(q))
 
-    offset = (page - 1) * limit
+        rows = (await db.execute(pagination.paginate(
+            archives_query, Archive.created_at, Archive.id, cursor, limit))).all()
+        archives, next_cursor = pagination.next_page(rows, limit)
+        count = await pagination.count(db, archives_query, estimate=total == "estimate") if total else None
 
-    archives = (db.query(Archive)
-                .filter(Archive.title.contains(q))
-                .limit(limit)
-                .offset(offset)
-                .all())
-    # archives = [format(pk) for pk in Archive.all_pks()]
-    return archives
+        content = formating.dumps({
+            "items": formating.as_dicts(archives),
+            "next_cursor": next_cursor,
+            "total": count,
+        })
+        return content, (next_cursor, count, [(archive.id, archive.updated_at) for archive in archives])
 
+    return await response_cache.respond(request, "archives", current_user.id, build)
 
-@router.get("/{archive_id}")
-def read_archive(
+
+# Highlight markers wrapped around matched words
+HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=30, MinWords=10'
+
+
+@router.get("/search", response_model=ArchiveSearchResults)
+async def search_archives(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(10, ge=1, le=settings.PAGINATION_MAX_LIMIT),
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:read")
+):
+    query = func.websearch_to_tsquery('simple', q)
+    rank = func.ts_rank_cd(Archive.search_vector, query)
+
+    # Rank on the index first, only build highlights for the returned rows
+    matches = (select(Archive.id, Archive.title, Archive.description, Archive.created_at, rank.label('rank'))
+               .where(Archive.search_vector.op('@@')(query))
+               .order_by(rank.desc(), Archive.id)
+               .limit(limit)
+               .subquery())
+
+    rows = (await db.execute(
+        select(
+            matches.c.id,
+            matches.c.title,
+            matches.c.created_at,
+            matches.c.rank,
+            func.ts_headline('simple', matches.c.title, query, HEADLINE_OPTIONS).label('title_highlight'),
+            func.ts_headline('simple', func.coalesce(matches.c.description, ''), query,
+                             HEADLINE_OPTIONS).label('description_highlight'),
+        ).order_by(matches.c.rank.desc(), matches.c.id)
+    )).all()
+
+    return ORJSONResponse({"items": formating.as_dicts(rows)})
+
+
+async def insert_archives(db: AsyncSession, batch: List[Tuple[int, dict]], report: bulk.ImportReport):
+    # One statement per batch, titles that already exist are skipped instead of failing it
+    try:
+        inserted = set((await db.execute(
+            insert(Archive)
+            .on_conflict_do_nothing(index_elements=[Archive.title], index_where=Archive.deleted_at.is_(None))
+            .returning(Archive.title),
+            [values for _, values in batch],
+        )).scalars())
+        await db.commit()
+    except DBAPIError as e:
+        await db.rollback()
+        if len(batch) > 1:
+            # Row by row, only the offending rows fail and the report names them
+            for item in batch:
+                await insert_archives(db, [item], report)
+        else:
+            # The driver's own message, without the adapter's class prefix
+            report.fail(batch[0][0], f"Could not be stored: {e.orig.__cause__ or e.orig}")
+        return
+
+    for row, values in batch:
+        if values["title"] in inserted:
+            # Later rows with the same title are duplicates
+            inserted.discard(values["title"])
+            report.inserted += 1
+        else:
+            report.fail(row, f'Archive {values["title"]} already exists')
+
+
+@router.post("/import")
+async def import_archives(
+    request: Request,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:create")
+):
+    '''
+    Stream archives as NDJSON (application/x-ndjson) or CSV with a header (text/csv),
+    one {"title", "description"} per row. Rows are committed IMPORT_BATCH_SIZE at a time.
+    '''
+    report = bulk.ImportReport()
+    batch: List[Tuple[int, dict]] = []
+    now = datetime.now()
+
+    async for row, record, error in bulk.records(request):
+        if error:
+            report.fail(row, error)
+            continue
+
+        try:
+            archive = CreateArchive.parse_obj(record)
+        except ValidationError as e:
+            report.fail(row, bulk.validation_message(e))
+            continue
+
+        batch.append((row, {
+            "id": uuid4(),
+            "title": archive.title,
+            "description": archive.description,
+            "author_id": current_user.id,
+            "created_at": now,
+        }))
+        if len(batch) >= settings.IMPORT_BATCH_SIZE:
+            await insert_archives(db, batch, report)
+            batch = []
+
+    if batch:
+        await insert_archives(db, batch, report)
+
+    if report.inserted:
+        await response_cache.invalidate("archives")
+        await broker.publish("archives.imported", {"inserted": report.inserted}, "archives")
+
+    return ORJSONResponse(report.as_dict())
+
+
+@router.get("/export")
+async def export_archives(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    current_user: UserOAuth = require_permission("archives:read")
+):
+    query = select(*formating.archive_columns).order_by(Archive.created_at, Archive.id)
+
+    if format == "csv":
+        columns = [column.key for column in formating.archive_columns]
+        header = bulk.to_csv(columns, [columns])
+        body = bulk.export_rows(query, bulk.to_csv, header)
+        media_type = "text/csv"
+    else:
+        body = bulk.export_rows(query, bulk.to_ndjson)
+        media_type = "application/x-ndjson"
+
+    return StreamingResponse(body, media_type=media_type, headers={
+        "content-disposition": f'attachment; filename="archives.{format}"',
+    })
+
+
+@router.get("/{archive_id}", response_model=ArchiveDetail)
+async def read_archive(
     archive_id: UUID,
-    db: Session = database.session()
+    request: Request,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:read")
 ):
+    async def build():
+        # Author comes from the same query, archives without one are kept
+        archive_query = loading.join_eager(
+            select(Archive), Archive.author, User.id, User.firstname, User.lastname)
+        archive = (await db.execute(archive_query.where(Archive.id == archive_id))).scalars().first()
 
-    archive = (db.query(Archive)
-               .join(User)
-               .filter(Archive.id == archive_id)
-               .first())
+        if not archive:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'Archive {archive_id} not found')
 
-    if not archive:
+        return formating.dumps(formating.format_archive(archive)), (archive.id, archive.updated_at)
+
+    return await response_cache.respond(request, "archives", current_user.id, build)
+
+
+@router.get("/{archive_id}/content")
+async def read_archive_content(
+    archive_id: UUID,
+    request: Request,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:read")
+):
+    content = (await db.execute(
+        select(Blob.hash, Blob.size, Blob.content_type, Blob.created_at, Archive.filename)
+        .join(Blob, Archive.blob_id == Blob.id)
+        # Corrupted content is not served, it comes back once uploaded again
+        .where(Archive.id == archive_id, Blob.corrupted_at.is_(None))
+    )).first()
+
+    if not content:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'Archive {archive_id} not found')
+                            detail=f'Archive {archive_id} has no content')
+
+    return await storage.blob_response(
+        request,
+        content.hash,
+        size=content.size,
+        content_type=content.content_type or "application/octet-stream",
+        created_at=content.created_at,
+        filename=content.filename,
+    )
+
 
-    return archive
+# Headers only, e.g. the size and validators before a ranged download
+router.add_api_route("/{archive_id}/content", read_archive_content, methods=["HEAD"], include_in_schema=False)
 
 
 @router.post('/')
 async def create_archive(
         create_archive: CreateArchive,
-        db: Session = database.session(),
-        current_user: UserOAuth = Depends(get_current_active_user)
+        db: AsyncSession = database.async_session(),
+        current_user: UserOAuth = require_permission("archives:create")
 ):
-    try:
-        new_archive = Archive(
+    # Taken titles insert nothing instead of raising
+    archive_id = (await db.execute(
+        insert(Archive)
+        .values(
             title=create_archive.title,
             description=create_archive.description,
             author_id=current_user.id,
             created_at=datetime.now(),
         )
-        db.add(new_archive)
-        db.commit()
-        db.refresh(new_archive)
+        .on_conflict_do_nothing(index_elements=[Archive.title], index_where=Archive.deleted_at.is_(None))
+        .returning(Archive.id)
+    )).scalar_one_or_none()
+
+    if archive_id is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f'Archive {create_archive.title} already exists')
+    await db.commit()
 
-        return {
-            "archive_id": new_archive.id,
-            "message": f"Archive created successfully",
-        }
+    await response_cache.invalidate("archives")
+    await broker.publish("archive.created", {"id": archive_id, "title": create_archive.title}, "archives")
 
-    except ValidationError as e:
-        print(e)
-        raise HTTPException(status_code=500, detail='Internal server error')
+    return {
+        "archive_id": archive_id,
+        "message": f"Archive created successfully",
+    }
 
 
 @router.delete("/{archive_id}")
-def read_archive(
+async def delete_archive(
     archive_id: UUID,
-    db: Session = database.session()
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:delete")
 ):
+    # Soft delete in one statement, the content stays referenced until the archive is purged
+    deleted = (await db.execute(
+        update(Archive)
+        .where(Archive.id == archive_id, Archive.deleted_at.is_(None))
+        .values(deleted_at=func.now())
+        .returning(Archive.id)
+    )).first()
+
+    if not deleted:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Archive {archive_id} not found')
+    await db.commit()
 
-    archive_query = db.query(Archive).filter(Archive.id == archive_id)
-    archive = archive_query.first()
+    await response_cache.invalidate("archives")
+    await broker.publish("archive.deleted", {"id": archive_id}, "archives", f"archive:{archive_id}")
 
-    if not archive:
+    return {"message": f"Archive {archive_id} deleted successfully"}
+
+
+@router.post("/{archive_id}/restore")
+async def restore_archive(
+    archive_id: UUID,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:delete")
+):
+    try:
+        restored = (await db.execute(
+            update(Archive)
+            .where(Archive.id == archive_id, Archive.deleted_at.is_not(None))
+            .values(deleted_at=None)
+            .returning(Archive.id, Archive.title)
+        )).first()
+    except IntegrityError:
+        # A live archive took the title in the meantime
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f'Another archive already uses the title of {archive_id}')
+
+    if not restored:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Deleted archive {archive_id} not found')
+    await db.commit()
+
+    await response_cache.invalidate("archives")
+    await broker.publish("archive.restored", {"id": archive_id, "title": restored.title},
+                         "archives", f"archive:{archive_id}")
+
+    return {"message": f"Archive {archive_id} restored successfully"}
+
+
+@router.delete("/{archive_id}/purge")
+async def purge_archive(
+    archive_id: UUID,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:purge")
+):
+    '''
+    Delete an archive for good, live or soft-deleted, without waiting for SOFT_DELETE_RETENTION.
+    '''
+    purged = (await db.execute(
+        delete(Archive)
+        .where(Archive.id == archive_id)
+        .returning(Archive.blob_id, Archive.deleted_at)
+        .execution_options(synchronize_session=False)
+    )).first()
+
+    if not purged:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Archive {archive_id} not found')
 
-    archive_query.delete()
-    db.commit()
+    # Orphaned content is removed by maintenance once nothing references it
+    if purged.blob_id:
+        await db.execute(update(Blob).where(Blob.id == purged.blob_id).values(ref_count=Blob.ref_count - 1))
+    await db.commit()
 
-    return {"message": f"Archive {archive_id} deleted successfully"}
+    if purged.deleted_at is None:
+        await response_cache.invalidate("archives")
+        await broker.publish("archive.deleted", {"id": archive_id}, "archives", f"archive:{archive_id}")
 
+    return {"message": f"Archive {archive_id} purged successfully"}
 
-'''
-Should be working with Websocket
-'''
 
+async def get_upload_session(db: AsyncSession, upload_id: UUID, current_user: UserOAuth) -> UploadSession:
+    upload_session: Optional[UploadSession] = (await db.execute(
+        select(UploadSession)
+        .where(UploadSession.id == upload_id,
+               UploadSession.author_id == current_user.id)
+    )).scalars().first()
 
-@router.post("/upload", status_code=status.HTTP_200_OK)
-def upload(name: str, size: str, currentChunkIndex: str, totalChunks: str, file: str = Body(...)):
-    try:
-        firstChunk = int(currentChunkIndex) == 0
-        lastChunk = int(currentChunkIndex) == int(totalChunks) - 1
+    if not upload_session:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Upload {upload_id} not found')
+
+    return upload_session
+
+
+def ensure_pending(upload_session: UploadSession):
+    if upload_session.status != 'pending':
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f'Upload {upload_session.id} is {upload_session.status}')
 
-        ext = name.split('.').pop()
-        data = file.split(',')[1]
 
-        buffer = base64.b64decode(data)
+async def attach_blob(db: AsyncSession, archive_id: UUID, blob_id: UUID, filename: str):
+    archive = (await db.execute(select(Archive.blob_id)
+                                .where(Archive.id == archive_id)
+                                .with_for_update())).first()
+
+    if not archive:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Archive {archive_id} not found')
 
-        tmpFilename = f"tmp_{hashlib.md5(name.encode('utf-8')).hexdigest()}.{ext}"
-        tmpFilePath = current_directory + tmpFilename
-        tmpFileExists = path.exists(tmpFilePath)
+    values = {"blob_id": blob_id, "filename": filename}
+    if archive.blob_id != blob_id:
+        values["processing_status"] = 'pending'
+    await db.execute(update(Archive).where(Archive.id == archive_id).values(**values))
 
-        if firstChunk and tmpFileExists:
-            os.unlink(tmpFilePath)
+    if archive.blob_id != blob_id:
+        await db.execute(update(Blob).where(Blob.id == blob_id).values(ref_count=Blob.ref_count + 1))
+        if archive.blob_id:
+            await db.execute(update(Blob).where(Blob.id == archive.blob_id).values(ref_count=Blob.ref_count - 1))
 
-        with open(tmpFilePath, "ab") as f:
-            f.write(buffer)
+        # Committed with the caller's transaction, the worker picks it up from there
+        await processing.enqueue_processing(db, archive_id, blob_id)
 
-        if lastChunk:
-            finalFilename = f"{hashlib.md5(str(datetime.now()).encode('utf-8')).hexdigest()}.{ext}"
-            finalFilePath = path.join(current_directory, finalFilename)
-            os.rename(tmpFilePath, finalFilePath)
 
-            return {"finalFilename": finalFilename}
+async def publish_content_changed(archive_id: UUID, blob_id: UUID, filename: str):
+    await response_cache.invalidate("archives")
+    await broker.publish("archive.updated", {"id": archive_id, "blob_id": blob_id, "filename": filename},
+                         "archives", f"archive:{archive_id}")
 
-        return JSONResponse(status_code=status.HTTP_201_CREATED)
 
+@router.post("/uploads", status_code=status.HTTP_201_CREATED)
+async def create_upload(
+    schema: CreateUploadSession,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:upload")
+):
+    chunk_size = schema.chunk_size or settings.UPLOAD_CHUNK_SIZE
+
+    if chunk_size > settings.UPLOAD_MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Chunk size cannot exceed {settings.UPLOAD_MAX_CHUNK_SIZE} bytes')
+
+    if schema.size > settings.UPLOAD_MAX_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f'Uploads cannot exceed {settings.UPLOAD_MAX_SIZE} bytes')
+
+    # Same bytes already stored, nothing to upload. Only verified blobs: an announced hash
+    # proves nothing, the stored bytes have to have been checked against it
+    if schema.sha256:
+        blob = (await db.execute(select(Blob.id, Blob.size)
+                                 .where(Blob.hash == schema.sha256, Blob.verified_at.is_not(None),
+                                        Blob.corrupted_at.is_(None)))).first()
+
+        if blob and blob.size == schema.size:
+            if schema.archive_id:
+                await attach_blob(db, schema.archive_id, blob.id, schema.name)
+                await db.commit()
+                await publish_content_changed(schema.archive_id, blob.id, schema.name)
+
+            return ORJSONResponse(status_code=status.HTTP_200_OK, content={
+                "blob_id": blob.id,
+                "sha256": schema.sha256,
+                "exists": True,
+            })
+
+    total_chunks = uploads.count_chunks(schema.size, chunk_size)
+
+    # A single chunk may be smaller, it is the whole upload
+    min_chunk_size = max(settings.UPLOAD_MIN_CHUNK_SIZE, storage.min_part_size)
+    if total_chunks > 1 and chunk_size < min_chunk_size:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Chunk size must be at least {min_chunk_size} bytes')
+
+    max_chunks = min(settings.UPLOAD_MAX_CHUNKS, storage.max_parts or settings.UPLOAD_MAX_CHUNKS)
+    if total_chunks > max_chunks:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Uploads cannot have more than {max_chunks} chunks')
+
+    upload_session = UploadSession(
+        id=uuid4(),
+        filename=schema.name,
+        size=schema.size,
+        chunk_size=chunk_size,
+        total_chunks=total_chunks,
+        received=uploads.empty_bitmap(total_chunks),
+        sha256=schema.sha256,
+        archive_id=schema.archive_id,
+        author_id=current_user.id,
+        created_at=datetime.now(),
+    )
+    upload_session.multipart_upload_id = await storage.create_upload(upload_session)
+    db.add(upload_session)
+    await db.commit()
+
+    return {
+        "upload_id": upload_session.id,
+        "chunk_size": chunk_size,
+        "total_chunks": total_chunks,
+        "exists": False,
+    }
+
+
+@router.get("/uploads/{upload_id}")
+async def read_upload(
+    upload_id: UUID,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:upload")
+):
+    upload_session = await get_upload_session(db, upload_id, current_user)
+
+    return {
+        "upload_id": upload_session.id,
+        "filename": upload_session.filename,
+        "size": upload_session.size,
+        "chunk_size": upload_session.chunk_size,
+        "total_chunks": upload_session.total_chunks,
+        "status": upload_session.status,
+        "missing_chunks": uploads.missing_chunks(upload_session.received, upload_session.total_chunks),
+    }
+
+
+@router.put("/uploads/{upload_id}/chunks/{index}")
+async def upload_chunk(
+    upload_id: UUID,
+    index: int,
+    request: Request,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:upload")
+):
+    upload_session = await get_upload_session(db, upload_id, current_user)
+    ensure_pending(upload_session)
+
+    if not 0 <= index < upload_session.total_chunks:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Chunk {index} is out of range')
+
+    offset, length = uploads.chunk_bounds(upload_session, index)
+
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        try:
+            content_length = int(content_length)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail='Invalid Content-Length header')
+
+        if content_length != length:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f'Chunk {index} must be {length} bytes')
+
+    # Give the connection back to the pool while the chunk streams in
+    await db.commit()
+
+    # A chunk stored before is only hashed again from storage, never from this stream
+    content_hash = None if uploads.has_chunk(upload_session.received, index) else uploads.claim_hash(upload_id, offset)
+
+    try:
+        written = await storage.write_chunk(upload_session, index, request.stream(), content_hash)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_410_GONE,
+                            detail=f'Upload {upload_id} is no longer available')
+    except ValueError:
+        written = None
     except Exception:
-        return JSONResponse(content="Server error", status_code=status.HTTP_403_FORBIDDEN)
+        await mark_rewritten(db, upload_id)
+        raise
+
+    if written != length:
+        await mark_rewritten(db, upload_id)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Chunk {index} must be {length} bytes')
+
+    # Flip the chunk bit atomically, parallel chunks never overwrite each other.
+    # A bit that was already set means the chunk was stored twice, possibly with other bytes
+    received = (await db.execute(
+        update(UploadSession)
+        .where(UploadSession.id == upload_id, UploadSession.status == 'pending')
+        .values(received=func.set_bit(UploadSession.received, index, 1),
+                rewritten=or_(UploadSession.rewritten, func.get_bit(UploadSession.received, index) == 1))
+        .returning(UploadSession.received)
+    )).scalar_one_or_none()
+    await db.commit()
+
+    if received is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f'Upload {upload_id} is no longer pending')
+
+    await storage.advance_hash(upload_session, received)
+
+    missing = len(uploads.missing_chunks(received, upload_session.total_chunks))
+    await broker.publish("upload.progress", {
+        "upload_id": upload_id,
+        "index": index,
+        "missing_chunks": missing,
+        "total_chunks": upload_session.total_chunks,
+    }, f"upload:{upload_id}")
+
+    return {
+        "index": index,
+        "missing_chunks": missing,
+    }
+
+
+async def mark_rewritten(db: AsyncSession, upload_id: UUID):
+    # Part of a failed write may have reached storage
+    await db.execute(update(UploadSession).where(UploadSession.id == upload_id).values(rewritten=True))
+    await db.commit()
+
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_upload(
+    upload_id: UUID,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:upload")
+):
+    upload_session = await get_upload_session(db, upload_id, current_user)
+    ensure_pending(upload_session)
+
+    missing = uploads.missing_chunks(upload_session.received, upload_session.total_chunks)
+    if missing:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail={"message": f'Upload {upload_id} is incomplete', "missing_chunks": missing})
+
+    # Only one concurrent completion may move the file
+    result = await db.execute(
+        update(UploadSession)
+        .where(UploadSession.id == upload_id, UploadSession.status == 'pending')
+        .values(status='complete')
+    )
+    if result.rowcount == 0:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f'Upload {upload_id} is already completed')
+
+    digest = await storage.complete_upload(upload_session)
+
+    if upload_session.sha256 and digest != upload_session.sha256:
+        await db.rollback()
+        await db.execute(update(UploadSession).where(UploadSession.id == upload_id).values(status='failed'))
+        await db.commit()
+        await storage.abort_upload(upload_session)
+
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f'Upload {upload_id} does not match its SHA-256')
+
+    # One row per distinct content, concurrent uploads of the same bytes share it
+    blob = (await db.execute(
+        insert(Blob)
+        .values(id=uuid4(), hash=digest, size=upload_session.size,
+                content_type=mimetypes.guess_type(upload_session.filename)[0],
+                created_at=datetime.now())
+        # A corrupted blob is replaced by this upload's bytes below, and verified again
+        .on_conflict_do_update(index_elements=[Blob.hash], set_={"updated_at": func.now(), "corrupted_at": None})
+        .returning(Blob.id, Blob.verified_at)
+    )).first()
+    blob_id = blob.id
+
+    if upload_session.archive_id:
+        await attach_blob(db, upload_session.archive_id, blob_id, upload_session.filename)
+    elif blob.verified_at is None:
+        await processing.enqueue_verification(db, blob_id)
+
+    # A stored file never verified may not hold these bytes, this upload's ones replace it
+    await storage.store_blob(upload_session, digest, replace=blob.verified_at is None)
+    await db.commit()
+
+    await broker.publish("upload.completed", {"upload_id": upload_id, "blob_id": blob_id, "sha256": digest},
+                         f"upload:{upload_id}")
+    if upload_session.archive_id:
+        await publish_content_changed(upload_session.archive_id, blob_id, upload_session.filename)
+
+    return {"blob_id": blob_id, "sha256": digest, "size": upload_session.size}
+
+
+@router.delete("/uploads/{upload_id}")
+async def abort_upload(
+    upload_id: UUID,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("archives:upload")
+):
+    upload_session = await get_upload_session(db, upload_id, current_user)
+    ensure_pending(upload_session)
+
+    upload_session.status = 'aborted'
+    await db.commit()
+    await storage.abort_upload(upload_session)
+
+    return {"message": f"Upload {upload_id} aborted successfully"}
@@ -1,19 +1,37 @@
+from urllib.parse import urlencode
 from uuid import uuid1
 from datetime import datetime
 from typing import Optional
-from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
 from fastapi.responses import JSONResponse
 from pydantic import EmailStr
-from api.core.oauth2 import UserOAuth, write_token, validate_token, get_current_active_user
+from api.core import refresh_tokens, tokens
+from api.core.http_cache import response_cache
+from api.core.oauth2 import (
+    UserOAuth,
+    get_current_active_user,
+    invalidate_principal,
+    oauth2_scheme,
+    principal_claims,
+    validate_token,
+    write_token,
+)
 from api.models import ResetCode, User
 from api.core.hashing import Hash
-from api.core.schemas import ChangePasswordSchema, LoginSchema, RegisterUserAdminSchema, ResetPasswordSchema
-from api.formating import format_user
-from starlette.requests import Request as request
+from api.core.schemas import (
+    ChangePasswordSchema,
+    LoginSchema,
+    RefreshTokenSchema,
+    RegisterUserAdminSchema,
+    ResetPasswordSchema,
+    UserProfile,
+)
+from api.formating import dumps, user_profile_columns
 from api.exceptions import UserNotFoundException
-from sqlalchemy.orm import Session
-from api import database
-from api.mailing import send_forgot_password_mail
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from api import database, mailing
+from api.config import settings
 
 
 router = APIRouter(
@@ -22,9 +40,9 @@ router = APIRouter(
 
 
 @router.post("/auth/login")
-def login(schema: LoginSchema, db: Session = database.session()):
-    user: Optional[User] = db.query(User).filter(
-        User.email == schema.email).first()
+async def login(schema: LoginSchema, db: AsyncSession = database.async_session()):
+    user: Optional[User] = (await db.execute(select(User).where(
+        User.email == schema.email))).scalars().first()
 
     if not user:
         raise HTTPException(
@@ -33,30 +51,84 @@ def login(schema: LoginSchema, db: Session = database.session()):
             headers={"WWW-Authenticate": "Bearer"}
         )
 
-    if not Hash.verify(schema.password, user.hashed_password):
+    verified, new_hash = await Hash.verify_and_update(schema.password, user.hashed_password)
+
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect password",
             headers={"WWW-Authenticate": "Bearer"}
         )
 
-    token: str = write_token({"sub": user.email})
+    # Stored hash uses outdated settings, upgrade it while we have the password
+    if new_hash:
+        await db.execute(update(User).where(User.id == user.id).values(hashed_password=new_hash))
+
+    refresh_token = await refresh_tokens.create(db, user.id)
+    await db.commit()
 
-    return {"access_token": token}
+    token: str = write_token(principal_claims(user))
 
+    return {"access_token": token, "refresh_token": refresh_token}
 
-@router.get("/user/me")
-def get_user_profile(
+
+@router.post("/auth/refresh")
+async def refresh(schema: RefreshTokenSchema, db: AsyncSession = database.async_session()):
+    rotated = await refresh_tokens.rotate(db, schema.refresh_token)
+
+    if not rotated:
+        # Keeps the family revocation when the token was reused
+        await db.commit()
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+    user_id, refresh_token = rotated
+    user = (await db.execute(select(User.id, User.email, User.is_active, User.roles)
+                             .where(User.id == user_id))).first()
+
+    if not user or not user.is_active:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+    await db.commit()
+
+    return {"access_token": write_token(principal_claims(user)), "refresh_token": refresh_token}
+
+
+@router.post("/auth/logout")
+async def logout(token: str = Depends(oauth2_scheme), db: AsyncSession = database.async_session()):
+    claims = validate_token(token, output=True)
+
+    # Tokens without an id expire on their own
+    if claims.get("jti"):
+        await tokens.revoke_token(db, claims)
+        await db.commit()
+
+    return JSONResponse(status_code=status.HTTP_200_OK, content='Logged out successfully.')
+
+
+@router.get("/user/me", response_model=UserProfile)
+async def get_user_profile(
+    request: Request,
     current_user: UserOAuth = Depends(get_current_active_user),
-    db: Session = database.session()
+    db: AsyncSession = database.async_session()
 ):
+    async def build():
+        user = (await db.execute(select(*user_profile_columns).where(User.id == current_user.id))).first()
 
-    user = db.query(User).filter(User.id == current_user.id).first()
+        if not user:
+            raise UserNotFoundException()
 
-    if not user:
-        raise UserNotFoundException()
+        return dumps(dict(user._mapping)), (user.id, user.updated_at)
 
-    return format_user(user)
+    return await response_cache.respond(request, f"user:{current_user.id}", current_user.id, build)
 
 
 @router.post("/auth/verify/token")
@@ -66,14 +138,14 @@ def verify_token(Authorization: str = Header(None)):
 
 
 @router.post('/auth/register/super-admin')
-async def create_user(schema: RegisterUserAdminSchema, db: Session = database.session()):
+async def create_user(schema: RegisterUserAdminSchema, db: AsyncSession = database.async_session()):
 
-    user_exists = db.query(User).filter(User.email == schema.email).first()
+    user_exists = (await db.execute(select(User).where(User.email == schema.email))).scalars().first()
 
     if not user_exists:
         new_user = User(
             email=schema.email,
-            hashed_password=Hash.bcrypt(schema.password),
+            hashed_password=await Hash.bcrypt_async(schema.password),
             firstname=schema.firstname,
             lastname=schema.lastname,
             middlename=schema.middlename,
@@ -82,7 +154,7 @@ async def create_user(schema: RegisterUserAdminSchema, db: Session = database.se
         )
 
         db.add(new_user)
-        db.commit()
+        await db.commit()
 
         return JSONResponse(status_code=status.HTTP_201_CREATED)
 
@@ -95,11 +167,10 @@ async def create_user(schema: RegisterUserAdminSchema, db: Session = database.se
 @router.post('/user/forgot-password')
 async def forgot_password(
     email: EmailStr,
-    background_tasks: BackgroundTasks,
-    db: Session = database.session()
+    db: AsyncSession = database.async_session()
 ):
 
-    user_exists = db.query(User).filter(User.email == email).first()
+    user_exists = (await db.execute(select(User).where(User.email == email))).scalars().first()
 
     if not user_exists:
         raise UserNotFoundException()
@@ -114,61 +185,71 @@ async def forgot_password(
     )
 
     db.add(storedResetCode)
-    db.commit()
 
-    # Send emai
-    background_tasks(send_email, email, reset_code)
+    # Queued in the same transaction, the worker sends it
+    queued = await mailing.queue_mail(db, email, "forgot_password", {
+        "name": user_exists.firstname,
+        "link": f"{settings.APP_BASE_URL}/user/reset-password?{urlencode({'reset_password_token': reset_code})}",
+    })
+
+    if not queued:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail='Too many password reset requests, try again later',
+            headers={"Retry-After": str(settings.MAIL_RECIPIENT_WINDOW)},
+        )
+
+    await db.commit()
 
     return JSONResponse(status_code=status.HTTP_200_OK)
 
 
 @router.put('/user/reset-password')
-async def reset_password(schema: ResetPasswordSchema, db: Session = database.session()):
+async def reset_password(schema: ResetPasswordSchema, db: AsyncSession = database.async_session()):
 
     # Check if passwords matches
-    if (schema.new_password is not schema.confirm_password):
+    if schema.new_password != schema.confirm_password:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail='Password not match'
         )
 
-    # Reset code query
-    reset_code_query = (db.query(ResetCode)
-                        .filter(ResetCode.reset_code == schema.reset_password_token))
-
-    # Rest code object
-    reset_code: Optional[ResetCode] = reset_code_query.first()
+    valid_code = (ResetCode.reset_code == schema.reset_password_token,
+                  ResetCode.expires_in > datetime.now(),
+                  ResetCode.deleted_at.is_(None))
 
-    # Check if reset code doesn't exist
-    if not reset_code:
+    # bcrypt only runs for a valid code, and outside any transaction
+    if (await db.execute(select(ResetCode.id).where(*valid_code))).first() is None:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail='Reset password token expired'
         )
+    await db.commit()
 
-    # check if expiration date is expired
-    if datetime.now() > reset_code.expires_in:
+    hashed_password = await Hash.bcrypt_async(schema.new_password)
+
+    # Consumed and applied in one statement, of two requests with the same code only one finds it
+    consumed = delete(ResetCode).where(*valid_code).returning(ResetCode.email).cte("consumed")
+    user = (await db.execute(
+        update(User)
+        .where(User.email == consumed.c.email, User.deleted_at.is_(None))
+        .values(hashed_password=hashed_password)
+        .returning(User.id, User.email)
+        .execution_options(synchronize_session=False)
+    )).first()
+
+    if not user:
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail='Reset password token expired'
         )
 
-    # User query
-    user_query = (db.query(User)
-                    .filter(User.email == reset_code.email))
-    # User object
-    user: Optional[User] = user_query.first()
-
-    if not user:
-        raise UserNotFoundException()
-
-    user_query.update({
-        "hashed_password": Hash.bcrypt(schema.new_password)
-    }, synchronize_session=False)
-
-    reset_code_query.delete(synchronize_session=False)
+    await tokens.revoke_user(db, user.id)
 
-    db.commit()
+    await db.commit()
+    await invalidate_principal(user.email)
+    await response_cache.invalidate(f"user:{user.id}")
 
     return JSONResponse(
         status_code=status.HTTP_200_OK,
@@ -177,19 +258,22 @@ async def reset_password(schema: ResetPasswordSchema, db: Session = database.ses
 
 
 @router.delete('/user/profile')
-async def deactivate_account(current_user: UserOAuth = Depends(get_current_active_user), db: Session = database.session()):
-    # User query
-    user_query = (db.query(User)
-                    .filter(User.id == current_user.id))
-    # User object
-    user: Optional[User] = user_query.first()
-
-    if not user:
+async def deactivate_account(current_user: UserOAuth = Depends(get_current_active_user), db: AsyncSession = database.async_session()):
+    deactivated = (await db.execute(
+        update(User)
+        .where(User.id == current_user.id, User.deleted_at.is_(None))
+        .values(is_active=False)
+        .returning(User.id)
+    )).first()
+
+    if not deactivated:
         raise UserNotFoundException()
 
-    user_query.update({"is_active": False}, synchronize_session=False)
+    await tokens.revoke_user(db, current_user.id)
 
-    db.commit()
+    await db.commit()
+    await invalidate_principal(current_user.email)
+    await response_cache.invalidate(f"user:{current_user.id}")
 
     return JSONResponse(
         status_code=status.HTTP_200_OK,
@@ -198,59 +282,50 @@ async def deactivate_account(current_user: UserOAuth = Depends(get_current_activ
 
 
 @router.put('/user/change-password')
-async def change_password(schema: ChangePasswordSchema, current_user: UserOAuth = Depends(get_current_active_user), db: Session = database.session()):
+async def change_password(schema: ChangePasswordSchema, current_user: UserOAuth = Depends(get_current_active_user), db: AsyncSession = database.async_session()):
     if (schema.new_password != schema.confirm_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail='Password not match'
         )
 
-    # User query
-    user_query = (db.query(User)
-                    .filter(User.id == current_user.id))
-    # User object
-    user: Optional[User] = user_query.first()
+    # Only the hash is needed to check the current password
+    hashed_password = (await db.execute(select(User.hashed_password)
+                                        .where(User.id == current_user.id))).scalar_one_or_none()
 
-    if not user:
+    if hashed_password is None:
         raise UserNotFoundException()
 
-    if not Hash.verify(schema.current_password, user.hashed_password):
+    if not await Hash.verify_async(schema.current_password, hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect password",
         )
 
-    user_query.update({
-        "hashed_password": Hash.bcrypt(schema.new_password)
-    }, synchronize_session=False)
+    # Release the connection while bcrypt runs, the update below checks nothing changed meanwhile
+    await db.commit()
+    new_hash = await Hash.bcrypt_async(schema.new_password)
+
+    changed = (await db.execute(
+        update(User)
+        .where(User.id == current_user.id, User.hashed_password == hashed_password)
+        .values(hashed_password=new_hash)
+        .returning(User.id)
+    )).first()
+
+    if not changed:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail='Password was changed concurrently, try again',
+        )
+
+    await tokens.revoke_user(db, current_user.id)
 
-    db.commit()
+    await db.commit()
+    await invalidate_principal(current_user.email)
+    await response_cache.invalidate(f"user:{current_user.id}")
 
     return JSONResponse(
         status_code=status.HTTP_200_OK,
         content='Your password has been changed successfully.'
     )
-
-
-async def send_email(email: EmailStr, reset_code: str):
-    # Mailjet Email API
-    message = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Reset password</title>
-        </head>
-        <body>
-            <div style="width: 100%;font-family: monospace;">
-                <h1>Hello, {0:}</h1>
-                <p>Someone has requested a link to reset your password. If you requested this, you can change your password through the following link <br>
-                <a href="{1:}/user/reset-password?reset_password_token={2:}" style="box-sizing: border-box;text-decoration: underline;">Reset password</a>
-                </p>
-                <p>If you didn't request this, you can ignore this email.</p>
-                <p>Your password won't chamge until you access the link above and create a new</p>
-            </div>
-        </body>
-        </html>
-    """.format(email, request.base_url, reset_code)
-
-    await send_forgot_password_mail(email, message)
@@ -0,0 +1,171 @@
+import asyncio
+from time import time
+from typing import Optional, Set
+from uuid import UUID
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, status
+from sqlalchemy import select
+import orjson
+
+from api import database
+from api.config import settings
+from api.core import tokens
+from api.core.oauth2 import get_current_user, validate_token
+from api.core.permissions import permission_map
+from api.core.schemas import UserOAuth
+from api.formating import dumps
+from api.models import UploadSession
+from api.realtime import broker, connected_clients
+
+
+router = APIRouter(
+    tags=['Realtime']
+)
+
+# Topics without an id and the kinds of topics that take one
+BROADCAST_TOPICS = {"archives", "workspaces"}
+KEYED_TOPICS = {"archive", "upload"}
+# Events of a topic are only sent to users allowed to read them
+TOPIC_PERMISSIONS = {
+    "archives": "archives:read",
+    "archive": "archives:read",
+    "upload": "archives:upload",
+    "workspaces": "workspaces:read",
+}
+
+
+async def authenticate(token: Optional[str]) -> Optional[UserOAuth]:
+    if not token:
+        return None
+
+    try:
+        validate_token(token)
+        # Short lived session, the socket must not hold a pooled connection
+        async with database.AsyncSessionLocal() as db:
+            current_user = await get_current_user(token, db)
+    except HTTPException:
+        return None
+
+    return current_user if current_user.is_active else None
+
+
+def token_check_delay(token: str) -> float:
+    '''
+    Seconds until the token is checked again: at the latest when it expires,
+    otherwise after REALTIME_TOKEN_CHECK_INTERVAL to catch revocations.
+    '''
+    expires_at = tokens.verify(token).get("exp", float("inf"))
+    return max(0.0, min(settings.REALTIME_TOKEN_CHECK_INTERVAL, expires_at - time()))
+
+
+async def can_subscribe(topic: str, current_user: UserOAuth) -> bool:
+    kind, _, key = topic.partition(":")
+    permission = TOPIC_PERMISSIONS.get(kind)
+    if permission is None or not await permission_map.allows(current_user.roles, permission):
+        return False
+
+    if topic in BROADCAST_TOPICS:
+        return True
+
+    if kind not in KEYED_TOPICS:
+        return False
+
+    try:
+        key = UUID(key)
+    except ValueError:
+        return False
+
+    if kind != "upload":
+        return True
+
+    # Upload progress is only for the uploader
+    async with database.AsyncSessionLocal() as db:
+        upload = (await db.execute(select(UploadSession.id)
+                                   .where(UploadSession.id == key,
+                                          UploadSession.author_id == current_user.id))).first()
+    return upload is not None
+
+
+async def send_events(websocket: WebSocket, queue: asyncio.Queue):
+    # Single writer, replies and events never interleave on the socket
+    while True:
+        await websocket.send_text(await queue.get())
+
+
+async def reply(queue: asyncio.Queue, event: str, **data):
+    await queue.put(dumps({"event": event, **data}))
+
+
+@router.websocket("/ws")
+async def realtime(websocket: WebSocket, token: Optional[str] = None):
+    '''
+    Connect with ?token=<access token>, then send
+    {"action": "subscribe", "topic": "archives"} or "workspaces", "archive:<id>", "upload:<id>".
+    '''
+    current_user = await authenticate(token)
+    if current_user is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    connected_clients.inc()
+
+    queue = asyncio.Queue(maxsize=settings.REALTIME_QUEUE_SIZE)
+    topics: Set[str] = set()
+    sender = asyncio.create_task(send_events(websocket, queue))
+
+    try:
+        while True:
+            # Checked between messages and at least every REALTIME_TOKEN_CHECK_INTERVAL while
+            # idle, the socket is closed once its token expires or is revoked
+            try:
+                delay = token_check_delay(token)
+            except tokens.TokenError as e:
+                sender.cancel()
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+                break
+
+            try:
+                frame = await asyncio.wait_for(websocket.receive(), delay)
+            except asyncio.TimeoutError:
+                continue
+
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000), frame.get("reason"))
+            if frame.get("text") is None:
+                await reply(queue, "error", detail="Expected a text frame")
+                continue
+
+            try:
+                message = orjson.loads(frame["text"])
+                action, topic = message["action"], str(message["topic"])
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                await reply(queue, "error", detail="Expected {\"action\": ..., \"topic\": ...}")
+                continue
+
+            if action == "subscribe":
+                if topic in topics:
+                    await reply(queue, "subscribed", topic=topic)
+                elif len(topics) >= settings.REALTIME_MAX_SUBSCRIPTIONS:
+                    await reply(queue, "error", topic=topic, detail="Too many subscriptions")
+                elif not await can_subscribe(topic, current_user):
+                    await reply(queue, "error", topic=topic, detail=f'Topic {topic} not found')
+                else:
+                    topics.add(topic)
+                    broker.subscribe(topic, queue)
+                    await reply(queue, "subscribed", topic=topic)
+
+            elif action == "unsubscribe":
+                topics.discard(topic)
+                broker.unsubscribe(topic, queue)
+                await reply(queue, "unsubscribed", topic=topic)
+
+            else:
+                await reply(queue, "error", detail=f'Unknown action {action}')
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        for topic in topics:
+            broker.unsubscribe(topic, queue)
+        connected_clients.dec()
@@ -1,12 +1,16 @@
 from datetime import datetime
 from typing import Optional
 from uuid import UUID
-from fastapi import APIRouter, HTTPException, status
-from pydantic import ValidationError
-from api.core.schemas import CreateWorkspace
+from fastapi import APIRouter, HTTPException, Query, Request, status
+from api.config import settings
+from api.core.http_cache import response_cache
+from api.core.permissions import require_permission
+from api.core.schemas import CreateWorkspace, UserOAuth, WorkspaceOut, WorkspacePage
 from api.models import Workspace
-from sqlalchemy.orm import Session
-from api import database
+from api.realtime import broker
+from sqlalchemy import insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from api import database, formating, pagination
 
 
 router = APIRouter(
@@ -14,38 +18,76 @@ router = APIRouter(
 )
 
 
-@router.get("/workspaces")
-def all_workspaces(q: Optional[str] = None, db: Session = database.session()):
-    workspaces = db.query(Workspace).all()
-    return workspaces
+@router.get("/workspaces", response_model=WorkspacePage)
+async def all_workspaces(
+    request: Request,
+    q: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=settings.PAGINATION_MAX_LIMIT),
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("workspaces:read")
+):
+    async def build():
+        # Served by the partial (created_at, id) index on live workspaces
+        workspaces_query = (select(*formating.workspace_columns)
+                            .where(Workspace.deleted_at.is_(None)))
+        if q:
+            workspaces_query = workspaces_query.where(or_(
+                Workspace.name.icontains(q),
+                Workspace.slug.icontains(q),
+                Workspace.description.icontains(q),
+            ))
 
+        rows = (await db.execute(pagination.paginate(
+            workspaces_query, Workspace.created_at, Workspace.id, cursor, limit))).all()
+        workspaces, next_cursor = pagination.next_page(rows, limit)
 
-@router.get("/workspaces/{workspace_id}")
-def read_archive(workspace_id: UUID, db: Session = database.session()):
-    workspace = (db.query(Workspace)
-                 .filter(Workspace.id == workspace_id)
-                 .first())
+        content = formating.dumps({
+            "items": formating.as_dicts(workspaces),
+            "next_cursor": next_cursor,
+        })
+        return content, (next_cursor, [(workspace.id, workspace.updated_at) for workspace in workspaces])
 
-    if not workspace:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'Workspace {workspace_id} not found')
+    return await response_cache.respond(request, "workspaces", current_user.id, build)
 
-    return workspace
+
+@router.get("/workspaces/{workspace_id}", response_model=WorkspaceOut)
+async def read_archive(
+    workspace_id: UUID,
+    request: Request,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("workspaces:read")
+):
+    async def build():
+        workspace = (await db.execute(select(*formating.workspace_columns)
+                                      .where(Workspace.id == workspace_id))).first()
+
+        if not workspace:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'Workspace {workspace_id} not found')
+
+        return formating.dumps(dict(workspace._mapping)), (workspace.id, workspace.updated_at)
+
+    return await response_cache.respond(request, "workspaces", current_user.id, build)
 
 
 @router.post('/workspaces')
-async def create_workspace(create_workspace: CreateWorkspace, db: Session = database.session()):
-    try:
-        new_workspace = Workspace(
+async def create_workspace(
+    create_workspace: CreateWorkspace,
+    db: AsyncSession = database.async_session(),
+    current_user: UserOAuth = require_permission("workspaces:create")
+):
+    workspace_id = (await db.execute(
+        insert(Workspace)
+        .values(
             name=create_workspace.title,
             description=create_workspace.description,
             created_at=datetime.now(),
         )
-        db.add(new_workspace)
-        db.commit()
-        db.refresh(new_workspace)
-        return {"message": f"Workspace created successfully {new_workspace.pk}"}
-
-    except ValidationError as e:
-        print(e)
-        raise HTTPException(status_code=500, detail='Internal server error')
+        .returning(Workspace.id)
+    )).scalar_one()
+    await db.commit()
+
+    await response_cache.invalidate("workspaces")
+    await broker.publish("workspace.created", {"id": workspace_id, "name": create_workspace.title}, "workspaces")
+    return {"message": f"Workspace created successfully {workspace_id}"}
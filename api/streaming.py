@@ -0,0 +1,145 @@
+import os
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional, Tuple
+from urllib.parse import quote
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+
+# Large enough to keep syscalls rare, small enough to start sending quickly
+CHUNK_SIZE = 256 * 1024
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    '''
+    Single "bytes=" range as an inclusive (start, end).
+    None means serve the whole file; several ranges are served whole too.
+    '''
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+
+    if start >= size or start > end:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers={"Content-Range": f"bytes */{size}"})
+
+    return start, min(end, size - 1)
+
+
+def not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+class FileRangeResponse(Response):
+    '''
+    Stream a byte range of a file, with zero-copy sendfile when the server
+    offers the ASGI "http.response.zerocopy" extension.
+    '''
+    def __init__(self, file_path: str, start: int, end: int, status_code: int, headers: dict,
+                 media_type: Optional[str] = None) -> None:
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.file_path = file_path
+        self.start = start
+        self.length = end - start + 1
+        self.headers["content-length"] = str(self.length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # Opened before the headers go out, a missing or truncated file still gets a proper error
+        try:
+            fd = await run_in_threadpool(os.open, self.file_path, os.O_RDONLY)
+        except FileNotFoundError:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Content not found')
+
+        try:
+            if (await run_in_threadpool(os.fstat, fd)).st_size < self.start + self.length:
+                raise RuntimeError(f'{self.file_path} is shorter than its recorded size')
+
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            })
+
+            if scope["method"] == "HEAD":
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            if "http.response.zerocopy" in scope.get("extensions", {}):
+                with open(fd, "rb", closefd=False) as file:
+                    await send({
+                        "type": "http.response.zerocopy",
+                        "file": file,
+                        "offset": self.start,
+                        "count": self.length,
+                        "more_body": False,
+                    })
+                return
+
+            offset, remaining = self.start, self.length
+            while remaining > 0:
+                data = await run_in_threadpool(os.pread, fd, min(CHUNK_SIZE, remaining), offset)
+                if not data:
+                    break
+                offset += len(data)
+                remaining -= len(data)
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            os.close(fd)
+
+
+def file_response(request: Request, file_path: str, size: int, etag: str, last_modified: datetime,
+                  filename: Optional[str] = None, media_type: Optional[str] = None) -> Response:
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "last-modified": format_datetime(last_modified.astimezone(timezone.utc), usegmt=True),
+        # Private content, always revalidated, which is cheap thanks to the ETag
+        "cache-control": "private, no-cache",
+    }
+
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if filename:
+        headers["content-disposition"] = f"inline; filename*=UTF-8''{quote(filename)}"
+
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if size and (if_range is None or if_range == etag):
+        byte_range = parse_range(request.headers.get("range"), size)
+
+    if byte_range is None:
+        return FileRangeResponse(file_path, 0, size - 1, status.HTTP_200_OK, headers, media_type)
+
+    start, end = byte_range
+    headers["content-range"] = f"bytes {start}-{end}/{size}"
+    return FileRangeResponse(file_path, start, end, status.HTTP_206_PARTIAL_CONTENT, headers, media_type)
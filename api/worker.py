@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import signal
+from concurrent.futures import ProcessPoolExecutor
+
+from api import jobs, mailing, maintenance, processing  # noqa: F401, importing registers the handlers
+from api.config import settings
+from api.database import AsyncSessionLocal, async_engine
+
+logger = logging.getLogger("api.worker")
+
+
+async def work(stop: asyncio.Event):
+    while not stop.is_set():
+        await maintenance.run_due_tasks()
+
+        try:
+            outcomes = await jobs.run_due(AsyncSessionLocal, settings.JOB_CONCURRENCY)
+        except Exception:
+            logger.exception("Could not claim jobs")
+            outcomes = []
+
+        try:
+            mails = await mailing.deliver_due(AsyncSessionLocal, settings.MAIL_BATCH_SIZE)
+        except Exception:
+            logger.exception("Could not deliver mails")
+            mails = 0
+
+        # Keep draining while there is work, poll once the queues are empty
+        if not outcomes and not mails:
+            try:
+                await asyncio.wait_for(stop.wait(), settings.JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    if settings.SMTP_HOST is None and not settings.MAIL_LOG_ONLY:
+        logger.warning("SMTP_HOST is not set, mails stay queued. Set MAIL_LOG_ONLY to only log them")
+
+    if not settings.CACHE_URL and settings.REALTIME_BACKEND != "postgres":
+        logger.warning("Jobs cannot invalidate the API's response cache, archives may be served stale for "
+                       "%s seconds. Set CACHE_URL or REALTIME_BACKEND=postgres", settings.RESPONSE_CACHE_TTL)
+
+    with ProcessPoolExecutor(settings.JOB_PROCESSES) as executor:
+        jobs.cpu_executor = executor
+        logger.info("Worker started with %s processes", settings.JOB_PROCESSES)
+        try:
+            await work(stop)
+        finally:
+            jobs.cpu_executor = None
+            mailing.smtp.close()
+            await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
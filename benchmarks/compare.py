@@ -0,0 +1,55 @@
+'''
+Compare two result files of the same suite, e.g. the main branch against a change.
+Exits with 1 when a benchmark got slower than the threshold or runs more queries.
+
+    python -m benchmarks.compare benchmarks/results/load-abc1234.json benchmarks/results/load-def5678.json
+'''
+import argparse
+import json
+import sys
+
+
+def load(file_path: str) -> dict:
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed p50 slowdown, 0.10 is 10%%")
+    parser.add_argument("--metric", default="p50", choices=("mean", "p50", "p95", "p99"))
+    args = parser.parse_args()
+
+    base, head = load(args.base), load(args.head)
+    if base["suite"] != head["suite"]:
+        sys.exit(f"Cannot compare a {base['suite']} run with a {head['suite']} run")
+
+    print(f"{base['environment']['commit']} -> {head['environment']['commit']}, {args.metric}")
+    print(f"{'benchmark':<40} {'base ms':>10} {'head ms':>10} {'change':>8}")
+
+    regressions = []
+    for name, result in head["benchmarks"].items():
+        previous = base["benchmarks"].get(name)
+        if previous is None:
+            print(f"{name:<40} {'':>10} {result[args.metric] * 1000:>10.3f} {'new':>8}")
+            continue
+
+        change = result[args.metric] / previous[args.metric] - 1 if previous[args.metric] else 0.0
+        print(f"{name:<40} {previous[args.metric] * 1000:>10.3f} {result[args.metric] * 1000:>10.3f} {change:>+8.1%}")
+
+        if change > args.threshold:
+            regressions.append(f"{name} is {change:.1%} slower")
+        # Query counts are exact, any increase is a regression
+        if result.get("queries_per_request", 0) > previous.get("queries_per_request", 0):
+            regressions.append(f"{name} runs {previous['queries_per_request']:.2f} -> "
+                               f"{result['queries_per_request']:.2f} queries per request")
+
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+'''
+HTTP load driver, httpx against the app in-process (no network, no uvicorn).
+Needs a seeded database, see benchmarks.seed.
+
+    python -m benchmarks.load [--only login] [--requests 500] [--concurrency 16] [--output results.json]
+
+Every scenario reports latency, throughput, errors and the SQL statements per
+request, read from the app's own instrumentation.
+'''
+import argparse
+import asyncio
+import os
+from time import perf_counter
+from typing import Awaitable, Callable, Dict
+
+import httpx
+
+from api import instrumentation
+from api.config import settings
+from api.main import app
+from benchmarks.results import print_table, summarize, write_results
+from benchmarks.seed import BENCHMARK_EMAIL, BENCHMARK_PASSWORD
+
+
+UPLOAD_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+Scenario = Callable[[httpx.AsyncClient, dict], Awaitable[None]]
+
+
+def check(response: httpx.Response) -> httpx.Response:
+    if response.is_error:
+        raise RuntimeError(f"{response.request.method} {response.request.url.path}: "
+                           f"{response.status_code} {response.text[:200]}")
+    return response
+
+
+async def login(client: httpx.AsyncClient, context: dict):
+    check(await client.post("/api/v1/auth/login", json={"email": BENCHMARK_EMAIL, "password": BENCHMARK_PASSWORD}))
+
+
+async def me(client: httpx.AsyncClient, context: dict):
+    check(await client.get("/api/v1/user/me", headers=context["headers"]))
+
+
+async def archives(client: httpx.AsyncClient, context: dict):
+    check(await client.get("/api/v1/archives/", params={"limit": 20}, headers=context["headers"]))
+
+
+async def upload(client: httpx.AsyncClient, context: dict):
+    # Fresh bytes every time, identical content would skip the upload
+    content = os.urandom(UPLOAD_SIZE)
+    session = check(await client.post("/api/v1/archives/uploads", headers=context["headers"], json={
+        "name": "benchmark.bin", "size": UPLOAD_SIZE, "chunk_size": UPLOAD_CHUNK_SIZE,
+    })).json()
+
+    for index in range(session["total_chunks"]):
+        offset = index * UPLOAD_CHUNK_SIZE
+        check(await client.put(f"/api/v1/archives/uploads/{session['upload_id']}/chunks/{index}",
+                               content=content[offset:offset + UPLOAD_CHUNK_SIZE], headers=context["headers"]))
+
+    check(await client.post(f"/api/v1/archives/uploads/{session['upload_id']}/complete", headers=context["headers"]))
+
+
+scenarios: Dict[str, Scenario] = {
+    "login": login,
+    "me": me,
+    "archives": archives,
+    "upload": upload,
+}
+
+
+def query_totals():
+    # Summed over every route, the deltas give statements per request
+    children = instrumentation.request_queries.children.values()
+    return sum(child.sum for child in children), sum(child.count for child in children)
+
+
+async def run(scenario: Scenario, client: httpx.AsyncClient, context: dict, requests: int, concurrency: int) -> dict:
+    samples = []
+    errors = []
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started_at = perf_counter()
+            try:
+                await scenario(client, context)
+            except Exception as e:
+                errors.append(str(e))
+            else:
+                samples.append(perf_counter() - started_at)
+
+    queries_before, requests_before = query_totals()
+    started_at = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = perf_counter() - started_at
+    queries_after, requests_after = query_totals()
+
+    http_requests = requests_after - requests_before
+    return summarize(
+        samples, elapsed,
+        errors=len(errors),
+        first_error=errors[0] if errors else None,
+        concurrency=concurrency,
+        http_requests=http_requests,
+        queries_per_request=(queries_after - queries_before) / http_requests if http_requests else 0.0,
+    )
+
+
+async def main_async(args) -> Dict[str, dict]:
+    await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            tokens = check(await client.post("/api/v1/auth/login", json={
+                "email": BENCHMARK_EMAIL, "password": BENCHMARK_PASSWORD,
+            })).json()
+            context = {"headers": {"Authorization": f"Bearer {tokens['access_token']}"}}
+
+            results = {}
+            for name in args.only or scenarios:
+                # Logins are bcrypt bound, a full run of them would dominate the suite
+                requests = max(1, args.requests // 10) if name in ("login", "upload") else args.requests
+                for _ in range(args.warmup):
+                    await scenarios[name](client, context)
+                results[f"http.{name}"] = await run(scenarios[name], client, context, requests, args.concurrency)
+            return results
+    finally:
+        await app.router.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", action="append", choices=sorted(scenarios), help="Run only these scenarios")
+    parser.add_argument("--requests", type=int, default=1000, help="Per scenario, a tenth for login and upload")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--output", help="Result file, defaults to benchmarks/results/load-<commit>.json")
+    args = parser.parse_args()
+
+    benchmarks = asyncio.run(main_async(args))
+
+    print_table(benchmarks)
+    for name, result in benchmarks.items():
+        if result["errors"]:
+            print(f"{name}: {result['errors']} errors, first: {result['first_error']}")
+    print(write_results("load", benchmarks, args.output, requests=args.requests, concurrency=args.concurrency,
+                        db_pool_size=settings.DB_POOL_SIZE, hash_workers=settings.HASH_WORKERS))
+
+
+if __name__ == "__main__":
+    main()
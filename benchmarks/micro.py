@@ -0,0 +1,163 @@
+'''
+Micro-benchmarks of the hot paths that need no database:
+password hashing, token issue/validation, archive formatting and chunk assembly.
+
+    python -m benchmarks.micro [--only tokens] [--scale 0.1] [--output results.json]
+'''
+import argparse
+import asyncio
+import os
+import tempfile
+from datetime import datetime
+from time import perf_counter
+from types import SimpleNamespace
+from typing import AsyncIterator, Dict
+from uuid import uuid4
+
+from fastapi.responses import ORJSONResponse
+
+from api import formating
+from api.config import settings
+from api.core import uploads
+from api.core.hashing import Hash
+from api.core.oauth2 import principal_claims, validate_token, write_token
+from api.models import Archive, UploadSession, User
+from benchmarks.results import measure, measure_async, print_table, summarize, write_results
+
+
+MiB = 1024 * 1024
+# Typical size of a network read handed to write_chunk
+STREAM_PIECE_SIZE = 64 * 1024
+
+
+def bench_hash(scale: float) -> Dict[str, dict]:
+    # Uses BCRYPT_ROUNDS like production, a few samples are enough
+    hashed = Hash.bcrypt("benchmark-password")
+    repeat = max(3, int(20 * scale))
+
+    async def concurrent_verify():
+        # A login burst, bounded by the hash pool
+        calls = settings.HASH_WORKERS * 4
+
+        async def timed():
+            started_at = perf_counter()
+            await Hash.verify_async("benchmark-password", hashed)
+            return perf_counter() - started_at
+
+        started_at = perf_counter()
+        samples = await asyncio.gather(*(timed() for _ in range(calls)))
+        return summarize(samples, perf_counter() - started_at, workers=settings.HASH_WORKERS)
+
+    return {
+        "hash.bcrypt": measure(Hash.bcrypt, "benchmark-password", repeat=repeat, warmup=1),
+        "hash.verify": measure(Hash.verify, "benchmark-password", hashed, repeat=repeat, warmup=1),
+        "hash.verify_async.concurrent": asyncio.run(concurrent_verify()),
+    }
+
+
+def bench_tokens(scale: float) -> Dict[str, dict]:
+    user = SimpleNamespace(id=uuid4(), email="benchmark@example.com", is_active=True, roles=["super_admin"])
+    claims = principal_claims(user)
+    token = write_token(claims)
+    repeat = max(100, int(10000 * scale))
+
+    return {
+        "tokens.write_token": measure(write_token, claims, repeat=repeat),
+        "tokens.validate_token": measure(validate_token, token, True, repeat=repeat),
+    }
+
+
+def bench_formating(scale: float) -> Dict[str, dict]:
+    now = datetime.now()
+    author = User(id=uuid4(), email="benchmark@example.com", firstname="Ada", lastname="Lovelace", created_at=now)
+    archives = [
+        Archive(id=uuid4(), title=f"Archive {i}", description="Lorem ipsum dolor sit amet " * 8,
+                author_id=author.id, author=author, processing_status="ready", created_at=now, updated_at=now)
+        for i in range(100)
+    ]
+    # What a listing page hands to the response: plain dicts, serialized by orjson
+    page = [dict(zip((column.key for column in formating.archive_columns),
+                     (getattr(archive, column.key) for column in formating.archive_columns)))
+            for archive in archives]
+    repeat = max(100, int(10000 * scale))
+
+    return {
+        "formating.format_author": measure(formating.format_author, author, repeat=repeat),
+        "formating.format_archive": measure(formating.format_archive, archives[0], repeat=repeat),
+        "formating.archive_page_100": measure(
+            lambda: ORJSONResponse({"items": page, "next_cursor": None, "total": None}), repeat=repeat // 10),
+    }
+
+
+async def stream(data: memoryview) -> AsyncIterator[bytes]:
+    for start in range(0, len(data), STREAM_PIECE_SIZE):
+        yield bytes(data[start:start + STREAM_PIECE_SIZE])
+
+
+async def assemble(content: memoryview, chunk_size: int, reverse: bool) -> str:
+    '''
+    The chunk path of an upload without HTTP or SQL:
+    preallocate, write every chunk, advance the running hash, then finish it.
+    '''
+    upload_session = UploadSession(id=uuid4(), size=len(content), chunk_size=chunk_size,
+                                   total_chunks=uploads.count_chunks(len(content), chunk_size))
+    file_path = uploads.temp_path(upload_session.id)
+    bitmap = bytearray(uploads.empty_bitmap(upload_session.total_chunks))
+
+    uploads.preallocate(file_path, upload_session.size)
+    try:
+        indexes = range(upload_session.total_chunks)
+        for index in (reversed(indexes) if reverse else indexes):
+            offset, length = uploads.chunk_bounds(upload_session, index)
+            await uploads.write_chunk(file_path, offset, length, stream(content[offset:offset + length]),
+                                      uploads.claim_hash(upload_session.id, offset))
+            bitmap[index >> 3] |= 1 << (index & 7)
+            await uploads.advance_hash(upload_session, bytes(bitmap))
+
+        return uploads.finish_hash(upload_session)
+    finally:
+        uploads.discard(upload_session.id)
+
+
+def bench_uploads(scale: float) -> Dict[str, dict]:
+    size = max(MiB, int(64 * MiB * scale))
+    chunk_size = min(settings.UPLOAD_CHUNK_SIZE, size)
+    content = memoryview(os.urandom(size))
+    repeat = max(3, int(10 * scale))
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        uploads.upload_directory = directory
+        for name, reverse in (("uploads.assemble.in_order", False), ("uploads.assemble.reverse", True)):
+            result = asyncio.run(measure_async(assemble, content, chunk_size, reverse, repeat=repeat, warmup=1))
+            result.update(size=size, chunk_size=chunk_size, mib_per_second=size / MiB / result["p50"])
+            results[name] = result
+
+    return results
+
+
+suites = {
+    "hash": bench_hash,
+    "tokens": bench_tokens,
+    "formating": bench_formating,
+    "uploads": bench_uploads,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", action="append", choices=sorted(suites), help="Run only these suites")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for repetitions and upload size")
+    parser.add_argument("--output", help="Result file, defaults to benchmarks/results/micro-<commit>.json")
+    args = parser.parse_args()
+
+    benchmarks = {}
+    for name in args.only or suites:
+        benchmarks.update(suites[name](args.scale))
+
+    print_table(benchmarks)
+    print(write_results("micro", benchmarks, args.output, scale=args.scale, bcrypt_rounds=settings.BCRYPT_ROUNDS))
+
+
+if __name__ == "__main__":
+    main()
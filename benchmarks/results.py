@@ -0,0 +1,104 @@
+'''
+Timing helpers and JSON result files shared by the benchmark scripts.
+'''
+import json
+import os
+import platform
+import subprocess
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+results_directory = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples: List[float], elapsed: Optional[float] = None, **extra) -> dict:
+    '''
+    Latency statistics in seconds; throughput over elapsed, or over the summed samples.
+    '''
+    ordered = sorted(samples)
+    elapsed = elapsed if elapsed is not None else sum(ordered)
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) if ordered else 0.0,
+        "min": ordered[0] if ordered else 0.0,
+        "p50": percentile(ordered, 0.50),
+        "p95": percentile(ordered, 0.95),
+        "p99": percentile(ordered, 0.99),
+        "max": ordered[-1] if ordered else 0.0,
+        "ops_per_second": len(ordered) / elapsed if elapsed else 0.0,
+        **extra,
+    }
+
+
+def measure(func: Callable, *args, repeat: int = 1000, warmup: int = 10) -> dict:
+    for _ in range(warmup):
+        func(*args)
+
+    samples = []
+    for _ in range(repeat):
+        started_at = perf_counter()
+        func(*args)
+        samples.append(perf_counter() - started_at)
+    return summarize(samples)
+
+
+async def measure_async(func: Callable[..., Awaitable], *args, repeat: int = 1000, warmup: int = 10) -> dict:
+    for _ in range(warmup):
+        await func(*args)
+
+    samples = []
+    for _ in range(repeat):
+        started_at = perf_counter()
+        await func(*args)
+        samples.append(perf_counter() - started_at)
+    return summarize(samples)
+
+
+def git(*args) -> Optional[str]:
+    try:
+        return subprocess.run(("git", *args), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> dict:
+    # Enough to tell whether two result files are comparable
+    return {
+        "commit": git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def write_results(suite: str, benchmarks: Dict[str, dict], output: Optional[str] = None, **parameters) -> str:
+    '''
+    Write {"suite", "environment", "parameters", "benchmarks"} and return the path,
+    benchmarks/results/<suite>-<commit>.json unless output is given.
+    '''
+    env = environment()
+    if output is None:
+        os.makedirs(results_directory, exist_ok=True)
+        output = os.path.join(results_directory, f"{suite}-{env['commit'] or 'unknown'}.json")
+
+    with open(output, "w") as f:
+        json.dump({"suite": suite, "environment": env, "parameters": parameters, "benchmarks": benchmarks},
+                  f, indent=2, sort_keys=True)
+    return output
+
+
+def print_table(benchmarks: Dict[str, dict]):
+    print(f"{'benchmark':<40} {'count':>8} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/s':>12}")
+    for name, result in benchmarks.items():
+        print(f"{name:<40} {result['count']:>8} {result['p50'] * 1000:>10.3f} {result['p95'] * 1000:>10.3f} "
+              f"{result['p99'] * 1000:>10.3f} {result['ops_per_second']:>12.1f}")
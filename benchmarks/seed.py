@@ -0,0 +1,140 @@
+'''
+Deterministic benchmark data, loaded with COPY into the database configured by DB_*.
+Use a dedicated database: --reset truncates users and everything that references them.
+
+    python -m benchmarks.seed --scale 10k|1m|10m [--reset] [--migrate]
+
+A scale seeds that many archives and a tenth as many users. The first user is
+BENCHMARK_EMAIL / BENCHMARK_PASSWORD with the super_admin role, for the load driver.
+'''
+import argparse
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from time import perf_counter
+from typing import Iterable, Iterator, Tuple
+from uuid import UUID
+
+import asyncpg
+
+from api.config import settings
+from api.core.hashing import Hash
+
+
+SCALES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+BENCHMARK_EMAIL = "benchmark@example.com"
+BENCHMARK_PASSWORD = "benchmark-password"
+
+# Rows per COPY, bounds memory at the 10m scale
+COPY_BATCH_SIZE = 100_000
+# Fixed, so the same seed gives the same rows on every run
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+USER_COLUMNS = ("id", "email", "hashed_password", "firstname", "lastname", "is_active", "roles",
+                "created_at", "updated_at")
+ARCHIVE_COLUMNS = ("id", "title", "description", "author_id", "processing_status", "created_at", "updated_at")
+
+FIRSTNAMES = ("Ada", "Grace", "Alan", "Edsger", "Barbara", "Donald", "Margaret", "Ken", "Frances", "John")
+LASTNAMES = ("Lovelace", "Hopper", "Turing", "Dijkstra", "Liskov", "Knuth", "Hamilton", "Thompson", "Allen")
+WORDS = ("invoice", "contract", "report", "payroll", "budget", "minutes", "audit", "policy", "receipt",
+         "inventory", "forecast", "proposal", "tender", "ledger", "statement", "memo")
+
+
+def connect():
+    return asyncpg.connect(host=settings.DB_HOST, port=settings.DB_PORT, database=settings.DB_NAME,
+                           user=settings.DB_USER, password=settings.DB_PASSWORD)
+
+
+def make_uuid(rng: random.Random) -> UUID:
+    return UUID(int=rng.getrandbits(128), version=4)
+
+
+def user_ids(count: int, seed: int) -> Iterator[UUID]:
+    rng = random.Random(f"users:{seed}")
+    return (make_uuid(rng) for _ in range(count))
+
+
+def users(count: int, seed: int, hashed_password: str) -> Iterator[Tuple]:
+    # One bcrypt hash for everyone, hashing millions of passwords is not what we measure
+    rng = random.Random(f"users:data:{seed}")
+    for i, user_id in enumerate(user_ids(count, seed)):
+        created_at = EPOCH + timedelta(seconds=rng.randrange(2 * 365 * 86400))
+        if i == 0:
+            yield (user_id, BENCHMARK_EMAIL, hashed_password, "Benchmark", "User", True, ["super_admin"],
+                   created_at, created_at)
+        else:
+            yield (user_id, f"user{i}@example.com", hashed_password, rng.choice(FIRSTNAMES),
+                   rng.choice(LASTNAMES), rng.random() > 0.02, [], created_at, created_at)
+
+
+def archives(count: int, author_count: int, seed: int) -> Iterator[Tuple]:
+    rng = random.Random(f"archives:{seed}")
+    # At most a million ids, regenerated from the same stream as the users
+    authors = list(user_ids(author_count, seed))
+
+    for i in range(count):
+        words = " ".join(rng.choices(WORDS, k=rng.randint(4, 24)))
+        created_at = EPOCH + timedelta(seconds=rng.randrange(2 * 365 * 86400))
+        yield (make_uuid(rng), f"{rng.choice(WORDS).title()} {i:08d}", words, rng.choice(authors),
+               rng.choice(("ready", "ready", "ready", "pending", "failed", None)), created_at, created_at)
+
+
+async def copy(connection: asyncpg.Connection, table: str, columns: Tuple[str, ...], rows: Iterable[Tuple],
+               total: int):
+    rows = iter(rows)
+    copied = 0
+    started_at = perf_counter()
+
+    while batch := list(islice(rows, COPY_BATCH_SIZE)):
+        await connection.copy_records_to_table(table, records=batch, columns=columns)
+        copied += len(batch)
+        print(f"{table}: {copied}/{total} rows, {copied / (perf_counter() - started_at):.0f} rows/s", flush=True)
+
+
+def migrate():
+    from alembic import command
+    from alembic.config import Config
+
+    command.upgrade(Config("alembic.ini"), "head")
+
+
+async def seed(archive_count: int, seed_value: int, reset: bool):
+    user_count = max(1, archive_count // 10)
+    hashed_password = Hash.bcrypt(BENCHMARK_PASSWORD)
+
+    connection = await connect()
+    try:
+        if reset:
+            await connection.execute("TRUNCATE users, archives, blobs CASCADE")
+
+        async with connection.transaction():
+            await copy(connection, "users", USER_COLUMNS, users(user_count, seed_value, hashed_password), user_count)
+            await copy(connection, "archives", ARCHIVE_COLUMNS, archives(archive_count, user_count, seed_value),
+                       archive_count)
+
+        # Fresh statistics, the planner should see the seeded sizes
+        await connection.execute("ANALYZE users")
+        await connection.execute("ANALYZE archives")
+    finally:
+        await connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--seed", type=int, default=0, help="Same seed, same rows")
+    parser.add_argument("--reset", action="store_true", help="Truncate users, archives and blobs first")
+    parser.add_argument("--migrate", action="store_true", help="Run alembic upgrade head first")
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate()
+
+    started_at = perf_counter()
+    asyncio.run(seed(SCALES[args.scale], args.seed, args.reset))
+    print(f"Seeded {args.scale} in {perf_counter() - started_at:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
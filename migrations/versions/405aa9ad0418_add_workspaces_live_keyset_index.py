@@ -0,0 +1,29 @@
+"""Add workspaces live keyset index
+
+Revision ID: 405aa9ad0418
+Revises: aa2dff0ad94d
+Create Date: 2026-10-18 12:41:05.220418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '405aa9ad0418'
+down_revision = 'aa2dff0ad94d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_workspaces_live_created_at_id', 'workspaces', ['created_at', 'id'],
+                        unique=False, postgresql_where=sa.text('deleted_at IS NULL'),
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_workspaces_live_created_at_id', table_name='workspaces',
+                      postgresql_concurrently=True)
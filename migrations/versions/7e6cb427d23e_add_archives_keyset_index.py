@@ -0,0 +1,29 @@
+"""Add archives keyset index
+
+Revision ID: 7e6cb427d23e
+Revises: b73abf6e3c91
+Create Date: 2026-10-18 10:26:47.905311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e6cb427d23e'
+down_revision = 'b73abf6e3c91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built concurrently so writes keep flowing on large tables
+    with op.get_context().autocommit_block():
+        op.create_index('ix_archives_created_at_id', 'archives', ['created_at', 'id'],
+                        unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_archives_created_at_id', table_name='archives',
+                      postgresql_concurrently=True)
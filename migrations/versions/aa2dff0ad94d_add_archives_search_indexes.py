@@ -0,0 +1,53 @@
+"""Add archives search indexes
+
+Revision ID: aa2dff0ad94d
+Revises: 7e6cb427d23e
+Create Date: 2026-10-18 11:08:32.117645
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'aa2dff0ad94d'
+down_revision = '7e6cb427d23e'
+branch_labels = None
+depends_on = None
+
+
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'B')"
+)
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    # A B-tree on free text serves no search and breaks on long descriptions
+    op.drop_index('ix_archives_description', table_name='archives')
+
+    op.add_column('archives', sa.Column('search_vector', postgresql.TSVECTOR(),
+                                        sa.Computed(SEARCH_VECTOR, persisted=True), nullable=True))
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_archives_title_trgm', 'archives', ['title'], unique=False,
+                        postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'},
+                        postgresql_concurrently=True)
+        op.create_index('ix_archives_description_trgm', 'archives', ['description'], unique=False,
+                        postgresql_using='gin', postgresql_ops={'description': 'gin_trgm_ops'},
+                        postgresql_concurrently=True)
+        op.create_index('ix_archives_search_vector', 'archives', ['search_vector'], unique=False,
+                        postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_archives_search_vector', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_description_trgm', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_title_trgm', table_name='archives', postgresql_concurrently=True)
+
+    op.drop_column('archives', 'search_vector')
+    op.create_index('ix_archives_description', 'archives', ['description'], unique=False)
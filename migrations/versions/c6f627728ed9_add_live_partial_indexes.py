@@ -0,0 +1,72 @@
+"""Add live partial indexes for archives and users
+
+Revision ID: c6f627728ed9
+Revises: f1d5318f7053
+Create Date: 2026-10-18 19:26:51.804113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6f627728ed9'
+down_revision = 'f1d5318f7053'
+branch_labels = None
+depends_on = None
+
+
+LIVE = sa.text('deleted_at IS NULL')
+
+
+def upgrade():
+    # New indexes first, queries keep an index to use while the old ones go away
+    with op.get_context().autocommit_block():
+        # Titles of soft-deleted archives can be reused
+        op.create_index('ix_archives_live_title', 'archives', ['title'], unique=True,
+                        postgresql_where=LIVE, postgresql_concurrently=True)
+        op.create_index('ix_archives_live_created_at_id', 'archives', ['created_at', 'id'], unique=False,
+                        postgresql_where=LIVE, postgresql_concurrently=True)
+        op.create_index('ix_archives_live_title_trgm', 'archives', ['title'], unique=False,
+                        postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'},
+                        postgresql_where=LIVE, postgresql_concurrently=True)
+        op.create_index('ix_archives_live_description_trgm', 'archives', ['description'], unique=False,
+                        postgresql_using='gin', postgresql_ops={'description': 'gin_trgm_ops'},
+                        postgresql_where=LIVE, postgresql_concurrently=True)
+        op.create_index('ix_archives_live_search_vector', 'archives', ['search_vector'], unique=False,
+                        postgresql_using='gin', postgresql_where=LIVE, postgresql_concurrently=True)
+        op.create_index('ix_users_live_email', 'users', ['email'], unique=False,
+                        postgresql_where=LIVE, postgresql_concurrently=True)
+
+        op.drop_index('ix_archives_title', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_created_at_id', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_title_trgm', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_description_trgm', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_search_vector', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_users_email', table_name='users', postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        # Fails while a soft-deleted archive shares its title with a live one, purge those first
+        op.create_index('ix_archives_title', 'archives', ['title'], unique=True,
+                        postgresql_concurrently=True)
+        op.create_index('ix_archives_created_at_id', 'archives', ['created_at', 'id'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_archives_title_trgm', 'archives', ['title'], unique=False,
+                        postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'},
+                        postgresql_concurrently=True)
+        op.create_index('ix_archives_description_trgm', 'archives', ['description'], unique=False,
+                        postgresql_using='gin', postgresql_ops={'description': 'gin_trgm_ops'},
+                        postgresql_concurrently=True)
+        op.create_index('ix_archives_search_vector', 'archives', ['search_vector'], unique=False,
+                        postgresql_using='gin', postgresql_concurrently=True)
+        op.create_index('ix_users_email', 'users', ['email'], unique=False,
+                        postgresql_concurrently=True)
+
+        op.drop_index('ix_users_live_email', table_name='users', postgresql_concurrently=True)
+        op.drop_index('ix_archives_live_search_vector', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_live_description_trgm', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_live_title_trgm', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_live_created_at_id', table_name='archives', postgresql_concurrently=True)
+        op.drop_index('ix_archives_live_title', table_name='archives', postgresql_concurrently=True)
@@ -0,0 +1,83 @@
+'''
+Tests run against PostgreSQL: the server configured for the app (DB_HOST, DB_USER...),
+database TEST_DB_NAME (managia_test by default). Its tables are dropped and recreated.
+
+    pip install -r tests/requirements.txt
+    createdb managia_test
+    python -m pytest tests
+'''
+import os
+
+# Before api.config reads the environment, tests never touch the app's own database
+os.environ["DB_NAME"] = os.environ.get("TEST_DB_NAME", "managia_test")
+
+from datetime import datetime
+from uuid import uuid4
+
+import httpx
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from api.core.oauth2 import principal_claims, write_token
+from api.core.permissions import permission_map
+from api.database import AsyncSessionLocal, Base, async_engine, engine
+from api.main import app
+from api.models import User
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+def database():
+    try:
+        with engine.begin() as connection:
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            Base.metadata.drop_all(connection)
+            Base.metadata.create_all(connection)
+    except OperationalError as e:
+        pytest.skip(f"PostgreSQL database {os.environ['DB_NAME']} is not available: {e.orig}")
+
+    yield
+    engine.dispose()
+
+
+@pytest.fixture
+async def db(database):
+    async with AsyncSessionLocal() as session:
+        yield session
+
+    # Every test starts from empty tables, and no pooled connection outlives its event loop
+    with engine.begin() as connection:
+        connection.execute(text(f"TRUNCATE {', '.join(table.name for table in Base.metadata.sorted_tables)}"))
+    await async_engine.dispose()
+
+
+@pytest.fixture
+async def user(db) -> User:
+    user = User(
+        id=uuid4(),
+        email=f"{uuid4().hex}@example.com",
+        firstname="Test",
+        lastname="User",
+        is_active=True,
+        roles=["super_admin"],
+        created_at=datetime.now(),
+    )
+    db.add(user)
+    await db.commit()
+    return user
+
+
+@pytest.fixture
+async def client(user):
+    # Loaded once up front, so permission checks add no query to the requests under test
+    await permission_map.ensure_loaded()
+
+    headers = {"Authorization": f"Bearer {write_token(principal_claims(user))}"}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test",
+                                 headers=headers) as client:
+        yield client
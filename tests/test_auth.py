@@ -0,0 +1,54 @@
+'''
+Password reset with a mailed code.
+'''
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from sqlalchemy import select
+
+from api.config import settings
+from api.core.hashing import Hash
+from api.main import app
+from api.models import ResetCode, User
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def anonymous():
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+@pytest.fixture
+async def reset_code(db, user, monkeypatch) -> str:
+    monkeypatch.setattr(settings, "BCRYPT_ROUNDS", 4)
+    db.add(ResetCode(email=user.email, reset_code="123456", created_at=datetime.now()))
+    await db.commit()
+    return "123456"
+
+
+def reset(code: str, password: str = "new-password") -> dict:
+    return {"reset_password_token": code, "new_password": password, "confirm_password": password}
+
+
+async def test_reset_password(anonymous, db, user, reset_code):
+    response = await anonymous.put("/api/v1/user/reset-password", json=reset(reset_code))
+    assert response.status_code == 200
+
+    hashed_password = (await db.execute(select(User.hashed_password).where(User.id == user.id))).scalar_one()
+    assert Hash.verify("new-password", hashed_password)
+
+    # A code works once
+    response = await anonymous.put("/api/v1/user/reset-password", json=reset(reset_code, "other-password"))
+    assert response.status_code == 403
+
+
+async def test_reset_password_expired_code(anonymous, db, user, reset_code):
+    db.add(ResetCode(email=user.email, reset_code="654321", expires_in=datetime.now() - timedelta(minutes=1),
+                     created_at=datetime.now()))
+    await db.commit()
+
+    response = await anonymous.put("/api/v1/user/reset-password", json=reset("654321"))
+    assert response.status_code == 403
@@ -0,0 +1,69 @@
+'''
+Archive content served from local storage, whole, by range and as HEAD.
+'''
+import hashlib
+import os
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import insert
+
+from api.core import uploads
+from api.models import Archive, Blob
+
+pytestmark = pytest.mark.anyio
+
+CONTENT = os.urandom(1000)
+
+
+@pytest.fixture
+async def archive_id(db, user, tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "upload_directory", str(tmp_path))
+    digest = hashlib.sha256(CONTENT).hexdigest()
+    os.makedirs(os.path.dirname(uploads.blob_path(digest)))
+    with open(uploads.blob_path(digest), "wb") as file:
+        file.write(CONTENT)
+
+    blob_id, archive_id = uuid4(), uuid4()
+    await db.execute(insert(Blob).values(id=blob_id, hash=digest, size=len(CONTENT),
+                                         content_type="application/pdf", ref_count=1, created_at=datetime.now()))
+    await db.execute(insert(Archive).values(id=archive_id, title="With content", author_id=user.id,
+                                            blob_id=blob_id, filename="notes.pdf", created_at=datetime.now()))
+    await db.commit()
+    return archive_id
+
+
+async def test_content(client, archive_id):
+    response = await client.get(f"/api/v1/archives/{archive_id}/content")
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["content-type"] == "application/pdf"
+
+
+async def test_content_range(client, archive_id):
+    response = await client.get(f"/api/v1/archives/{archive_id}/content", headers={"range": "bytes=100-199"})
+
+    assert response.status_code == 206
+    assert response.content == CONTENT[100:200]
+    assert response.headers["content-range"] == f"bytes 100-199/{len(CONTENT)}"
+
+
+async def test_content_head(client, archive_id):
+    response = await client.head(f"/api/v1/archives/{archive_id}/content")
+
+    assert response.status_code == 200
+    assert response.content == b""
+    assert response.headers["content-length"] == str(len(CONTENT))
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+async def test_content_missing_file(client, archive_id):
+    digest = hashlib.sha256(CONTENT).hexdigest()
+    os.unlink(uploads.blob_path(digest))
+
+    response = await client.get(f"/api/v1/archives/{archive_id}/content")
+
+    # Answered before any header is sent, not as a truncated 200
+    assert response.status_code == 404
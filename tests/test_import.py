@@ -0,0 +1,60 @@
+'''
+Bulk archive import, streamed as NDJSON or CSV.
+'''
+import orjson
+import pytest
+
+from api.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+def ndjson(*records: dict) -> bytes:
+    return b"".join(orjson.dumps(record) + b"\n" for record in records)
+
+
+async def test_import_ndjson(client):
+    response = await client.post("/api/v1/archives/import", headers={"content-type": "application/x-ndjson"},
+                                 content=ndjson({"title": "First"}, {"title": "First"}, {"description": "x"}))
+
+    assert response.status_code == 200
+    report = response.json()
+    assert report["inserted"] == 1
+    assert sorted(error["row"] for error in report["errors"]) == [2, 3]
+
+
+async def test_import_names_rows_the_database_rejects(client):
+    # Postgres text cannot hold NUL, the batch is retried row by row
+    response = await client.post("/api/v1/archives/import", headers={"content-type": "application/x-ndjson"},
+                                 content=ndjson({"title": "First"}, {"title": "Nul\u0000"}, {"title": "Third"}))
+
+    report = response.json()
+    assert report["inserted"] == 2
+    assert report["failed"] == 1
+    assert report["errors"][0]["row"] == 2
+    assert report["errors"][0]["error"].startswith("Could not be stored: invalid byte sequence")
+
+    response = await client.get("/api/v1/archives/", params={"limit": 10})
+    assert {item["title"] for item in response.json()["items"]} == {"First", "Third"}
+
+
+async def test_import_csv_multiline_fields(client):
+    content = b'title,description\nFirst,"one\n""two""\nthree"\nSecond,\n'
+    response = await client.post("/api/v1/archives/import", headers={"content-type": "text/csv"}, content=content)
+
+    report = response.json()
+    assert report["inserted"] == 2
+    assert report["failed"] == 0
+
+    response = await client.get("/api/v1/archives/", params={"limit": 10})
+    descriptions = {item["title"]: item["description"] for item in response.json()["items"]}
+    assert descriptions == {"First": 'one\n"two"\nthree', "Second": None}
+
+
+async def test_import_csv_unterminated_field(client, monkeypatch):
+    monkeypatch.setattr(settings, "IMPORT_MAX_LINE_SIZE", 1024)
+    # Short lines, but the open quote would keep the rest of the body in one record
+    content = b'title,description\nFirst,"open\n' + b"short line\n" * 200
+    response = await client.post("/api/v1/archives/import", headers={"content-type": "text/csv"}, content=content)
+
+    assert response.status_code == 413
@@ -0,0 +1,154 @@
+'''
+Outbox delivery against an in-process SMTP server.
+'''
+import logging
+import socket
+from datetime import datetime, timezone
+
+import pytest
+from aiosmtpd.controller import Controller
+from sqlalchemy import select, update
+
+from api import mailing
+from api.config import settings
+from api.database import AsyncSessionLocal
+from api.models import OutboxMail
+
+pytestmark = pytest.mark.anyio
+
+
+class Sink:
+    '''
+    Accepts every mail except to the refused addresses, remembers the sessions they came through.
+    '''
+    def __init__(self) -> None:
+        self.refused = set()
+        self.mails = []
+        self.sessions = set()
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return '550 Mailbox unavailable'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(id(session))
+        self.mails.extend(envelope.rcpt_tos)
+        return '250 OK'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def sink(monkeypatch):
+    sink = Sink()
+    controller = Controller(sink, hostname="127.0.0.1", port=free_port())
+    controller.start()
+
+    monkeypatch.setattr(settings, "SMTP_HOST", controller.hostname)
+    monkeypatch.setattr(settings, "SMTP_PORT", controller.port)
+    monkeypatch.setattr(settings, "SMTP_STARTTLS", False)
+    monkeypatch.setattr(settings, "SMTP_SSL", False)
+    monkeypatch.setattr(settings, "SMTP_USER", None)
+    monkeypatch.setattr(settings, "MAIL_LOG_ONLY", False)
+
+    yield sink
+    mailing.smtp.close()
+    controller.stop()
+
+
+async def queue(db, *recipients: str):
+    for recipient in recipients:
+        assert await mailing.queue_mail(db, recipient, "forgot_password",
+                                        {"name": "Test", "link": "http://localhost/reset?code=secret-code"})
+    await db.commit()
+
+
+async def outbox(db) -> dict:
+    db.expire_all()
+    return {mail.recipient: mail for mail in (await db.execute(select(OutboxMail))).scalars()}
+
+
+async def test_deliver_due_in_batches(db, sink):
+    recipients = [f"user{i}@example.com" for i in range(5)]
+    await queue(db, *recipients)
+
+    assert [await mailing.deliver_due(AsyncSessionLocal, 2) for _ in range(4)] == [2, 2, 1, 0]
+
+    assert sorted(sink.mails) == recipients
+    # Batches share one SMTP session
+    assert len(sink.sessions) == 1
+    assert {mail.status for mail in (await outbox(db)).values()} == {"sent"}
+
+
+async def test_refused_mail_retried_with_backoff(db, sink, monkeypatch):
+    monkeypatch.setattr(settings, "MAIL_MAX_ATTEMPTS", 2)
+    sink.refused.add("refused@example.com")
+    await queue(db, "refused@example.com", "user@example.com")
+
+    assert await mailing.deliver_due(AsyncSessionLocal, 10) == 2
+
+    # The other mail of the batch still goes out
+    assert sink.mails == ["user@example.com"]
+    mails = await outbox(db)
+    assert mails["user@example.com"].status == "sent"
+    refused = mails["refused@example.com"]
+    assert refused.status == "queued"
+    assert refused.attempts == 1
+    assert refused.send_after > datetime.now(timezone.utc)
+    assert "SMTPRecipientsRefused" in refused.last_error
+
+    # Not due before its backoff
+    assert await mailing.deliver_due(AsyncSessionLocal, 10) == 0
+
+    await db.execute(update(OutboxMail).values(send_after=datetime.now(timezone.utc)))
+    await db.commit()
+    assert await mailing.deliver_due(AsyncSessionLocal, 10) == 1
+
+    refused = (await outbox(db))["refused@example.com"]
+    assert refused.status == "failed"
+    assert refused.attempts == 2
+    assert await mailing.deliver_due(AsyncSessionLocal, 10) == 0
+
+
+async def test_queue_mail_limited_per_recipient(db, monkeypatch):
+    monkeypatch.setattr(settings, "MAIL_RECIPIENT_LIMIT", 2)
+    context = {"name": "Test", "link": "http://localhost/reset"}
+
+    assert await mailing.queue_mail(db, "user@example.com", "forgot_password", context)
+    assert await mailing.queue_mail(db, "user@example.com", "forgot_password", context)
+    assert not await mailing.queue_mail(db, "user@example.com", "forgot_password", context)
+    assert await mailing.queue_mail(db, "other@example.com", "forgot_password", context)
+    await db.commit()
+
+    assert set(await outbox(db)) == {"user@example.com", "other@example.com"}
+
+
+async def test_mail_kept_without_smtp_host(db, monkeypatch):
+    monkeypatch.setattr(settings, "SMTP_HOST", None)
+    monkeypatch.setattr(settings, "MAIL_LOG_ONLY", False)
+    await queue(db, "user@example.com")
+
+    assert await mailing.deliver_due(AsyncSessionLocal, 10) == 0
+
+    mail = (await outbox(db))["user@example.com"]
+    assert mail.status == "queued"
+    assert mail.attempts == 0
+
+
+async def test_logged_mail_logs_no_body(db, caplog, monkeypatch):
+    monkeypatch.setattr(settings, "SMTP_HOST", None)
+    monkeypatch.setattr(settings, "MAIL_LOG_ONLY", True)
+    await queue(db, "user@example.com")
+
+    with caplog.at_level(logging.INFO, logger=mailing.logger.name):
+        assert await mailing.deliver_due(AsyncSessionLocal, 10) == 1
+
+    assert "user@example.com" in caplog.text
+    assert "secret-code" not in caplog.text
+    assert (await outbox(db))["user@example.com"].status == "sent"
@@ -0,0 +1,90 @@
+'''
+Background verification of stored blobs.
+'''
+import hashlib
+import os
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import insert, select
+
+from api import jobs, processing
+from api.core import uploads
+from api.database import AsyncSessionLocal
+from api.models import Archive, Blob, Job
+
+pytestmark = pytest.mark.anyio
+
+CONTENT = b"stored bytes"
+
+
+@pytest.fixture
+def blob_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "upload_directory", str(tmp_path))
+
+    def write(digest: str, content: bytes):
+        os.makedirs(os.path.dirname(uploads.blob_path(digest)), exist_ok=True)
+        with open(uploads.blob_path(digest), "wb") as file:
+            file.write(content)
+
+    return write
+
+
+async def add_blob(db, blob_path, content: bytes) -> Blob:
+    # Stored under the hash of CONTENT, whatever it holds
+    digest = hashlib.sha256(CONTENT).hexdigest()
+    blob_path(digest, content)
+    blob_id = uuid4()
+    await db.execute(insert(Blob).values(id=blob_id, hash=digest, size=len(content), ref_count=1,
+                                         created_at=datetime.now()))
+    await db.commit()
+    return blob_id
+
+
+async def run_jobs(db) -> dict:
+    await jobs.run_due(AsyncSessionLocal, 10)
+    db.expire_all()
+    return {job.kind: job for job in (await db.execute(select(Job))).scalars()}
+
+
+async def test_verified_blob(db, blob_path):
+    blob_id = await add_blob(db, blob_path, CONTENT)
+    await processing.enqueue_verification(db, blob_id)
+    await db.commit()
+
+    job = (await run_jobs(db))[processing.VERIFY_BLOB]
+
+    assert job.status == "done"
+    blob = (await db.execute(select(Blob).where(Blob.id == blob_id))).scalar_one()
+    assert blob.verified_at is not None
+    assert blob.corrupted_at is None
+
+
+async def test_corrupted_blob_fails_at_once(client, db, user, blob_path):
+    blob_id = await add_blob(db, blob_path, b"other bytes!")
+    archive_id = uuid4()
+    await db.execute(insert(Archive).values(id=archive_id, title="Corrupted", author_id=user.id, blob_id=blob_id,
+                                            processing_status="pending", created_at=datetime.now()))
+    await processing.enqueue_processing(db, archive_id, blob_id)
+    await db.commit()
+
+    job = (await run_jobs(db))[processing.PROCESS_ARCHIVE]
+
+    # Not retried, reading the same bytes again cannot change the outcome
+    assert job.status == "failed"
+    assert job.attempts == 1
+    assert "PermanentError" in job.last_error
+
+    blob = (await db.execute(select(Blob).where(Blob.id == blob_id))).scalar_one()
+    assert blob.corrupted_at is not None
+    assert blob.verified_at is None
+    archive = (await db.execute(select(Archive).where(Archive.id == archive_id))).scalar_one()
+    assert archive.processing_status == "failed"
+
+    response = await client.get(f"/api/v1/archives/{archive_id}/content")
+    assert response.status_code == 404
+
+    response = await client.post("/api/v1/archives/uploads", json={
+        "name": "scan.pdf", "size": len(CONTENT), "sha256": blob.hash})
+    assert response.json()["exists"] is False
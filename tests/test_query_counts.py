@@ -0,0 +1,128 @@
+'''
+Statements per request of the read endpoints. The counts must not grow with the
+number of rows returned, a change that adds one per row (N+1) fails here.
+'''
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import insert
+
+from api.database import expect_queries
+from api.models import Archive, User, Workspace
+
+pytestmark = pytest.mark.anyio
+
+
+async def add_archives(db, author: User, count: int) -> list:
+    now = datetime.now()
+    rows = [{
+        "id": uuid4(),
+        "title": f"Archive {i}",
+        "description": f"Description of archive {i}",
+        "author_id": author.id,
+        "created_at": now - timedelta(seconds=i),
+    } for i in range(count)]
+    await db.execute(insert(Archive), rows)
+    await db.commit()
+    return [row["id"] for row in rows]
+
+
+async def add_workspaces(db, count: int) -> list:
+    now = datetime.now()
+    rows = [{"id": uuid4(), "name": f"Workspace {i}", "created_at": now - timedelta(seconds=i)}
+            for i in range(count)]
+    await db.execute(insert(Workspace), rows)
+    await db.commit()
+    return [row["id"] for row in rows]
+
+
+@pytest.mark.parametrize("count", [1, 100])
+async def test_list_archives(client, db, user, count):
+    await add_archives(db, user, count)
+
+    with expect_queries(1):
+        response = await client.get("/api/v1/archives/", params={"limit": 100})
+
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == count
+
+
+async def test_list_archives_with_total(client, db, user):
+    await add_archives(db, user, 100)
+
+    with expect_queries(2):
+        response = await client.get("/api/v1/archives/", params={"limit": 10, "total": "exact"})
+
+    assert response.status_code == 200
+    assert response.json()["total"] == 100
+
+
+async def test_list_archives_skips_deleted(client, db, user):
+    archive_ids = await add_archives(db, user, 3)
+
+    response = await client.delete(f"/api/v1/archives/{archive_ids[0]}")
+    assert response.status_code == 200
+
+    response = await client.get("/api/v1/archives/", params={"limit": 100})
+    assert {item["id"] for item in response.json()["items"]} == {str(id) for id in archive_ids[1:]}
+
+
+async def test_read_archive_with_author(client, db, user):
+    archive_id, = await add_archives(db, user, 1)
+
+    with expect_queries(1):
+        response = await client.get(f"/api/v1/archives/{archive_id}")
+
+    assert response.status_code == 200
+    assert response.json()["author"]["id"] == str(user.id)
+
+
+async def test_read_archive_from_cache(client, db, user):
+    archive_id, = await add_archives(db, user, 1)
+    response = await client.get(f"/api/v1/archives/{archive_id}")
+
+    with expect_queries(0):
+        cached = await client.get(f"/api/v1/archives/{archive_id}",
+                                  headers={"if-none-match": response.headers["etag"]})
+
+    assert cached.status_code == 304
+
+
+@pytest.mark.parametrize("count", [1, 100])
+async def test_search_archives(client, db, user, count):
+    await add_archives(db, user, count)
+
+    with expect_queries(1):
+        response = await client.get("/api/v1/archives/search", params={"q": "archive", "limit": 100})
+
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == count
+
+
+@pytest.mark.parametrize("count", [1, 100])
+async def test_list_workspaces(client, db, count):
+    await add_workspaces(db, count)
+
+    with expect_queries(1):
+        response = await client.get("/api/v1/workspaces", params={"limit": 100})
+
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == count
+
+
+async def test_read_workspace(client, db):
+    workspace_id, = await add_workspaces(db, 1)
+
+    with expect_queries(1):
+        response = await client.get(f"/api/v1/workspaces/{workspace_id}")
+
+    assert response.status_code == 200
+
+
+async def test_user_profile(client, user):
+    with expect_queries(1):
+        response = await client.get("/api/v1/user/me")
+
+    assert response.status_code == 200
+    assert response.json()["id"] == str(user.id)
@@ -0,0 +1,76 @@
+'''
+Websocket connections end with their token.
+'''
+from datetime import timedelta
+from uuid import uuid4
+
+import jwt
+import pytest
+from starlette.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from api.config import settings
+from api.core import tokens
+from api.core.permissions import SUPER_ROLE, WILDCARD, permission_map
+from api.main import app
+
+
+@pytest.fixture
+def token(monkeypatch) -> str:
+    monkeypatch.setattr(settings, "REALTIME_TOKEN_CHECK_INTERVAL", 0.1)
+    monkeypatch.setattr(tokens, "revocations", tokens.RevocationList())
+    # Claims carry the user, connecting needs no database
+    return tokens.issue({"sub": "user@example.com", "uid": str(uuid4()), "is_active": True, "roles": []})
+
+
+def test_revoked_token_closes_socket(token):
+    with TestClient(app).websocket_connect(f"/api/v1/ws?token={token}") as websocket:
+        websocket.send_json({"action": "unknown", "topic": "archives"})
+        assert websocket.receive_json()["event"] == "error"
+
+        tokens.revocations.add_jti(jwt.decode(token, options={"verify_signature": False})["jti"])
+
+        with pytest.raises(WebSocketDisconnect) as disconnect:
+            websocket.receive_json()
+
+    assert disconnect.value.code == 1008
+    assert disconnect.value.reason == "Token Revoked"
+
+
+def test_expired_token_closes_socket(monkeypatch):
+    monkeypatch.setattr(tokens, "token_lifetime", timedelta(seconds=1))
+    token = tokens.issue({"sub": "user@example.com", "uid": str(uuid4()), "is_active": True, "roles": []})
+
+    with TestClient(app).websocket_connect(f"/api/v1/ws?token={token}") as websocket:
+        with pytest.raises(WebSocketDisconnect) as disconnect:
+            websocket.receive_json()
+
+    assert disconnect.value.code == 1008
+    assert disconnect.value.reason == "Token Expired"
+
+
+def test_binary_frame_answered_with_error(token):
+    with TestClient(app).websocket_connect(f"/api/v1/ws?token={token}") as websocket:
+        websocket.send_bytes(b'{"action": "subscribe", "topic": "archives"}')
+        assert websocket.receive_json() == {"event": "error", "detail": "Expected a text frame"}
+
+        # The socket stays usable
+        websocket.send_json({"action": "unknown", "topic": "archives"})
+        assert websocket.receive_json()["event"] == "error"
+
+
+def test_workspace_topics_rejected(monkeypatch):
+    # Roles already loaded, subscribing needs no database
+    monkeypatch.setattr(permission_map, "roles", {SUPER_ROLE: frozenset({WILDCARD})})
+    monkeypatch.setattr(permission_map, "combined", {})
+    monkeypatch.setattr(permission_map, "loaded_version", permission_map.version)
+    token = tokens.issue({"sub": "user@example.com", "uid": str(uuid4()), "is_active": True,
+                          "roles": [SUPER_ROLE]})
+
+    with TestClient(app).websocket_connect(f"/api/v1/ws?token={token}") as websocket:
+        websocket.send_json({"action": "subscribe", "topic": "workspaces"})
+        assert websocket.receive_json() == {"event": "subscribed", "topic": "workspaces"}
+
+        # Nothing is published per workspace
+        websocket.send_json({"action": "subscribe", "topic": f"workspace:{uuid4()}"})
+        assert websocket.receive_json()["event"] == "error"
@@ -0,0 +1,165 @@
+'''
+S3Storage against a local S3 stand-in: a moto server started here, or the
+service at S3_TEST_ENDPOINT_URL (e.g. MinIO, with S3_TEST_ACCESS_KEY and S3_TEST_SECRET_KEY).
+'''
+import hashlib
+import os
+import socket
+from uuid import uuid4
+
+import httpx
+import pytest
+
+from api import maintenance, processing
+from api.config import settings
+from api.core import storage as storage_module
+from api.routers import archives
+
+pytestmark = pytest.mark.anyio
+
+CHUNK_SIZE = 5 * 1024 * 1024
+CONTENT = os.urandom(2 * CHUNK_SIZE + 1000)
+DIGEST = hashlib.sha256(CONTENT).hexdigest()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def s3_endpoint():
+    endpoint = os.environ.get("S3_TEST_ENDPOINT_URL")
+    if endpoint:
+        yield endpoint, os.environ.get("S3_TEST_ACCESS_KEY", "test"), os.environ.get("S3_TEST_SECRET_KEY", "test")
+        return
+
+    pytest.importorskip("boto3")
+    server_module = pytest.importorskip("moto.server")
+    server = server_module.ThreadedMotoServer(ip_address="127.0.0.1", port=free_port(), verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}", "test", "test"
+    server.stop()
+
+
+@pytest.fixture
+def s3(s3_endpoint, monkeypatch):
+    endpoint, access_key, secret_key = s3_endpoint
+    for name, value in {
+        "S3_BUCKET": "managia-test",
+        "S3_ENDPOINT_URL": endpoint,
+        "S3_REGION": "us-east-1",
+        "S3_ACCESS_KEY": access_key,
+        "S3_SECRET_KEY": secret_key,
+        "S3_ADDRESSING_STYLE": "path",
+        # Every test in its own keys, the bucket may be shared
+        "S3_PREFIX": f"test-{uuid4().hex}/",
+    }.items():
+        monkeypatch.setattr(settings, name, value)
+    monkeypatch.setattr(storage_module, "s3_client", None)
+
+    s3 = storage_module.S3Storage()
+    try:
+        s3.client.create_bucket(Bucket=settings.S3_BUCKET)
+    except s3.client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    for module in (archives, processing, maintenance):
+        monkeypatch.setattr(module, "storage", s3)
+    return s3
+
+
+async def upload(client, order, archive_id=None) -> str:
+    response = await client.post("/api/v1/archives/uploads", json={
+        "name": "scan.pdf", "size": len(CONTENT), "chunk_size": CHUNK_SIZE, "archive_id": archive_id})
+    assert response.status_code == 201
+    upload_id = response.json()["upload_id"]
+
+    for index in order:
+        response = await client.put(f"/api/v1/archives/uploads/{upload_id}/chunks/{index}",
+                                    content=CONTENT[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE])
+        assert response.status_code == 200
+
+    return upload_id
+
+
+def keys(s3) -> set:
+    listing = s3.client.list_objects_v2(Bucket=s3.bucket, Prefix=settings.S3_PREFIX)
+    return {item["Key"] for item in listing.get("Contents", [])}
+
+
+def multipart_uploads(s3) -> list:
+    return s3.client.list_multipart_uploads(Bucket=s3.bucket, Prefix=settings.S3_PREFIX).get("Uploads", [])
+
+
+async def test_upload_served_by_redirect(client, s3):
+    response = await client.post("/api/v1/archives/", json={"title": "Scan"})
+    archive_id = response.json()["archive_id"]
+
+    upload_id = await upload(client, [0, 1, 2], archive_id)
+    response = await client.post(f"/api/v1/archives/uploads/{upload_id}/complete")
+
+    assert response.status_code == 200
+    assert response.json()["sha256"] == DIGEST
+    # Copied server side to its content address, the multipart object is gone
+    assert keys(s3) == {s3.blob_key(DIGEST)}
+    assert multipart_uploads(s3) == []
+
+    response = await client.get(f"/api/v1/archives/{archive_id}/content")
+    assert response.status_code == 307
+    downloaded = httpx.get(response.headers["location"])
+    assert downloaded.status_code == 200
+    assert downloaded.content == CONTENT
+    assert downloaded.headers["content-type"] == "application/pdf"
+
+
+async def test_out_of_order_chunks_hashed_from_storage(client, s3):
+    # Chunk 2 arrives first and misses the running hash, it is read back from storage on completion
+    upload_id = await upload(client, [2, 0, 1])
+    response = await client.post(f"/api/v1/archives/uploads/{upload_id}/complete")
+
+    assert response.status_code == 200
+    assert response.json()["sha256"] == DIGEST
+    assert s3.read_hash(DIGEST) == DIGEST
+
+
+async def test_oversized_chunk_not_uploaded(client, s3):
+    response = await client.post("/api/v1/archives/uploads", json={
+        "name": "scan.pdf", "size": len(CONTENT), "chunk_size": CHUNK_SIZE})
+    upload_id = response.json()["upload_id"]
+
+    async def body():
+        # Streamed without a Content-Length, only the storage notices the size
+        yield CONTENT[:CHUNK_SIZE]
+
+    response = await client.put(f"/api/v1/archives/uploads/{upload_id}/chunks/2", content=body())
+    assert response.status_code == 400
+
+    multipart_upload_id = multipart_uploads(s3)[0]["UploadId"]
+    parts = s3.client.list_parts(Bucket=s3.bucket, Key=s3.upload_key(upload_id), UploadId=multipart_upload_id)
+    assert parts.get("Parts", []) == []
+
+
+async def test_abort_upload(client, s3):
+    upload_id = await upload(client, [0])
+    assert len(multipart_uploads(s3)) == 1
+
+    response = await client.delete(f"/api/v1/archives/uploads/{upload_id}")
+
+    assert response.status_code == 200
+    assert multipart_uploads(s3) == []
+    assert keys(s3) == set()
+
+
+async def test_remove_stale_multipart_uploads(client, s3, monkeypatch):
+    await upload(client, [0])
+    s3.client.put_object(Bucket=s3.bucket, Key=s3.upload_key(uuid4()), Body=b"completed, never moved")
+
+    # Everything is older than a negative TTL
+    monkeypatch.setattr(settings, "UPLOAD_SESSION_TTL", -60)
+    assert await s3.remove_orphan_uploads() == 2
+
+    assert multipart_uploads(s3) == []
+    assert keys(s3) == set()